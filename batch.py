@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import csv
+import copy
+import json
+import time
+import fnmatch
+import tempfile
+import unittest
+import contextlib
+import concurrent.futures
+
+from msgs import cprint, fatal
+
+# --batch DIR...: build every book found under the directories.  Each
+# book is built in its own directory, by a worker process, --jobs at a
+# time; its output goes to <book>-build.log beside it, instead of the
+# terminal.  When they are all done a summary is written, in JSON, or
+# in CSV if the summary file name ends in .csv.
+
+DEFAULT_SUMMARY = "fpgen-batch.json"
+
+# Every *-src.txt under the dirs, in a stable order
+def findBooks(dirs):
+  books = []
+  for top in dirs:
+    if not os.path.isdir(top):
+      fatal("--batch: not a directory: " + top)
+    for dir, subdirs, files in os.walk(top):
+      subdirs[:] = sorted(d for d in subdirs if not d.startswith("."))
+      for file in sorted(files):
+        if fnmatch.fnmatch(file, "*-src.txt"):
+          books.append(os.path.join(dir, file))
+  return books
+
+# Runs in a worker: build one book, returning its line of the summary
+def buildBook(path, options):
+  import main
+  dir, infile = os.path.split(os.path.abspath(path))
+  bn = infile[:-len("-src.txt")]
+  options = copy.copy(options)
+  options.infile = infile
+  options.jobs = 1
+
+  summary = {
+    "book" : path,
+    "status" : "ok",
+    "error" : "",
+    "seconds" : 0,
+    "warnings" : [],
+    "tasks" : [],
+    "log" : os.path.join(os.path.dirname(path), bn + "-build.log"),
+  }
+  cwd = os.getcwd()
+  out = io.StringIO()
+  start = time.time()
+  os.chdir(dir)
+  scheduler = None
+  try:
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+      try:
+        scheduler = main.build(options, bn)
+      except SystemExit:
+        summary["status"] = "failed"
+      except Exception as e:
+        summary["status"] = "failed"
+        summary["error"] = type(e).__name__ + ": " + str(e)
+    with open(bn + "-build.log", "w", encoding='utf-8') as f:
+      f.write(out.getvalue())
+
+    if scheduler is not None:
+      for task in scheduler.tasks:
+        sizes = {}
+        for file in task.outputs:
+          if os.path.exists(file):
+            sizes[file] = os.path.getsize(file)
+        summary["tasks"].append({
+          "name" : task.name,
+          "format" : task.group,
+          "status" : task.status,
+          "seconds" : round(task.elapsed, 3),
+          "cached" : task.cached,
+          "outputs" : sizes,
+        })
+        if task.status == "failed":
+          summary["status"] = "failed"
+  finally:
+    os.chdir(cwd)
+
+  summary["seconds"] = round(time.time() - start, 3)
+  log = out.getvalue().splitlines()
+  summary["warnings"] = [ l for l in log if l.startswith("warning") ]
+  if summary["status"] == "failed" and summary["error"] == "":
+    errors = [ l for l in log if l.startswith("fatal:") or ": failed: " in l ]
+    if scheduler is not None:
+      errors.append("Failed: " + ", ".join(task.name
+        for task in scheduler.tasks if task.status == "failed"))
+    summary["error"] = "; ".join(errors)
+  return summary
+
+def runBatch(options, dirs):
+  from formats import makePool
+  books = findBooks(dirs)
+  if len(books) == 0:
+    fatal("--batch: no *-src.txt files found")
+  cprint("Building {} books, {} at a time".format(len(books), options.jobs))
+
+  summaries = []
+  with makePool(options.jobs) as pool:
+    futures = [ pool.submit(buildBook, book, options) for book in books ]
+    for future in concurrent.futures.as_completed(futures):
+      summary = future.result()
+      summaries.append(summary)
+      cprint("{:6} {:8.2f}s {:3} warnings  {}".format(summary["status"],
+        summary["seconds"], len(summary["warnings"]), summary["book"]))
+
+  summaries.sort(key = lambda s: books.index(s["book"]))
+  summaryFile = options.summary or DEFAULT_SUMMARY
+  writeSummary(summaries, summaryFile)
+  failed = sum(1 for s in summaries if s["status"] != "ok")
+  cprint("{} built, {} failed; summary in {}".format(len(summaries) - failed,
+    failed, summaryFile))
+  if failed > 0:
+    exit(1)
+
+def writeSummary(summaries, file):
+  if file.endswith(".csv"):
+    writeCSV(summaries, file)
+  else:
+    with open(file, "w", encoding='utf-8') as f:
+      json.dump(summaries, f, indent=2)
+      f.write("\n")
+
+# One row per book; the time of each format is the sum of its tasks, and
+# its size that of its final outputs.
+def writeCSV(summaries, file):
+  from formats import ORDER
+  header = [ "book", "status", "seconds", "warnings", "error" ]
+  for fmt in ORDER:
+    header += [ fmt + "_seconds", fmt + "_bytes" ]
+  with open(file, "w", encoding='utf-8', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(header)
+    for s in summaries:
+      row = [ s["book"], s["status"], s["seconds"], len(s["warnings"]),
+        s["error"] ]
+      for fmt in ORDER:
+        tasks = [ t for t in s["tasks"] if t["format"] == fmt ]
+        if len(tasks) == 0:
+          row += [ "", "" ]
+          continue
+        row.append(round(sum(t["seconds"] for t in tasks), 3))
+        row.append(sum(sum(t["outputs"].values()) for t in tasks))
+      writer.writerow(row)
+
+class TestBatch(unittest.TestCase):
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.dir = tempfile.TemporaryDirectory()
+    os.chdir(self.dir.name)
+    for name, line in [ ("a/one", "A book."), ("a/b/two", "<l>bad"),
+        ("c/three", "Another.") ]:
+      os.makedirs(os.path.dirname(name), exist_ok=True)
+      with open(name + "-src.txt", "w", encoding='utf-8') as f:
+        f.write("<heading level='1'>H</heading>\n\n" + line + "\n")
+    os.makedirs("a/.hidden")
+    with open("a/.hidden/x-src.txt", "w") as f:
+      f.write("\n")
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    self.dir.cleanup()
+    import config
+    config.setContext(config.BuildContext())
+
+  def options(self):
+    from optparse import Values
+    return Values({ "formats" : "th", "debug" : "0", "saveint" : False,
+      "ebookid" : "", "jobs" : 1, "resume" : False, "cache" : False,
+      "unitCache" : False, "watch" : False, "trace" : "",
+      "memprofile" : False, "regexStats" : False, "cssMinify" : False })
+
+  def test_batch_find(self):
+    self.assertSequenceEqual(findBooks([ "a", "c" ]), [
+      os.path.join("a", "one-src.txt"),
+      os.path.join("a", "b", "two-src.txt"),
+      os.path.join("c", "three-src.txt"),
+    ])
+
+  def test_batch_build(self):
+    s = buildBook(os.path.join("a", "one-src.txt"), self.options())
+    self.assertEqual(s["status"], "ok")
+    self.assertEqual(os.getcwd(), os.path.realpath(self.dir.name))
+    self.assertTrue(os.path.exists("a/one.html"))
+    self.assertTrue(os.path.exists("a/one-build.log"))
+    html = [ t for t in s["tasks"] if t["format"] == 'h' ][0]
+    self.assertEqual(html["status"], "done")
+    self.assertEqual(html["outputs"]["one.html"],
+      os.path.getsize("a/one.html"))
+
+  def test_batch_failure(self):
+    s = buildBook(os.path.join("a", "b", "two-src.txt"), self.options())
+    self.assertEqual(s["status"], "failed")
+    self.assertIn("lint text", s["error"])
+    self.assertEqual(os.getcwd(), os.path.realpath(self.dir.name))
+
+  def test_batch_summary(self):
+    s = [ buildBook(b, self.options()) for b in findBooks([ "a" ]) ]
+    writeSummary(s, "s.json")
+    with open("s.json") as f:
+      self.assertEqual(json.load(f)[0]["book"], s[0]["book"])
+    writeSummary(s, "s.csv")
+    with open("s.csv") as f:
+      rows = list(csv.reader(f))
+    self.assertEqual(rows[0][:3], [ "book", "status", "seconds" ])
+    self.assertEqual(rows[1][1], "ok")
+    self.assertEqual(rows[2][1], "failed")
+    self.assertEqual(rows[1][rows[0].index("h_bytes")],
+      str(os.path.getsize("a/one.html")))
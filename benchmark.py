@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from optparse import OptionParser
+import os
+import io
+import json
+import math
+import time
+import tempfile
+import unittest
+import contextlib
+
+import config
+import passes
+import synthbook
+
+# benchmark: how the time to generate each format, and each pass within
+# it, grows with the size of the book.  A synthetic book (synthbook.py) is
+# built at each scale, each format generated in this process with the
+# passes timed, and the times written as JSON.
+#
+# The growth between the two largest scales is measured as an exponent:
+# time is proportional to size ** exponent, so 1 is linear and 2 is
+# quadratic.  Anything over --max-exponent fails the benchmark; times too
+# short to measure reliably, under --min-time, are not checked.
+
+DEFAULT_SCALES = "1,10,100"
+DEFAULT_OUTPUT = "fpgen-benchmark.json"
+MAX_EXPONENT = 1.25
+MIN_TIME = 0.05
+
+# Generate one format, returning the total time, and that of every pass by
+# name; a pass which runs more than once is the sum of its runs.
+def timeFormat(fmt, infile, bn):
+  from formats import generateFormat
+  timer = passes.addListener(passes.PassTimer())
+  out = io.StringIO()
+  try:
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+      result = generateFormat(fmt, infile, bn, 0, None)
+  finally:
+    passes.removeListener(timer)
+  times = {}
+  for book, name, depth, start, elapsed in timer.entries:
+    times[name] = times.get(name, 0) + elapsed
+  return result.elapsed, times
+
+# Generate every format at one scale, keeping the fastest of repeat runs
+def runScale(shape, scale, formats, repeat):
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as dir:
+    os.chdir(dir)
+    try:
+      lines = synthbook.writeBook(shape.scaled(scale), "synth-src.txt")
+      results = { "lines" : lines, "formats" : {} }
+      for fmt in formats:
+        best = None
+        for i in range(repeat):
+          total, times = timeFormat(fmt, "synth-src.txt", "synth")
+          if best is None or total < best[0]:
+            best = (total, times)
+        results["formats"][fmt] = {
+          "total" : round(best[0], 4),
+          "passes" : { name : round(t, 4) for name, t in best[1].items() },
+        }
+    finally:
+      os.chdir(cwd)
+  return results
+
+def exponent(t0, t1, n0, n1):
+  return math.log(t1 / t0) / math.log(n1 / n0)
+
+# Everything which grows faster than maxExponent, between the two largest
+# scales: a list of (format, pass, exponent); pass is "" for the total.
+def checkScaling(results, maxExponent, minTime):
+  scales = sorted(results["scales"], key=int)
+  if len(scales) < 2:
+    return []
+  small = results["scales"][scales[-2]]
+  big = results["scales"][scales[-1]]
+  n0, n1 = small["lines"], big["lines"]
+  slow = []
+  for fmt, f1 in big["formats"].items():
+    f0 = small["formats"][fmt]
+    pairs = [ ("", f0["total"], f1["total"]) ]
+    pairs += [ (name, f0["passes"].get(name, 0), t1)
+      for name, t1 in f1["passes"].items() ]
+    for name, t0, t1 in pairs:
+      if t0 < minTime or t1 < minTime:
+        continue
+      e = exponent(t0, t1, n0, n1)
+      if e > maxExponent:
+        slow.append((fmt, name, e))
+  return slow
+
+def report(results, out = print):
+  scales = sorted(results["scales"], key=int)
+  out("{:<32}".format("scale") +
+    "".join("{:>12}".format(s + "x") for s in scales))
+  out("{:<32}".format("lines") + "".join("{:>12}".format(
+    results["scales"][s]["lines"]) for s in scales))
+  for fmt in results["formats"]:
+    out("{:<32}".format(fmt) + "".join("{:>11.3f}s".format(
+      results["scales"][s]["formats"][fmt]["total"]) for s in scales))
+    largest = results["scales"][scales[-1]]["formats"][fmt]["passes"]
+    for name in sorted(largest, key=lambda n: -largest[n])[:10]:
+      out("{:<32}".format("  " + name) + "".join("{:>11.3f}s".format(
+        results["scales"][s]["formats"][fmt]["passes"].get(name, 0))
+        for s in scales))
+
+def main():
+  parser = OptionParser(usage="usage: %prog [options]")
+  parser.add_option("-s", "--scales", dest="scales", default=DEFAULT_SCALES,
+    help="comma separated multiples of the base book, default " +
+      DEFAULT_SCALES)
+  parser.add_option("-f", "--formats", dest="formats", default="thekp",
+    help="format(s), from thekp, default thekp")
+  parser.add_option("-o", "--output", dest="output", default=DEFAULT_OUTPUT,
+    help="JSON results file, default " + DEFAULT_OUTPUT)
+  parser.add_option("-r", "--repeat", dest="repeat", type="int", default=1,
+    help="run each format this many times, keeping the fastest")
+  parser.add_option("--chapters", dest="chapters", type="int",
+    default=synthbook.Shape().chapters, help="chapters in the 1x book")
+  parser.add_option("--max-exponent", dest="maxExponent", type="float",
+    default=MAX_EXPONENT, help="fail when time grows faster than " +
+    "size to this power, default " + str(MAX_EXPONENT))
+  parser.add_option("--min-time", dest="minTime", type="float",
+    default=MIN_TIME, help="do not check times under this many seconds, " +
+    "default " + str(MIN_TIME))
+  (options, args) = parser.parse_args()
+
+  scales = [ int(s) for s in options.scales.split(",") ]
+  formats = [ fmt for fmt in "thekp" if fmt in options.formats ]
+  shape = synthbook.Shape()
+  shape.chapters = options.chapters
+
+  results = {
+    "version" : config.VERSION,
+    "formats" : formats,
+    "scales" : {},
+  }
+  for scale in scales:
+    start = time.time()
+    results["scales"][str(scale)] = runScale(shape, scale, formats,
+      options.repeat)
+    print("{}x: {} lines, {:.2f}s".format(scale,
+      results["scales"][str(scale)]["lines"], time.time() - start))
+
+  slow = checkScaling(results, options.maxExponent, options.minTime)
+  results["slow"] = [ { "format" : fmt, "pass" : name,
+    "exponent" : round(e, 2) } for fmt, name, e in slow ]
+  with open(options.output, "w", encoding='utf-8') as f:
+    json.dump(results, f, indent=2)
+    f.write("\n")
+
+  report(results)
+  if len(slow) > 0:
+    for fmt, name, e in slow:
+      print("{}: {} grows as size ** {:.2f}".format(fmt, name or "total", e))
+    exit(1)
+
+class TestBenchmark(unittest.TestCase):
+  def tearDown(self):
+    config.setContext(config.BuildContext())
+
+  def results(self, t0, t1):
+    return { "scales" : {
+      "1" : { "lines" : 100, "formats" : {
+        "t" : { "total" : t0, "passes" : { "a" : t0 } } } },
+      "10" : { "lines" : 1000, "formats" : {
+        "t" : { "total" : t1, "passes" : { "a" : t1 } } } },
+    } }
+
+  def test_benchmark_linear(self):
+    self.assertEqual(checkScaling(self.results(0.1, 1.0), 1.25, 0.05), [])
+
+  def test_benchmark_quadratic(self):
+    slow = checkScaling(self.results(0.1, 10.0), 1.25, 0.05)
+    self.assertEqual([ (f, n) for f, n, e in slow ], [ ("t", ""), ("t", "a") ])
+    self.assertAlmostEqual(slow[0][2], 2.0)
+
+  def test_benchmark_too_short(self):
+    self.assertEqual(checkScaling(self.results(0.001, 1.0), 1.25, 0.05), [])
+
+  # The synthetic book builds, without warnings, and grows with the scale
+  def test_benchmark_synthbook(self):
+    shape = synthbook.Shape()
+    shape.chapters = 2
+    results = runScale(shape, 1, "th", 1)
+    self.assertGreater(results["formats"]["h"]["total"], 0)
+    self.assertIn("loadFile", results["formats"]["h"]["passes"])
+    self.assertIn("rewrap", results["formats"]["t"]["passes"])
+    one = synthbook.Synth(shape.scaled(1)).book()
+    three = synthbook.Synth(shape.scaled(3)).book()
+    self.assertGreater(len(three), 2.5 * len(one))
+
+if __name__ == '__main__':
+  main()
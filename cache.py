@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import pickle
+import hashlib
+import tempfile
+import unittest
+
+# A content addressed cache of build outputs, in .fpgen-cache in the book's
+# directory.  Each entry is keyed by a hash of everything the step depends
+# on: the contents of its input files, the command line or format, the
+# fpgen version, and fpgen's own code; and holds copies of the files the
+# step made, and its result.  When the key matches, the files are copied back, rather than
+# running the step again.
+#
+# Entries which have not been used for maxDays are evicted; and then the
+# least recently used, until the cache is smaller than maxBytes.
+#
+# Lines of a file which match volatile, such as the time it was made, are
+# not part of its hash.
+
+CACHE_DIR = ".fpgen-cache"
+CACHE_MAX_MB = 500
+CACHE_MAX_DAYS = 30
+
+# The hash of fpgen's own code, the .py files beside this one; part of
+# every key, so that a change to the code makes new entries even when
+# config.VERSION is the same
+codeDigest = None
+
+def codeHash():
+  global codeDigest
+  if codeDigest is None:
+    h = hashlib.sha256()
+    dir = os.path.dirname(os.path.abspath(__file__))
+    for name in sorted(os.listdir(dir)):
+      if name.endswith(".py"):
+        h.update(name.encode('utf-8') + b'\0')
+        with open(os.path.join(dir, name), "rb") as f:
+          h.update(hashlib.sha256(f.read()).digest())
+    codeDigest = h.hexdigest()
+  return codeDigest
+
+class BuildCache(object):
+  def __init__(self, dir = CACHE_DIR, maxBytes = CACHE_MAX_MB * 1024 * 1024,
+      maxDays = CACHE_MAX_DAYS, volatile = None):
+    self.dir = dir
+    self.volatile = volatile
+    self.maxBytes = maxBytes
+    self.maxDays = maxDays
+    self.hashes = {}
+
+  def key(self, parts):
+    h = hashlib.sha256()
+    h.update(codeHash().encode('utf-8'))
+    for part in parts:
+      h.update(part.encode('utf-8'))
+      h.update(b'\0')
+    return h.hexdigest()
+
+  # Hash of a file's contents; remembered while the file is unchanged,
+  # since the same image is part of many keys.
+  def hashFile(self, path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return "missing " + path
+    id = (path, st.st_mtime_ns, st.st_size)
+    if id not in self.hashes:
+      h = hashlib.sha256()
+      with open(path, "rb") as f:
+        if self.volatile is None:
+          for block in iter(lambda: f.read(1024*1024), b''):
+            h.update(block)
+        else:
+          for line in f:
+            if not self.volatile.search(line):
+              h.update(line)
+      self.hashes[id] = h.hexdigest()
+    return self.hashes[id]
+
+  def entry(self, key):
+    return os.path.join(self.dir, key[:2], key)
+
+  # Copy the files of the entry back; returns (True, result) on a hit.
+  def restore(self, key, files):
+    entry = self.entry(key)
+    if not os.path.isdir(entry):
+      return False, None
+    try:
+      with open(os.path.join(entry, "result"), "rb") as f:
+        result = pickle.load(f)
+      for i, file in enumerate(files):
+        shutil.copyfile(os.path.join(entry, str(i)), file)
+    except Exception:
+      return False, None
+    # Mark it used, for eviction
+    os.utime(entry)
+    return True, result
+
+  def store(self, key, files, result):
+    entry = self.entry(key)
+    if os.path.isdir(entry):
+      return
+    os.makedirs(os.path.dirname(entry), exist_ok = True)
+    # Build it to one side, so a partial entry is never seen
+    tmp = tempfile.mkdtemp(dir = os.path.dirname(entry))
+    try:
+      for i, file in enumerate(files):
+        shutil.copyfile(file, os.path.join(tmp, str(i)))
+      with open(os.path.join(tmp, "result"), "wb") as f:
+        pickle.dump(result, f)
+      os.rename(tmp, entry)
+    except OSError:
+      # Most likely another process stored the same entry
+      shutil.rmtree(tmp, ignore_errors = True)
+
+  def evict(self):
+    if not os.path.isdir(self.dir):
+      return
+    entries = []
+    for sub in os.listdir(self.dir):
+      subdir = os.path.join(self.dir, sub)
+      if not os.path.isdir(subdir):
+        continue
+      for key in os.listdir(subdir):
+        entry = os.path.join(subdir, key)
+        # Not an entry; e.g. left by an editor
+        if not os.path.isdir(entry):
+          continue
+        size = 0
+        for file in os.listdir(entry):
+          size += os.path.getsize(os.path.join(entry, file))
+        entries.append((os.path.getmtime(entry), size, entry))
+
+    # Oldest first
+    entries.sort()
+    total = sum(size for mtime, size, entry in entries)
+    oldest = time.time() - self.maxDays * 24 * 60 * 60
+    for mtime, size, entry in entries:
+      if mtime >= oldest and total <= self.maxBytes:
+        break
+      shutil.rmtree(entry, ignore_errors = True)
+      total -= size
+
+class TestBuildCache(unittest.TestCase):
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.dir = tempfile.TemporaryDirectory()
+    os.chdir(self.dir.name)
+    self.cache = BuildCache()
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    self.dir.cleanup()
+
+  def write(self, name, contents):
+    with open(name, "w") as f:
+      f.write(contents)
+
+  def read(self, name):
+    with open(name, "r") as f:
+      return f.read()
+
+  def test_cache_key(self):
+    k = self.cache.key([ "a", "b" ])
+    self.assertEqual(k, self.cache.key([ "a", "b" ]))
+    self.assertNotEqual(k, self.cache.key([ "ab" ]))
+    self.assertNotEqual(k, self.cache.key([ "b", "a" ]))
+
+  # A change to fpgen's code, without a new version, is a different key
+  def test_cache_key_code(self):
+    global codeDigest
+    k = self.cache.key([ "a" ])
+    saved = codeHash()
+    try:
+      codeDigest = "changed"
+      self.assertNotEqual(k, self.cache.key([ "a" ]))
+    finally:
+      codeDigest = saved
+    self.assertEqual(k, self.cache.key([ "a" ]))
+
+  def test_cache_hash_file(self):
+    self.write("a", "one")
+    h = self.cache.hashFile("a")
+    self.write("b", "one")
+    self.assertEqual(h, self.cache.hashFile("b"))
+    self.write("a", "two!")
+    self.assertNotEqual(h, self.cache.hashFile("a"))
+    self.assertEqual(self.cache.hashFile("c"), "missing c")
+
+  def test_cache_hash_volatile(self):
+    import re
+    self.cache.volatile = re.compile(b"^made at ")
+    self.write("a", "one\nmade at 1\n")
+    self.write("b", "one\nmade at 2\n")
+    self.write("c", "one\nmade by 2\n")
+    self.assertEqual(self.cache.hashFile("a"), self.cache.hashFile("b"))
+    self.assertNotEqual(self.cache.hashFile("a"), self.cache.hashFile("c"))
+
+  def test_cache_store_restore(self):
+    self.write("out", "contents")
+    self.assertEqual(self.cache.restore("k1", [ "out" ]), (False, None))
+    self.cache.store("k1", [ "out" ], { "x" : 1 })
+    os.remove("out")
+    self.assertEqual(self.cache.restore("k1", [ "out" ]), (True, { "x" : 1 }))
+    self.assertEqual(self.read("out"), "contents")
+
+  def test_cache_evict_size(self):
+    for i in range(4):
+      self.write("out", "x" * 100)
+      self.cache.store("k" + str(i), [ "out" ], None)
+      os.utime(self.cache.entry("k" + str(i)), (1000 + i, time.time() - i))
+    # k0 was used last, k3 first
+    self.cache.maxBytes = 250
+    self.cache.evict()
+    self.assertTrue(self.cache.restore("k0", [ "out" ])[0])
+    self.assertTrue(self.cache.restore("k1", [ "out" ])[0])
+    self.assertFalse(self.cache.restore("k2", [ "out" ])[0])
+    self.assertFalse(self.cache.restore("k3", [ "out" ])[0])
+
+  def test_cache_evict_age(self):
+    self.write("out", "x")
+    self.cache.store("old", [ "out" ], None)
+    self.cache.store("new", [ "out" ], None)
+    old = time.time() - (CACHE_MAX_DAYS + 1) * 24 * 60 * 60
+    os.utime(self.cache.entry("old"), (old, old))
+    self.cache.evict()
+    self.assertFalse(self.cache.restore("old", [ "out" ])[0])
+    self.assertTrue(self.cache.restore("new", [ "out" ])[0])
+
+  def test_cache_evict_stray_file(self):
+    self.write("out", "x")
+    self.cache.store("k", [ "out" ], None)
+    stray = os.path.join(os.path.dirname(self.cache.entry("k")), "k~")
+    self.write(stray, "x")
+    self.cache.evict()
+    self.assertTrue(self.cache.restore("k", [ "out" ])[0])
+    self.assertTrue(os.path.exists(stray))
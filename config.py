@@ -1,5 +1,8 @@
 from userOptions import userOptions
 
+import sys
+import types
+import threading
 from time import gmtime, strftime
 
 #uopt = userOptions()
@@ -206,8 +209,56 @@ from time import gmtime, strftime
 # 4.67b    Fix double insertion of fpgen html line in pppunc.py
 # 4.67c    Fix two spaces between dashes (em and en) in pppunc.py
 # 4.67d    Fix for space after dash, and before punctuation in pppunc.py
+# 4.68     Source is loaded once, and shared by every format generated
+# 4.68a    --jobs N generates the formats in parallel processes, with timings
+# 4.68b    Build steps, including ebook-convert & kindlegen, run as a task graph;
+#          independent steps run at once with --jobs; --resume after a failure
+# 4.68c    Build cache in .fpgen-cache; unchanged formats and conversions are
+#          copied from it rather than redone.  --no-cache to disable
+# 4.68d    --watch: rebuild on every change to the source or images, showing
+#          the time taken by each pass
+# 4.68e    --batch DIR...: build every book under the directories, with a
+#          JSON or CSV --summary
+# 4.68f    --trace file.json: Chrome trace of every pass and build step
+# 4.68g    --memprofile: peak and retained memory of every pass, by source line
+# 4.68h    benchmark.py: how each format and pass scales, on books from
+#          synthbook.py
+# 4.68i    Passes which insert and delete lines as they go are linear in
+#          the size of the book
+# 4.68j    Macros, templates, .title &c., <meta>, <property> and <option>
+#          are taken out of the source in a single pass
+# 4.68k    Standalone tag blocks are replaced in one pass over the buffer,
+#          and <summary>, <index> and <multicol> share it
+# 4.68l    <link>, <drop>, <ditto> and <target> are found in one scan of
+#          each line
+# 4.68m    Tag attributes and rend options are parsed once for each
+#          distinct string; --trace shows the cache hits and misses
+# 4.68n    Inline font markup is protected and restored with one regex, in one
+#          scan of each line
+# 4.68o    Special characters are protected, and internal characters
+#          replaced, in one scan of each line
+# 4.68p    Regular expressions of the passes are compiled once, in a registry;
+#          --regex-stats reports the calls of and time in each
+# 4.68q    The text inline, preProcess and rewrap passes, and html <l>
+#          lines, keep each chapter in the build cache, and only redo those
+#          which changed
+# 4.68r    The loaded source of each format is kept in the build cache, and
+#          not loaded again while the source is unchanged
+# 4.68s    The footnote emitters rebuild the buffer once, rather than
+#          deleting the lines of each note from it
+# 4.68t    The sidenotes waiting for their references are kept in the
+#          FootnoteIndex of the book, not in the footnote module
+# 4.68u    The options, debug level, cover image and suppressed warnings of
+#          a book are in its BuildContext, so books can be built in threads
+# 4.68v    CSS is ordered by the number of its priority; rules for classes the
+#          book does not use, and earlier copies of a rule, are left out;
+#          --css-minify
+# 4.68w    Inline styles used often enough in the html are replaced by a
+#          class, with an !important rule in the style block
+# 4.68x    The build cache is only used with --cache; its keys include fpgen's
+#          own code, and what a cached step printed is shown again
 
-VERSION="4.67d"
+VERSION="4.68x"
 
 NOW = strftime("%Y-%m-%d %H:%M:%S", gmtime()) + " GMT"
 
@@ -218,11 +269,9 @@ LINE_WIDTH = 72
 # TEXT: Lines passed through are wrapped at this number of columns.
 LINE_WRAP = 75
 
-debug = 0
 FORMATTED_PREFIX = "▹"
 NO_WRAP_PREFIX = "\u2135"
 HARD_SPACE = "□"
-pn_cover = ""
 
 # Used for <font:xx>...</font>
 # <font:xx> becomes FONT_BASE + font index
@@ -235,3 +284,46 @@ FONT_END = "\uEFFF"
 # try to use the characters in the text.
 OL_START = "\uEE00"
 OL_END   = "\uEE01"
+
+# The state of one build: the user's options and properties, the debug
+# level, the cover image for the conversion step, and the warnings the
+# book suppresses.  A Book makes a new one when it is created, and it is
+# the current context of whichever thread runs one of the book's passes,
+# in Book.step.  config.uopt, config.debug and config.pn_cover are those
+# of the current context; the passes in fpgen, para, drama, footnote and
+# template still read them there, rather than being given the context.
+# So two books run in different threads do not see each other's options,
+# and what one captures with msgs.capture is only its own output; but
+# what they print is interleaved, and passes.listeners hear from both.
+class BuildContext(object):
+  def __init__(self, debug = 0):
+    self.uopt = userOptions()
+    self.debug = debug # numeric, 0=no debug, 1=function level, 2=line level
+    self.pnCover = ""
+    self.warnings = {} # tag: False, for each suppressed warning
+
+local = threading.local()
+
+# The current context of this thread; a fresh one if it has none
+def context():
+  c = getattr(local, "context", None)
+  if c is None:
+    c = local.context = BuildContext()
+  return c
+
+# Make c the current context of this thread; returns the one it replaces
+def setContext(c):
+  previous = getattr(local, "context", None)
+  local.context = c
+  return previous
+
+def contextAttribute(name):
+  return property(lambda module: getattr(context(), name),
+    lambda module, value: setattr(context(), name, value))
+
+class ConfigModule(types.ModuleType):
+  uopt = contextAttribute("uopt")
+  debug = contextAttribute("debug")
+  pn_cover = contextAttribute("pnCover")
+
+sys.modules[__name__].__class__ = ConfigModule
@@ -16,12 +16,17 @@ footnoteMarkersText = [
   "star", "dagger", "doubledagger", "section", "parallelto", "pilcrow",
 ]
 
-noteMap = {}
-
 table = 1
 paragraph = 2
 sidenote = 3
 
+# The footnote state of one Book, which is passed from pass to pass;
+# nothing is kept in the module, so books and formats can be built one
+# after another, or at once, in the one process.
+class FootnoteIndex(object):
+  def __init__(self):
+    self.noteMap = {} # target: sidenote, to be emitted at its reference
+
 def getFootnoteStyle():
   options = {
     'table':table,
@@ -46,13 +51,13 @@ def getFootnoteStyle():
 # The tags are parsed again below in footnotesToHtml (both fn and footnote),
 # (and once again in mediaTweak, or at least the generated html is!)
 # and Text.preProcess(fn), and Text.rewrap(footnote)
+# Sidenotes are kept in index, the book's FootnoteIndex, until FNtoHtml
+# emits them at their reference.
 #
 # Note that the footnotes have already been normalized to the format
 #    <footnote>\ntext\n</footnote>
 # in loadFile
-#
-# This method is unittested in testfootnote.py
-def relocateFootnotes(block):
+def relocateFootnotes(block, index):
   #self.dprint(1, "relocate footnotes")
 
   none = 1
@@ -113,14 +118,14 @@ def relocateFootnotes(block):
     opts = "id='" + displayid + "' target='" + target + "'"
 
     # Handle fn tags inside footnotes!
-    relocateFootnotes(block)
+    relocateFootnotes(block, index)
 
     # Recreate the block
     block.insert(0, "<footnote " + opts + ">")
     block.append("</footnote>")
 
     if emitAtReference:
-      noteMap[target] = block
+      index.noteMap[target] = block
       return []
 
     # If we aren't supposed to move footnotes, do nothing
@@ -281,15 +286,18 @@ def reformat(block):
 # Allow for textual processing of sidenote footnotes which are no longer
 # in the normal flow. This makes sure that font changes, and special
 # character processing are handled.
-def outOfBandFootnoteProcessing(fn):
-  for k,v in noteMap.items():
-    noteMap[k] = fn(v)
+def outOfBandFootnoteProcessing(fn, index):
+  for k,v in index.noteMap.items():
+    index.noteMap[k] = fn(v)
+
+matchFN = re.compile(r"<fn\s+(.*?)/?>")
+matchFootnote = re.compile(r"<footnote\s+(.*?)>")
+matchFootnoteId = re.compile(r"<div class='footnote-id' id='f(.+?)'><a href='#r.+?'>\[?.*?\]?<\/a>")
 
 # Convert the footnote references <fn=...> into html.
 # Emit footnotes which are relocated to their references when we find those
 # tags.
-def FNtoHtml(wb):
-  matchFN = re.compile("<fn\s+(.*?)/?>")
+def FNtoHtml(wb, index):
   footnotes = {}
 
   # footnote marks in text
@@ -298,7 +306,7 @@ def FNtoHtml(wb):
     off = 0
     line = wb[i]
     block = [ ]
-    while True:
+    while "<fn" in line:
       m = matchFN.search(line, off)
       if not m:
         break
@@ -311,10 +319,10 @@ def FNtoHtml(wb):
       dprint(1, "id: " + fmid + ", target: " + target)
       repl = "<sup><span style='font-size:0.9em'>" + fmid + "</span></sup>"
 
-      if target in noteMap:
+      if target in index.noteMap:
         # Note no link when we are co-locating the reference with the footnote
-        block.extend(noteMap[target])
-        del noteMap[target]
+        block.extend(index.noteMap[target])
+        del index.noteMap[target]
       elif fmid in footnotes and footnotes[fmid] == target:
         wprint('multifootnote', "warning: footnote id <fn id='" + fmid + "'> occurs multiple times.  <footnote> link will be to the first. Line: >>>" + line + "<<<")
         repl = "<a href='#f{0}' style='text-decoration:none'>{1}</a>".format(target, repl)
@@ -340,44 +348,44 @@ def FNtoHtml(wb):
       i += len(block)
     i += 1
 
-def footnotesToTags(wb):
+def footnotesToTags(wb, index):
   if getFootnoteStyle() == sidenote:
-    footnotesToSidenoteTags(wb)
+    footnotesToSidenoteTags(wb, index)
   else:
-    footnotesToHtmlTags(wb)
+    footnotesToHtmlTags(wb, index)
 
-def footnotesToHtmlTags(wb):
-  FNtoHtml(wb)
+def footnotesToHtmlTags(wb, index):
+  FNtoHtml(wb, index)
 
   # footnote targets and text
   i = 0
   while i < len(wb):
-    m = re.match("<footnote\s+(.*?)>", wb[i])
+    m = wb[i].startswith("<footnote") and matchFootnote.match(wb[i])
     if m:
       opts = m.group(1)
       args = parseTagAttributes("footnote", opts, [ "id", "target" ])
       fnid = args["id"]
       target = args["target"]
       wb[i] = "<div class='footnote-id' id='f{0}'><a href='#r{0}'>{1}</a></div>".format(target, fnid)
-      while not re.match("<\/footnote>", wb[i]):
+      while not wb[i].startswith("</footnote>"):
         i += 1
       wb[i] = "</div> <!-- footnote end -->"
     i += 1
 
-def footnotesToSidenoteTags(wb):
-  FNtoHtml(wb)
+def footnotesToSidenoteTags(wb, index):
+  FNtoHtml(wb, index)
 
   # footnote targets and text
   i = 0
   while i < len(wb):
-    m = re.match("<footnote\s+(.*?)>", wb[i])
+    m = wb[i].startswith("<footnote") and matchFootnote.match(wb[i])
     if m:
       opts = m.group(1)
       args = parseTagAttributes("footnote", opts, [ "id", "target" ])
       fnid = args["id"]
       target = args["target"]
       wb[i] = "<sidenote>" + fnid
-      while not re.match("<\/footnote>", wb[i]):
+      while not wb[i].startswith("</footnote>"):
         i += 1
       wb[i] = "</sidenote>"
     i += 1
@@ -392,42 +400,76 @@ def emitFootnotes(wb, css):
   elif mode == sidenote:
     footnotesToSidenote(wb, css)
 
-# anything particular for derived-class media (epub, mobi, PDF)
-# can use this as an overridden method
-def footnotesToTable(wb, css):
-  # for HTML, gather footnotes into a table structure
+# The target of the note which starts on this line, the
+# <div class='footnote-id'> footnotesToHtmlTags made of its <footnote>;
+# or None
+def noteTarget(line):
+  if not line.startswith("<div class='footnote-id'"):
+    return None
+  m = matchFootnoteId.match(line)
+  return m.group(1) if m else None
+
+# Each note in wb, from its <div class='footnote-id'> to its closing div,
+# replaced by function(lines of the note), which includes the footnote-id
+# line; the replacement also takes the place of the line after the note,
+# the blank line relocateFootnotes put there.  The buffer is rebuilt once,
+# rather than deleting the lines of each note from it.  Returns True if
+# there were any notes.
+def replaceNotes(wb, function):
+  result = []
   matched = False
   i = 0
-  while i < len(wb):
-    m = re.match("<div class='footnote-id' id='f(.+?)'><a href='#r.+?'>\[?.*?\]?<\/a>", wb[i])
-    if m:
-      matched = True
-      t = []
-      t.append("<div class='footnote'>")
-      t.append("<table summary='footnote_{}'>".format(m.group(1)))
-
-      t.append("<colgroup>")
-      t.append("<col span='1' class='footnoteid'/>")
-      t.append("<col span='1'/>")
-      t.append("</colgroup>")
-
-      t.append("<tr><td style='vertical-align:top;'>")
-      t.append(wb[i])
-      del(wb[i])
-      t.append("</td><td>")
-      while not re.search("<!-- footnote end -->", wb[i]):
-        t.append(wb[i])
-        del(wb[i])
-      del(wb[i]) # closing div
-      t.append("</td></tr>")
-      t.append("</table>")
-      t.append("</div>")
-      t.append("")
-      wb[i:i+1] = t
-      i += len(t)-1
+  n = len(wb)
+  while i < n:
+    line = wb[i]
     i += 1
+    target = noteTarget(line)
+    if target == None:
+      result.append(line)
+      continue
+    matched = True
+    note = [ line ]
+    while not "<!-- footnote end -->" in wb[i]:
+      note.append(wb[i])
+      i += 1
+    i += 2 # closing div, and the line after it
+    result.extend(function(target, note))
+  wb[:] = result
+  return matched
+
+# Remove the paragraph tag which starts the first paragraph of the note
+def removeFirstParagraph(lines):
+  for i, line in enumerate(lines):
+    m = re.match("<p.*?>", line)
+    if m:
+      lines[i] = line[m.end():]
+      break
 
-  if matched:
+# anything particular for derived-class media (epub, mobi, PDF)
+# can use this as an overridden method
+def footnotesToTable(wb, css):
+  # for HTML, gather footnotes into a table structure
+  def toTable(target, note):
+    t = []
+    t.append("<div class='footnote'>")
+    t.append("<table summary='footnote_{}'>".format(target))
+
+    t.append("<colgroup>")
+    t.append("<col span='1' class='footnoteid'/>")
+    t.append("<col span='1'/>")
+    t.append("</colgroup>")
+
+    t.append("<tr><td style='vertical-align:top;'>")
+    t.append(note[0])
+    t.append("</td><td>")
+    t.extend(note[1:])
+    t.append("</td></tr>")
+    t.append("</table>")
+    t.append("</div>")
+    t.append("")
+    return t
+
+  if replaceNotes(wb, toTable):
     if config.uopt.getopt("pstyle") == "indent":
       # Single paragraph footnotes look strange with a paragraph indent
       # on the first paragraph. Subsequent paragraphs look ok indented
@@ -437,38 +479,19 @@ def footnotesToTable(wb, css):
 
 def footnotesToParagraph(wb, css):
   # for HTML, gather footnotes into paragraphs
-  matched = False
-  i = 0
-  while i < len(wb):
-    m = re.match("<div class='footnote-id' id='f(.+?)'><a href='#r.+?'>\[?.*?\]?<\/a>", wb[i])
-    if m:
-      matched = True
-      t = []
-      t.append("<div class='footnote'>")
-      t.append("<p class='footnote'>")
-      wb[i] = re.sub("div", "span", wb[i])
-      t.append(wb[i]) # <div id='f1_2'><a href='#r1_2'>[1]</a></div>
-      del(wb[i])
-
-      first = True
-      while not re.search("<!-- footnote end -->", wb[i]):
-
-        if first:
-          # Remove first paragraph tag
-          m = re.match("<p.*?>", wb[i])
-          if m:
-            wb[i] = wb[i][m.end():]
-            first = False
-        t.append(wb[i])
-        del(wb[i])
-      del(wb[i]) # closing div
-      t.append("</div>")
-      t.append("")
-      wb[i:i+1] = t
-      i += len(t)-1
-    i += 1
-
-  if matched:
+  def toParagraph(target, note):
+    t = []
+    t.append("<div class='footnote'>")
+    t.append("<p class='footnote'>")
+    t.append(re.sub("div", "span", note[0])) # <div id='f1_2'><a href='#r1_2'>[1]</a></div>
+    body = note[1:]
+    removeFirstParagraph(body)
+    t.extend(body)
+    t.append("</div>")
+    t.append("")
+    return t
+
+  if replaceNotes(wb, toParagraph):
     css.addcss("[411] div.footnote { margin:0 .5em; }")
     css.addcss("[411] p.footnote { text-indent:1.5em; }")
     css.addcss(""" [411] .footnote-id {
@@ -479,34 +502,11 @@ def footnotesToParagraph(wb, css):
 
 def footnotesToSidenote(wb, css):
   # for HTML, gather footnotes into paragraphs
-  matched = False
-  i = 0
-  while i < len(wb):
-    m = re.match("<div class='footnote-id' id='f(.+?)'><a href='#r.+?'>\[?.*?\]?<\/a>", wb[i])
-    if m:
-      matched = True
-      t = []
-      t.append("<sidenote>")
-
-      first = True
-      while not re.search("<!-- footnote end -->", wb[i]):
-
-        if first:
-          # Remove first paragraph tag
-          m = re.match("<p.*?>", wb[i])
-          if m:
-            wb[i] = wb[i][m.end():]
-            first = False
-        t.append(wb[i])
-        del(wb[i])
-      del(wb[i]) # closing div
-      t.append("</sidenote>")
-      t.append("")
-      wb[i:i+1] = t
-      i += len(t)-1
-    i += 1
+  def toSidenote(target, note):
+    removeFirstParagraph(note)
+    return [ "<sidenote>" ] + note + [ "</sidenote>", "" ]
 
-  if matched:
+  if replaceNotes(wb, toSidenote):
     css.addcss("[411] div.footnote { margin:0 .5em; }")
     css.addcss("[411] p.footnote { text-indent:1.5em; }")
     css.addcss(""" [411] .footnote-id {
@@ -566,7 +566,7 @@ class TestFootnote(unittest.TestCase):
       "<heading level='1'>h1</heading>",
       "text",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_none_auto2(self):
@@ -594,7 +594,7 @@ class TestFootnote(unittest.TestCase):
       "fn",
       "</footnote>",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_none_auto_same_line(self):
@@ -604,7 +604,7 @@ class TestFootnote(unittest.TestCase):
     result = [
       "blah<fn id='[1]' target='1'>, more words, <fn id='[2]' target='2'>, another <fn id='[3]' target='3'>",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_reset_auto_same_line(self):
@@ -615,7 +615,7 @@ class TestFootnote(unittest.TestCase):
     result = [
       "blah<fn id='[1]' target='1_1'>, more words, <fn id='[2]' target='2_1'>, another <fn id='[3]' target='3_1'>",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_reset_auto_same_line_and_reset(self):
@@ -637,7 +637,7 @@ class TestFootnote(unittest.TestCase):
       "",
       "blah<fn id='[1]' target='1_2'>, more words, <fn id='[2]' target='2_2'>, another <fn id='[3]' target='3_2'>",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_none_unchanged(self):
@@ -655,7 +655,7 @@ class TestFootnote(unittest.TestCase):
       "<heading level='1'>h1</heading>",
       "text",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_none_fn_inside_footnote(self):
@@ -692,7 +692,7 @@ class TestFootnote(unittest.TestCase):
       "<heading level='1'>h1</heading>",
       "text",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_heading(self):
@@ -713,7 +713,7 @@ class TestFootnote(unittest.TestCase):
       "text",
     ]
     config.uopt.addopt("footnote-location", "heading")
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   # Emit early if marker hit
@@ -739,7 +739,7 @@ class TestFootnote(unittest.TestCase):
       "more text",
     ]
     config.uopt.addopt("footnote-location", "heading")
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_heading_auto2(self):
@@ -772,7 +772,7 @@ class TestFootnote(unittest.TestCase):
       "</footnote>",
       "",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_heading_reset_auto2(self):
@@ -805,7 +805,7 @@ class TestFootnote(unittest.TestCase):
       "</footnote>",
       "",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_heading_reset_asterisk2(self):
@@ -845,7 +845,7 @@ class TestFootnote(unittest.TestCase):
       "</footnote>",
       "",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_asterisk_cross_gen(self):
@@ -879,7 +879,7 @@ class TestFootnote(unittest.TestCase):
       "</footnote>",
       "",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnoteToHtml_asterisk_cross_gen(self):
@@ -914,7 +914,7 @@ class TestFootnote(unittest.TestCase):
       '</div> <!-- footnote end -->',
       '',
     ]
-    footnotesToHtmlTags(input)
+    footnotesToHtmlTags(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_heading_reset_manual2(self):
@@ -964,7 +964,7 @@ class TestFootnote(unittest.TestCase):
       "</footnote>",
       "",
     ]
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
 
@@ -987,7 +987,7 @@ class TestFootnote(unittest.TestCase):
       "",
     ]
     config.uopt.addopt("footnote-location", "heading")
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   # Emit at marker, not heading
@@ -1014,7 +1014,7 @@ class TestFootnote(unittest.TestCase):
       "more text",
     ]
     config.uopt.addopt("footnote-location", "marker")
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_asterisk(self):
@@ -1038,7 +1038,7 @@ class TestFootnote(unittest.TestCase):
       "",
     ]
 
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   # two starred footnotes separated by footnote dump
@@ -1079,7 +1079,7 @@ class TestFootnote(unittest.TestCase):
       '',
     ]
 
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_section(self):
@@ -1103,7 +1103,7 @@ class TestFootnote(unittest.TestCase):
       '',
     ]
 
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_section_two_forward(self):
@@ -1131,7 +1131,7 @@ class TestFootnote(unittest.TestCase):
       "",
     ]
 
-    relocateFootnotes(input)
+    relocateFootnotes(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_section_two_forward_Html(self):
@@ -1162,26 +1162,26 @@ class TestFootnote(unittest.TestCase):
     ]
 
     # TODO: Warning that id is twice, <footnote> link to the first
-    footnotesToHtmlTags(input)
+    footnotesToHtmlTags(input, FootnoteIndex())
     self.assertSequenceEqual(input, result)
 
   def test_footnote_no_id(self):
     input = [ "<footnote xid='x'>", "</footnote>" ]
     with self.assertRaises(SystemExit) as cm:
-      relocateFootnotes(input)
+      relocateFootnotes(input, FootnoteIndex())
     self.assertEqual(cm.exception.code, 1)
 
   def test_footnote_no_id_fn(self):
     input = [ "text<fn iid='1'>" ]
     with self.assertRaises(SystemExit) as cm:
-      relocateFootnotes(input)
+      relocateFootnotes(input, FootnoteIndex())
     self.assertEqual(cm.exception.code, 1)
 
   def test_footnote_bad_option(self):
     input = [ "text<fn id='1'>" ]
     config.uopt.addopt("footnote-location", "headings")
     with self.assertRaises(SystemExit) as cm:
-      relocateFootnotes(input)
+      relocateFootnotes(input, FootnoteIndex())
     self.assertEqual(cm.exception.code, 1)
 
   def test_footnote_style(self):
@@ -1191,3 +1191,44 @@ class TestFootnote(unittest.TestCase):
     self.assertEqual(getFootnoteStyle(), sidenote)
     config.uopt.setGenType('t')
     self.assertEqual(getFootnoteStyle(), table)
+
+  # The notes, made into html, are found in order
+  def test_footnote_replace_notes(self):
+    config.uopt.addopt("footnote-location", "heading-reset")
+    input = [
+      "l1",
+      "w1<fn id='#'> w2<fn id='*'>",
+      "<footnote id='#'>",
+      "foot<fn id='x'>",
+      "</footnote>",
+      "<footnote id='*'>",
+      "star",
+      "</footnote>",
+      "<heading level='1'>h1</heading>",
+      "w3<fn id='#'>",
+      "<footnote id='#'>",
+      "foot2",
+      "</footnote>",
+    ]
+    index = FootnoteIndex()
+    relocateFootnotes(input, index)
+    footnotesToHtmlTags(input, index)
+    notes = []
+    replaceNotes(input, lambda target, note: notes.append(target) or [])
+    self.assertEqual(notes, [ "1_1", "star_1", "1_2" ])
+    self.assertNotIn("<!-- footnote end -->", "".join(input))
+
+  # Two books with sidenotes, relocated one after the other and then
+  # converted, each get their own notes
+  def test_footnote_two_books(self):
+    config.uopt.addopt("footnote-style", "sidenote")
+    books = [ [ "w1<fn id='1'>", "<footnote id='1'>", note, "</footnote>" ]
+      for note in [ "first", "second" ] ]
+    indexes = [ FootnoteIndex() for book in books ]
+    for book, index in zip(books, indexes):
+      relocateFootnotes(book, index)
+    for book, index in zip(books, indexes):
+      footnotesToTags(book, index)
+    self.assertEqual([ book[0:2] for book in books ],
+      [ [ "<sidenote>[1]", "first" ], [ "<sidenote>[1]", "second" ] ])
+    self.assertEqual(indexes[0].noteMap, {})
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import time
+import tempfile
+import unittest
+import multiprocessing
+import concurrent.futures
+
+import msgs
+import config
+import passes
+import units
+
+# Generation of the output file for one format, either in this process,
+# or with --jobs, in a pool of worker processes.
+#
+# Each format is an independent Book, with its own BuildContext (config.py)
+# of options, cover image and warnings; only what the conversion step in
+# main needs is kept, as a FormatResult, since with --jobs the Book itself
+# stays in the worker.
+
+# format letter: (output file pattern, message)
+FORMATS = {
+  't' : ("{}.txt", "creating UTF-8 text"),
+  'h' : ("{}.html", "creating HTML"),
+  'e' : ("{}-e.html", "creating Epub"),
+  'k' : ("{}-e2.html", "creating Kindle (.mobi & -k.epub)"),
+  'p' : ("{}-p.html", "creating PDF"),
+}
+
+# The order formats have always been generated in
+ORDER = "thekp"
+
+def makeBook(fmt, infile, outfile, debug):
+  from fpgen import Text, HTML
+  from kindle import Kindle, EPub, PDF
+  if fmt == 't':
+    return Text(infile, outfile, debug, 't')
+  if fmt == 'h':
+    return HTML(infile, outfile, debug, 'h')
+  return { 'e' : EPub, 'k' : Kindle, 'p' : PDF }[fmt](infile, outfile, debug)
+
+# What is left of a format after its Book is generated
+class FormatResult(object):
+  def __init__(self, fmt, outfile, elapsed, book):
+    self.fmt = fmt
+    self.outfile = outfile
+    self.elapsed = elapsed
+    self.uopt = book.context.uopt
+    self.pnCover = book.context.pnCover
+    self.fonts = book.getFonts()
+    self.events = [] # --trace events, from a worker
+    self.output = "" # what was printed, from a worker
+
+  def getFonts(self):
+    return self.fonts
+
+# trace is only used in a worker, to send back the events of the passes;
+# with unitCache, passes keep their chapters in the build cache (units.py);
+# cssMinify is --css-minify, for the html formats
+def generateFormat(fmt, infile, bn, debug, frontEnd, trace = False,
+    unitCache = False, cssMinify = False):
+  pattern, message = FORMATS[fmt]
+  outfile = pattern.format(bn)
+  book = makeBook(fmt, infile, outfile, debug)
+  if unitCache:
+    book.unitCache = units.UnitCache()
+  if cssMinify:
+    book.cssMinify = True
+  print(message)
+  if trace:
+    from tracing import TraceRecorder
+    recorder = passes.addListener(TraceRecorder())
+  start = time.time()
+  try:
+    book.run(frontEnd)
+  finally:
+    if trace:
+      passes.removeListener(recorder)
+  result = FormatResult(fmt, outfile, time.time() - start, book)
+  if trace:
+    result.events = recorder.events
+  return result
+
+# In a worker: generateFormat, with what it prints sent back in the result,
+# for main to print, so that it goes into the build cache with the rest of
+# the task's output.  What was printed before a failure is shown here.
+def generateInWorker(*args):
+  out = io.StringIO()
+  try:
+    with msgs.capture(out):
+      result = generateFormat(*args)
+  except BaseException:
+    sys.stdout.write(out.getvalue())
+    raise
+  result.output = out.getvalue()
+  return result
+
+# With --jobs, each format is generated in one of a pool of processes.
+# They are started fresh rather than forked, since the scheduler submits
+# to the pool from its threads.
+def makePool(jobs):
+  return concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+    mp_context=multiprocessing.get_context("spawn"))
+
+class TestFormats(unittest.TestCase):
+  source = [
+    "<property name='cover image' content='images/c.jpg'>",
+    "<option name='toc-levels' content='1'>",
+    "<heading level='1'>Chapter</heading>",
+    "Some text<fn id='1'>.",
+    "<footnote id='1'>A note</footnote>",
+  ]
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.dir = tempfile.TemporaryDirectory()
+    os.chdir(self.dir.name)
+    with open("book-src.txt", "w", encoding='utf-8') as f:
+      f.write("\n".join(self.source) + "\n")
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    self.dir.cleanup()
+    config.setContext(config.BuildContext())
+
+  def generate(self, jobs, makePool = makePool):
+    from frontend import FrontEnd
+    frontEnd = FrontEnd("book-src.txt")
+    results = {}
+    with makePool(jobs) as pool:
+      futures = [ pool.submit(generateFormat, fmt, "book-src.txt", "book",
+        0, frontEnd) for fmt in ORDER ]
+      for fmt, future in zip(ORDER, futures):
+        results[fmt] = future.result()
+    outputs = {}
+    for fmt, result in results.items():
+      with open(result.outfile, "r", encoding='utf-8') as f:
+        outputs[fmt] = [ l for l in f.readlines() if "GMT" not in l ]
+    return results, outputs
+
+  # With one worker, every format is generated in the same process, one
+  # after the other, so this also checks the state is reset between them
+  def test_formats_parallel_same(self):
+    seqResults, seqOutputs = self.generate(1)
+    parResults, parOutputs = self.generate(3)
+    self.assertEqual(parOutputs, seqOutputs)
+
+  # Every format at once, in threads of this process; each Book has its
+  # own BuildContext, so none sees the options or cover of another
+  def test_formats_threads_same(self):
+    threads = lambda jobs: concurrent.futures.ThreadPoolExecutor(
+      max_workers=jobs)
+    seqResults, seqOutputs = self.generate(1, threads)
+    thrResults, thrOutputs = self.generate(len(ORDER), threads)
+    self.assertEqual(thrOutputs, seqOutputs)
+    self.assertEqual(thrResults['k'].pnCover, "images/c.jpg")
+    self.assertEqual(thrResults['t'].uopt.getGenType(), 't')
+    self.assertEqual(thrResults['h'].uopt.getGenType(), 'h')
+
+  # As main.build does with the Lints: made here, run in another thread
+  def test_formats_other_thread(self):
+    import contextlib
+    from fpgen import Lint
+    lint = Lint("book-src.txt", "", 0, 'h')
+    def genType():
+      return config.uopt.getGenType()
+    with contextlib.redirect_stdout(io.StringIO()):
+      with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        pool.submit(lint.run).result()
+        self.assertEqual(pool.submit(lint.step, genType).result(), 'h')
+    self.assertIsNot(config.uopt, lint.context.uopt)
+
+  # What a worker prints comes back with its result
+  def test_formats_worker_output(self):
+    from frontend import FrontEnd
+    with makePool(2) as pool:
+      result = pool.submit(generateInWorker, 'h', "book-src.txt", "book", 0,
+        FrontEnd("book-src.txt")).result()
+    self.assertIn("creating HTML", result.output)
+
+  def test_formats_result_state(self):
+    results, outputs = self.generate(2)
+    self.assertEqual(results['e'].pnCover, "images/c.jpg")
+    self.assertEqual(results['e'].uopt.getopt('toc-levels'), '1')
@@ -12,11 +12,15 @@ from userOptions import userOptions
 import config
 import footnote
 import font
+import passes
+import patterns
+import units
+import stylesheet
+from linebuffer import LineBuffer
 
 from parse import parseTagAttributes, parseOption, parseLineEntry, \
-  parseStandaloneTagBlock, \
-  parseEmbeddedSingleLineTagWithContent, \
-  parseEmbeddedTagWithoutContent, \
+  parseStandaloneTagBlock, parseStandaloneTagBlocks, \
+  parseEmbeddedTags, \
   parseStandaloneSingleLineTagWithContent, \
   parseEmbeddedTagBlock
 from msgs import cprint, uprint, dprint, fatal, wprint, setWarnings
@@ -60,7 +64,8 @@ summaryBlock = 2
 summaryIndent = 3
 summaryCenter = 4
 
-empty = re.compile("^$")
+empty = patterns.compile("empty", "^$")
+blank = patterns.compile("blank", r"^\s*$")
 
 class TextWrapperDash(textwrap.TextWrapper):
   dashre = re.compile(r'(\s+|◠◠|—)')
@@ -226,12 +231,12 @@ def parseCaptions(block):
   return captions
 
 class Book(object): #{
-  wb = []
 
   def __init__(self, ifile, ofile, d, fmt):
-    config.uopt = userOptions()
-    config.debug = d # numeric, 0=no debug, 1=function level, 2=line level
+    # The options &c. of this book; see config.BuildContext
+    self.context = config.BuildContext(d)
     self.debug = d # numeric, 0=no debug, 1=function level, 2=line level
+    self.wb = []
     self.srcfile = ifile
     self.dstfile = ofile
     self.gentype = fmt
@@ -242,7 +247,11 @@ class Book(object): #{
     self.umeta = self.userMeta()
     self.templates = template.createTemplates(fmt)
     self.supphd = [] # user's supplemental header lines
-    config.uopt.setGenType(fmt)
+    self.userTemplates = [] # user's <template> definitions
+    self.directives = [] # user's .title, <meta>, <property> & <option> lines
+    self.unitCache = None # chapters of passes, see units.py
+    self.footnoteIndex = footnote.FootnoteIndex()
+    self.context.uopt.setGenType(fmt)
 
   def poetryIndent(self):
     return config.uopt.getOptEnum("poetry-style", {
@@ -344,6 +353,24 @@ class Book(object): #{
   def addcss(self, css):
     pass
 
+  # The .title &c. shortcuts, <property>, <option> and <meta> lines are
+  # taken out of the buffer by extractDirectives, into self.directives;
+  # shortHeading, addOptionsAndProperties and addMeta interpret them.
+  regexShortcut = patterns.compile("directive.shortcut", r"\.(title|author|language|created|date|cover|displaytitle|generator|tags) (.*)")
+  regexProperty = patterns.compile("directive.property", r"<property name=[\"'](.*?)[\"'] content=[\"'](.*?)[\"']\s*\/?>")
+  regexOption = patterns.compile("directive.option", r"<option name=[\"'](.*?)[\"'] content=[\"'](.*?)[\"']\s*\/?>")
+
+  def isDirective(self, line):
+    if line.startswith("."):
+      return self.regexShortcut.match(line) != None
+    if line.startswith("<meta"):
+      return True
+    if line.startswith("<property"):
+      return self.regexProperty.match(line) != None
+    if line.startswith("<option"):
+      return self.regexOption.match(line) != None
+    return False
+
   def shortHeading(self):
     self.dprint(1, "shortHeadings")
     # allow shortcut heading
@@ -355,80 +382,40 @@ class Book(object): #{
     # .cover (default "images/cover.jpg")
     # .display title (default "{.title}, by {.author}")
     #
-    h = []
     dc_title = "Unknown"
     dc_author = "Unknown"
     dc_language = "en"
     dc_created = ""
     dc_subject = None
-    config.pn_cover = "images/cover.jpg"
+    self.context.pnCover = "images/cover.jpg"
     pn_displaytitle = ""
     m_generator = None
-    i = 0
-    where = 0
     shortused = False
-    while i < len(self.wb):
-
-      m = re.match(r"\.title (.*)", self.wb[i])
-      if m:
-        dc_title = m.group(1)
-        where = i
-        del(self.wb[i])
-        shortused = True
-
-      m = re.match(r"\.author (.*)", self.wb[i])
-      if m:
-        dc_author = m.group(1)
-        where = i
-        del(self.wb[i])
+    for line in self.directives:
+      m = self.regexShortcut.match(line)
+      if not m:
+        continue
+      name, value = m.group(1), m.group(2)
+      if name == "title":
+        dc_title = value
         shortused = True
-
-      m = re.match(r"\.language (.*)", self.wb[i])
-      if m:
-        dc_language = m.group(1)
-        where = i
-        del(self.wb[i])
+      elif name == "author":
+        dc_author = value
         shortused = True
-
-      m = re.match(r"\.created (.*)", self.wb[i])
-      if m:
-        dc_created = m.group(1)
-        where = i
-        del(self.wb[i])
+      elif name == "language":
+        dc_language = value
         shortused = True
-
-      m = re.match(r"\.date (.*)", self.wb[i])
-      if m:
-        dc_created = m.group(1)
-        where = i
-        del(self.wb[i])
+      elif name == "created" or name == "date":
+        dc_created = value
         shortused = True
-
-      m = re.match(r"\.cover (.*)", self.wb[i])
-      if m:
-        config.pn_cover = m.group(1)
-        where = i
-        del(self.wb[i])
-
-      m = re.match(r"\.displaytitle (.*)", self.wb[i])
-      if m:
-        pn_displaytitle = m.group(1)
-        where = i
-        del(self.wb[i])
-
-      m = re.match(r"\.generator (.*)", self.wb[i])
-      if m:
-        m_generator = m.group(1)
-        where = i
-        del(self.wb[i])
-
-      m = re.match(r"\.tags (.*)", self.wb[i])
-      if m:
-        dc_subject = m.group(1)
-        where = i
-        del(self.wb[i])
-
-      i += 1
+      elif name == "cover":
+        self.context.pnCover = value
+      elif name == "displaytitle":
+        pn_displaytitle = value
+      elif name == "generator":
+        m_generator = value
+      elif name == "tags":
+        dc_subject = value
 
     if shortused:
       self.umeta.add("DC.Title", dc_title)
@@ -445,44 +432,33 @@ class Book(object): #{
     if m_generator != None:
       self.umeta.addmeta("generator", m_generator)
 
-    self.uprop.addprop("cover image", "{}".format(config.pn_cover))
+    self.uprop.addprop("cover image", "{}".format(self.context.pnCover))
     self.uprop.addprop("display title", "{}".format(pn_displaytitle))
 
   def addMeta(self):
     self.dprint(1,"userHeader")
-    i = 0
-    while i < len(self.wb):
-      m = re.match("<meta", self.wb[i])
-      if m:
-        if not re.search(r"\/>$", self.wb[i]):
-          self.wb[i] = re.sub(">$", "/>", self.wb[i])
-        self.umeta.addmeta(self.wb[i])
-        del self.wb[i]
-        continue
-
-      i += 1
+    for line in self.directives:
+      if line.startswith("<meta"):
+        if not re.search(r"\/>$", line):
+          line = re.sub(">$", "/>", line)
+        self.umeta.addmeta(line)
 
   def addOptionsAndProperties(self):
     self.dprint(1,"addOptionsAndProperties")
-    i = 0
-    while i < len(self.wb):
-      m = re.match(r"<property name=[\"'](.*?)[\"'] content=[\"'](.*?)[\"']\s*\/?>", self.wb[i])
+    for line in self.directives:
+      m = self.regexProperty.match(line)
       if m:
         self.uprop.addprop(m.group(1), m.group(2))
-        # 22-Feb-2014 if it's a specified cover, need to put it in global variable
-        # so epub &c. can use it after instance is complete
+        # 22-Feb-2014 if it's a specified cover, need to put it in the build
+        # context so epub &c. can use it after instance is complete
         if m.group(1) == "cover image":
-          config.pn_cover = m.group(2)
-          # print("cover image: {}".format(config.pn_cover))
-        del self.wb[i]
+          self.context.pnCover = m.group(2)
+          # print("cover image: {}".format(self.context.pnCover))
         continue
 
-      m = re.match(r"<option name=[\"'](.*?)[\"'] content=[\"'](.*?)[\"']\s*\/?>", self.wb[i])
+      m = self.regexOption.match(line)
       if m:
         config.uopt.addopt(m.group(1), m.group(2))
-        del self.wb[i]
-        continue
-      i += 1
 
     setWarnings(config.uopt.getopt("warning-suppress"))
 
@@ -509,25 +485,25 @@ class Book(object): #{
 
   summaryStyle = summaryHang
 
-  def doSummary(self):
-    self.dprint(1,"doSummary")
-    options = {
-      'hang':summaryHang,
-      'block':summaryBlock,
-      'indent':summaryIndent,
-      'center':summaryCenter,
+  # <summary>, <index> and <multicol> blocks, whichever of them are given,
+  # in a single pass over the buffer
+  def doBlocks(self, *tags):
+    self.dprint(1,"doBlocks " + ", ".join(tags))
+    if "summary" in tags:
+      options = {
+        'hang':summaryHang,
+        'block':summaryBlock,
+        'indent':summaryIndent,
+        'center':summaryCenter,
+      }
+      self.summaryStyle = config.uopt.getOptEnum("summary-style", options, summaryHang);
+
+    functions = {
+      "summary" : self.oneSummary,
+      "index" : self.oneIndex,
+      "multicol" : self.oneMulticol,
     }
-    self.summaryStyle = config.uopt.getOptEnum("summary-style", options, summaryHang);
-
-    parseStandaloneTagBlock(self.wb, "summary", self.oneSummary)
-
-  def doIndex(self):
-    self.dprint(1,"doIndex")
-    parseStandaloneTagBlock(self.wb, "index", self.oneIndex)
-
-  def doMulticol(self):
-    self.dprint(1,"doMulticol")
-    parseStandaloneTagBlock(self.wb, "multicol", self.oneMulticol)
+    parseStandaloneTagBlocks(self.wb, [ (tag, functions[tag]) for tag in tags ])
 
   # validate file as UTF-8
   def checkFile(self, fn):
@@ -553,115 +529,188 @@ class Book(object): #{
 
   def blankLines(self, tag, before, after):
     self.dprint(1, tag + "+spacing")
-    i = 0
-    while i < len(self.wb):
-      if self.wb[i].startswith(tag):
-        if before:
-          if i == 0 or not empty.match(self.wb[i-1]):
-            t = self.wb[i]
-            self.wb[i:i+1] = ["", t]
-            i += 1
-        if after:
-          if i+1 == len(self.wb) or not empty.match(self.wb[i+1]):
-            t = self.wb[i]
-            self.wb[i:i+1] = [t, ""]
-            i += 1
-      i += 1
+    buf = LineBuffer(self.wb)
+    while buf.seek(lambda line: line.startswith(tag)):
+      if before:
+        if buf.index() == 0 or not empty.match(buf.previous()):
+          t = buf.current()
+          buf.replace(1, ["", t])
+          buf.advance()
+      if after:
+        if buf.index()+1 == len(buf) or not empty.match(buf.peek(1)):
+          t = buf.current()
+          buf.replace(1, [t, ""])
+          buf.advance()
+      buf.advance()
+    buf.close()
 
   def stripComments(self):
-    i = 0
-    while i < len(self.wb):
-      if self.wb[i].startswith("//"): # line starts with "//"
-        del self.wb[i]
+    buf = LineBuffer(self.wb)
+    while buf.seek(lambda line: line.startswith(("//", "<!--")) or "/*" in line):
+      line = buf.current()
+      if line.startswith("//"): # line starts with "//"
+        buf.delete()
         continue
-      if self.wb[i].startswith("<!--") and "-->" in self.wb[i]:
-        del self.wb[i]
+      if line.startswith("<!--") and "-->" in line:
+        buf.delete()
         continue
       # multi-line
-      if self.wb[i].startswith("<!--"):
-        while not "-->" in self.wb[i]:
-          del self.wb[i]
-          if i == len(self.wb):
-            fatal("Open comment marker <!-- found at line " + str(i) + \
+      if line.startswith("<!--"):
+        while not "-->" in buf.current():
+          buf.delete()
+          if buf.atEnd():
+            fatal("Open comment marker <!-- found at line " + str(buf.index()) + \
                 " with no closing marker. Check for a typo in closing -->");
           continue
-        del self.wb[i]
+        buf.delete()
+        line = buf.current()
       # ANSI standard
-      if self.wb[i].startswith("/*") and self.wb[i].endswith("*/"):
+      if line.startswith("/*") and line.endswith("*/"):
         # entire line is comment
-        del self.wb[i]
+        buf.delete()
         continue
-      if re.search(r"\/\*.*?\*\/", self.wb[i]): # comment as part of line
-        self.wb[i] = re.sub(r"\/\*.*?\*\/", "", self.wb[i])
-        self.wb[i] = self.wb[i].rstrip()
+      if re.search(r"\/\*.*?\*\/", line): # comment as part of line
+        buf.set(re.sub(r"\/\*.*?\*\/", "", line).rstrip())
         continue
       # multi-line (must be last)
-      if self.wb[i].startswith("/*"):
-        while not "*/" in self.wb[i]:
-          del self.wb[i]
-          if i == len(self.wb):
-            fatal("Open comment marker /* found at line " + str(i) + \
+      if line.startswith("/*"):
+        while not "*/" in buf.current():
+          buf.delete()
+          if buf.atEnd():
+            fatal("Open comment marker /* found at line " + str(buf.index()) + \
                 " with no closing marker. Check for a typo in closing */");
           continue
-        del self.wb[i] # closing comment line
+        buf.delete() # closing comment line
         continue
-      i += 1
-
-  def applyMacros(self):
-    # process macros
-    self.dprint(1, "define macros")
+      buf.advance()
+    buf.close()
+
+  # One pass over the buffer takes out every line which defines something
+  # rather than being text: <macro> definitions, <template> blocks, and
+  # the lines shortHeading, addOptionsAndProperties and addMeta interpret,
+  # which are kept in self.directives.  Nothing inside a <template> or a
+  # <lit> block is a directive, though macros are defined anywhere.
+  #
+  # Macros are applied once they are all defined, to the text and to what
+  # was taken out, in the order of the original lines; then the templates
+  # are defined.
+  def extractDirectives(self):
+    self.dprint(1, "extract directives")
     macro = {}
+    regexMacroDef = re.compile(r"<macro (.*?)=\"(.*?)\"\/?>")
+    regexTemplate = re.compile("<template(.*?)(/)?>")
+    regexLit = re.compile("<lit(.*?)(/)?>")
+
+    out = []
+    extracted = [] # (where it was in out, its lines, is it a template)
+    template = None # lines of the <template> block being collected
+    inLit = False
+    for line in self.wb:
+      if line.startswith("<macro"):
+        m = regexMacroDef.match(line)
+        if m:
+          macro[m.group(1)] = m.group(2)
+          continue
 
-    # define macros and save
-    i = 0
-    regex = re.compile(r"<macro (.*?)=\"(.*?)\"\/?>")
-    while i < len(self.wb):
-      m = regex.match(self.wb[i])
-      if m:
-        macroName = m.group(1)
-        macroDef = m.group(2)
-        macro[macroName] = macroDef
-        del self.wb[i] # macro has been stored
-        i -= 1
-      i += 1
+      if template != None:
+        if line.startswith("</template>"):
+          extracted.append((len(out), template, True))
+          template = None
+        elif line.startswith("<template"):
+          fatal("No closing tag found for template; open line: " +
+            template[0] + "; found another open tag: " + line)
+        else:
+          template.append(line)
+        continue
+
+      if line.startswith("<template"):
+        m = regexTemplate.match(line)
+        if m:
+          if m.group(2) != None:
+            fatal("Open tag template marked for close. " + line)
+          template = [ line ]
+          continue
+
+      if inLit:
+        inLit = not line.startswith("</lit>")
+      elif line.startswith("<lit"):
+        m = regexLit.match(line)
+        inLit = m != None and m.group(2) == None
+      elif self.isDirective(line):
+        extracted.append((len(out), [ line ], False))
+        continue
+      out.append(line)
+
+    if template != None:
+      fatal("No closing tag found for template; open line: " + template[0])
     dprint(1, "Macros defined: " + str(macro));
 
     # apply macros to text
     self.dprint(1, "apply macros")
-    i = 0
     regex = re.compile("%([^; ].*?)%")
-    for i, line in enumerate(self.wb):
+    def applyMacros(line):
+      if not "%" in line:
+        return line
       while True:
         m = regex.search(line)
         if not m:
           break
         macroName = m.group(1)
         if not macroName in macro: # is this in our list of macros already defined?
-          wprint('macro', "warning: macro %{}% undefined in line\n>>>{}<<<\nIgnoring, may simply be two percent signs on the line.".format(macroName, self.wb[i]))
+          wprint('macro', "warning: macro %{}% undefined in line\n>>>{}<<<\nIgnoring, may simply be two percent signs on the line.".format(macroName, line))
           break
         dprint(1, "Sub in " + line + ", " + macro[macroName]);
         line = line[0:m.start(0)] + macro[macroName] + line[m.end(0):]
         dprint(1, "result:" + line);
-        self.wb[i] = line
-      i += 1
+      return line
+
+    i = 0
+    for where, lines, isTemplate in extracted + [ (len(out), [], False) ]:
+      while i < where:
+        out[i] = applyMacros(out[i])
+        i += 1
+      lines[:] = [ applyMacros(line) for line in lines ]
+    self.wb[:] = out
+
+    self.dprint(1, "user-defined templates")
+    self.directives = []
+    for where, lines, isTemplate in extracted:
+      if not isTemplate:
+        self.directives.append(lines[0])
+        continue
+      # Remember the definitions, so a FrontEnd can replay them into
+      # other books sharing this buffer
+      opts = regexTemplate.match(lines[0]).group(1)
+      self.userTemplates.append((opts, lines[1:]))
+      self.templates.defineTemplate(opts, lines[1:])
+
+  # Given the type='...' value of an <if> tag, does the block get
+  # included when generating the output format gentype?
+  # Returns None if the tag is badly formatted.
+  @staticmethod
+  def conditionalIncludes(openTag, gentype):
+    m = re.match(" *type=['\"](.*?)['\"]", openTag)
+    if not m:
+      return None
+
+    conditional_type = m.group(1)
+    if "!" in conditional_type:
+      all = "hepkt"
+      for type in conditional_type:
+        if type in all:
+          all = all.replace(type, '')
+      conditional_type = all
+    return gentype in conditional_type
 
   def applyConditionals(self):
     # process conditional source directives
     self.dprint(1,"conditionals")
 
     def oneIfBlock(openTag, block):
-      m = re.match(" *type=['\"](.*?)['\"]", openTag)
-      if not m:
+      include = self.conditionalIncludes(openTag, self.gentype)
+      if include is None:
         fatal("Badly formatted <if> conditional")
-
-      conditional_type = m.group(1)
-      if "!" in conditional_type:
-        all = "hepkt"
-        for type in conditional_type:
-          if type in all:
-            all = all.replace(type, '')
-        conditional_type = all
-      if self.gentype in conditional_type:
+      if include:
         return block
       else:
         return []
@@ -671,26 +720,28 @@ class Book(object): #{
   def fixPageNumberTags(self):
     # page number tags
     # force page numbers to separate line and to single-quote version
-    i = 0
     regex = re.compile(r"<pn=[\"'](.+?)[\"']>")
     regex1 = re.compile(r"^(.*?)(\s?<pn='.*?'>\s?)(.*)$")
-    while i < len(self.wb):
-      self.wb[i] = regex.sub(r"<pn='\1'>", self.wb[i])
-      m = regex1.search(self.wb[i])
+    buf = LineBuffer(self.wb)
+    while buf.seek(lambda line: "<pn=" in line):
+      line = regex.sub(r"<pn='\1'>", buf.current())
+      buf.set(line)
+      m = regex1.search(line)
       if m:
         if m.group(1) != "" and m.group(3) != "":
           t = [m.group(1), m.group(2).strip(), m.group(3)]
-          self.wb[i:i+1] = t
-          i += 2
+          buf.replace(1, t)
+          buf.advance(2)
         if m.group(1) != "" and m.group(3) == "":
           t = [m.group(1), m.group(2).strip()]
-          self.wb[i:i+1] = t
-          i += 1
+          buf.replace(1, t)
+          buf.advance()
         if m.group(1) == "" and m.group(3) != "":
           t = [m.group(2).strip(), m.group(3)]
-          self.wb[i:i+1] = t
-          i += 1
-      i += 1
+          buf.replace(1, t)
+          buf.advance()
+      buf.advance()
+    buf.close()
 
   def literals(self):
     self.dprint(1, "protecting literals")
@@ -716,8 +767,34 @@ class Book(object): #{
     parseStandaloneTagBlock(self.wb, "lit", oneLitBlock)
 
   # load file from specified source file
+  # The work is split in two: commonPasses() does not depend on the
+  # output format, so a FrontEnd can do it once and share the result
+  # between all the formats being generated; formatPasses() is the
+  # per-format projection, starting with <if> conditionals.
   def loadFile(self, fn):
     self.dprint(1, "loadFile")
+    self.step(self.loadSource, fn)
+    self.step(self.commonPasses)
+    self.step(self.formatPasses)
+
+  # Characters the passes use internally, to stand for markup or escapes
+  # in the text: ⩤⩥ for protected tag braces, ①-⑦ and ⓯-⓳ for font
+  # changes, and those in HTML.cleanTrans.  One in the source would be
+  # taken for what it stands for, and not come out as written.
+  reservedRegex = patterns.compile("reserved", "[⩤⩥①-⑦⓯-⓳⧲⧗⧢⋀⧀⧁⊐⊏≼≽⨭⨮" +
+    config.OL_START + config.OL_END + config.FONT_END + "]")
+
+  def checkReserved(self):
+    regex = self.reservedRegex
+    for line in self.wb:
+      m = regex.search(line)
+      if m:
+        cprint("warning: character U+{:04X} is used internally by fpgen, " \
+          "and will not appear as written, in line\n>>>{}<<<".format(
+          ord(m.group(0)), line))
+
+  # Read the source file into self.wb
+  def loadSource(self, fn):
     self.checkFile(fn)
     try:
       wbuf = open(fn, "r", encoding='UTF-8').read()
@@ -732,75 +809,97 @@ class Book(object): #{
     self.wb.insert(0,"")
     self.wb = [s.rstrip() for s in self.wb]
 
-    self.stripComments()
+  # Output format independent part of loadFile
+  def commonPasses(self):
+    self.step(self.stripComments)
+    self.step(self.checkReserved)
 
     # Before or after conditions & macros?
-    self.fixPageNumberTags()
-
-    # process optional formatting (DEPRECATED)
-    # <I>..</I> will be italics only in media that can render it natively.
-    # <B>..</B> will be bold only in media that can render it natively.
-    # both are ignored in Text
-    #
-    i = 0
-    while i < len(self.wb):
-      if self.gentype == 't':
-        self.wb[i] = re.sub(r"<\/?I>", "", self.wb[i])
-        self.wb[i] = re.sub(r"<\/?B>", "", self.wb[i])
-      else:
-        self.wb[i] = self.wb[i].replace("<I>", "<i>")
-        self.wb[i] = self.wb[i].replace("<B>", "<b>")
-        self.wb[i] = self.wb[i].replace("</I>", "</i>")
-        self.wb[i] = self.wb[i].replace("</B>", "</b>")
-      i += 1
+    self.step(self.fixPageNumberTags)
 
-    self.applyConditionals()
+  # Output format dependent part of loadFile
+  def formatPasses(self):
+    self.step(self.optionalFormatting)
 
-    self.applyMacros()
+    self.step(self.applyConditionals)
 
-    self.createUserDefinedTemplates()
+    self.step(self.extractDirectives)
 
-    self.literals()
+    self.step(self.literals)
 
     # ensure heading has a blank line before
-    self.blankLines("<heading", True, False)
+    self.step(self.blankLines, "<heading", True, False)
 
     # ensure line group has a blank line before
-    self.blankLines("<lg", True, False)
-    self.blankLines("</lg", False, True)
+    self.step(self.blankLines, "<lg", True, False)
+    self.step(self.blankLines, "</lg", False, True)
 
-    # ensure standalone illustration line has blank lines before, after
-    i = 0
-    regex = re.compile(r"<illustration.*?\/>")
-    while i < len(self.wb):
-      if regex.match(self.wb[i]):
-        t = self.wb[i]
-        u = []
-        if not empty.match(self.wb[i-1]):
-          u.append("")
-        u.append(t)
-        if not empty.match(self.wb[i+1]):
-          u.append("")
-        self.wb[i:i+1] = u
-        i += len(u)
-      i += 1
+    self.step(self.illustrationSpacing)
 
     # ensure illustration line has blank lines before
-    self.blankLines("<illustration", True, False)
-    self.blankLines("</illustration", False, True)
+    self.step(self.blankLines, "<illustration", True, False)
+    self.step(self.blankLines, "</illustration", False, True)
 
     for i, line in enumerate(self.wb):
       # map <br> to be legal
       line = line.replace("<br>", "<br/>")
       self.wb[i] = line
 
-    # normalize rend format to have trailing semicolons
-    # honour <lit>...</lit> blocks
-    # FIX ME! This changes rend='...' when it is not inside <...>
-    # TODO: Make all users of rend= use parseOption, and then remove this!
+    self.step(self.normalizeRend)
+
+    self.step(self.lineSpacing)
+
+    self.step(self.userWarnings)
+
+    # format footnotes to standard form 08-Sep-2013
+    self.step(footnote.reformat, self.wb)
+
+  # process optional formatting (DEPRECATED)
+  # <I>..</I> will be italics only in media that can render it natively.
+  # <B>..</B> will be bold only in media that can render it natively.
+  # both are ignored in Text
+  #
+  def optionalFormatting(self):
+    i = 0
+    while i < len(self.wb):
+      if self.gentype == 't':
+        self.wb[i] = re.sub(r"<\/?I>", "", self.wb[i])
+        self.wb[i] = re.sub(r"<\/?B>", "", self.wb[i])
+      else:
+        self.wb[i] = self.wb[i].replace("<I>", "<i>")
+        self.wb[i] = self.wb[i].replace("<B>", "<b>")
+        self.wb[i] = self.wb[i].replace("</I>", "</i>")
+        self.wb[i] = self.wb[i].replace("</B>", "</b>")
+      i += 1
+
+  # ensure standalone illustration line has blank lines before, after
+  def illustrationSpacing(self):
+    regex = re.compile(r"<illustration.*?\/>")
+    buf = LineBuffer(self.wb)
+    while buf.seek(regex.match):
+      t = buf.current()
+      u = []
+      if not empty.match(buf.previous()):
+        u.append("")
+      u.append(t)
+      if not empty.match(buf.peek(1)):
+        u.append("")
+      buf.replace(1, u)
+      buf.advance(len(u))
+      buf.advance()
+    buf.close()
+
+  # normalize rend format to have trailing semicolons
+  # honour <lit>...</lit> blocks
+  # FIX ME! This changes rend='...' when it is not inside <...>
+  # TODO: Make all users of rend= use parseOption, and then remove this!
+  regexRendDouble = patterns.compile("normalizeRend.double", 'rend="(.*?)"')
+  regexRendSingle = patterns.compile("normalizeRend.single", "rend='(.*?)'")
+
+  def normalizeRend(self):
     in_pre = False
-    regexDouble = re.compile('rend="(.*?)"')
-    regexSingle = re.compile("rend='(.*?)'")
+    regexDouble = self.regexRendDouble
+    regexSingle = self.regexRendSingle
     for i,line in enumerate(self.wb):
       if "<lit" in line:
         in_pre = True
@@ -808,50 +907,51 @@ class Book(object): #{
         in_pre = False
       m = regexDouble.search(line)
       if m:
-        self.wb[i] = re.sub('rend=".*?"', "rend='{}'".format(m.group(1)), self.wb[i])
+        self.wb[i] = regexDouble.sub("rend='{}'".format(m.group(1)), self.wb[i])
       m = regexSingle.search(self.wb[i])
       if not in_pre and m:
         therend = m.group(1)
-        therend = re.sub(" ",";", therend)
+        therend = therend.replace(" ",";")
         therend += ";"
-        therend = re.sub(";;", ";", therend)
-        self.wb[i] = re.sub("rend='.*?'", "rend='{}'".format(therend), self.wb[i])
+        therend = therend.replace(";;", ";")
+        self.wb[i] = regexSingle.sub("rend='{}'".format(therend), self.wb[i])
 
-    # ensure spacing around standalone <l> or <l/> elements that are not in a line group
-    i = 0
+  # ensure spacing around standalone <l> or <l/> elements that are not in a line group
+  def lineSpacing(self):
     inLineGroup = False
-    while i < len(self.wb):
-      if self.wb[i].startswith("<lg"):
+    buf = LineBuffer(self.wb)
+    while not buf.atEnd():
+      line = buf.current()
+      if line.startswith("<lg"):
           inLineGroup = True
-      if self.wb[i].startswith("</lg"):
+      if line.startswith("</lg"):
           inLineGroup = False
       if inLineGroup:
-          i += 1
+          buf.advance()
           continue
-      m = re.search("<l[^i]", self.wb[i])
+      m = re.search("<l[^i]", line)
       if m:
         # if the line before this isn't blank or another <l element, add a blank line before
-        if not empty.match(self.wb[i-1]) and not re.match("^<l", self.wb[i-1]):
-          self.wb[i:i+1] = ["", self.wb[i]]
-          i += 1
+        if not empty.match(buf.previous()) and not re.match("^<l", buf.previous()):
+          buf.insert([""])
+          buf.advance()
         # if the line after this isn't blank or another <l element, add a blank line after
-        if not empty.match(self.wb[i+1]) and not re.match("^<l", self.wb[i+1]):
-          self.wb[i:i+1] = [self.wb[i],""]
-          i += 1
-      i += 1
-
-    # display user-supplied warnings (<warn>...</warn>)
-    i = 0
+        if not empty.match(buf.peek(1)) and not re.match("^<l", buf.peek(1)):
+          buf.advance()
+          buf.insert([""])
+      buf.advance()
+    buf.close()
+
+  # display user-supplied warnings (<warn>...</warn>)
+  def userWarnings(self):
     regex = re.compile(r"<warning>(.*?)<\/warning>")
-    while i < len(self.wb):
-      m = regex.match(self.wb[i])
-      if m:
-        cprint("warning: {}".format(m.group(1)))
-        del self.wb[i]
-      i += 1
-
-    # format footnotes to standard form 08-Sep-2013
-    footnote.reformat(self.wb)
+    buf = LineBuffer(self.wb)
+    while buf.seek(regex.match):
+      m = regex.match(buf.current())
+      cprint("warning: {}".format(m.group(1)))
+      buf.delete()
+      buf.advance()
+    buf.close()
   ## End of loadFile method
 
   # save file to specified dstfile
@@ -886,10 +986,10 @@ class Book(object): #{
     self.back2 = self.back1
     self.back1 = i
 
-  def createUserDefinedTemplates(self):
-    self.dprint(1, "user-defined templates")
-
-    parseStandaloneTagBlock(self.wb, "template", self.templates.defineTemplate)
+  def replayUserDefinedTemplates(self, definitions):
+    for opts, block in definitions:
+      self.userTemplates.append((opts, block[:]))
+      self.templates.defineTemplate(opts, block[:])
 
   def macroTemplates(self):
     self.dprint(1, "applying macro templates")
@@ -898,50 +998,61 @@ class Book(object): #{
     self.templates.setGlobals(self.umeta.getAsDict())
 
     regexMacro = re.compile(r"<expand-macro\s+(.*?)/?>")
-    i = 0
-    while i < len(self.wb):
-      line = self.wb[i]
+    buf = LineBuffer(self.wb)
+    while buf.seek(regexMacro.search):
+      line = buf.current()
 
       # What about multiple macro expansions on a line?  Or recursion?
       # Make it simpler for now by just punting: if you expand, then we move on
       # to the next line.
       m = regexMacro.search(line)
-      if m:
-        opts = m.group(1)
-        replacement = self.templates.expandMacro(opts)
-        prefix = line[:m.start(0)]
-        suffix = line[m.end(0):]
-
-        if len(replacement) == 0:
-          # If the template returns nothing, then you end up with a single line of
-          # the prefix and suffix around the <expand-macro>
-          replacement = [ prefix + suffix ]
-        else:
-          # Otherwise the prefix goes on the first line; and the suffix at the end of
-          # the last; which might be the same single line.
-          replacement[0] = prefix + replacement[0]
-          replacement[-1] = replacement[-1] + suffix
-        self.wb[i:i+1] = replacement
-        i += len(replacement)
-        continue
-
-      i += 1
-
-  def run(self):
-    self.loadFile(self.srcfile)
-    self.process()
-    self.saveFile(self.dstfile)
+      opts = m.group(1)
+      replacement = self.templates.expandMacro(opts)
+      prefix = line[:m.start(0)]
+      suffix = line[m.end(0):]
+
+      if len(replacement) == 0:
+        # If the template returns nothing, then you end up with a single line of
+        # the prefix and suffix around the <expand-macro>
+        replacement = [ prefix + suffix ]
+      else:
+        # Otherwise the prefix goes on the first line; and the suffix at the end of
+        # the last; which might be the same single line.
+        replacement[0] = prefix + replacement[0]
+        replacement[-1] = replacement[-1] + suffix
+      buf.replace(1, replacement)
+      buf.advance(len(replacement))
+    buf.close()
+
+  # If a FrontEnd is given, the source has already been loaded (or will be
+  # loaded once) and is shared with the other formats being generated.
+  def run(self, frontEnd = None):
+    if frontEnd is None:
+      self.step(self.loadFile, self.srcfile)
+    else:
+      self.step(frontEnd.load, self)
+    self.step(self.process)
+    self.step(self.saveFile, self.dstfile)
+
+  # Run one pass over the book; see passes.py.  While it runs, the book's
+  # context is the current one, on whichever thread runs it
+  def step(self, function, *args):
+    previous = config.setContext(self.context)
+    try:
+      return passes.run(self, function.__name__, function, args)
+    finally:
+      config.setContext(previous)
 
   # Common processing output independent code.
   # Invoked as super() followed by output dependent code in the subclasses
   def process(self):
-    self.shortHeading()
-    self.addOptionsAndProperties()
-    self.addMeta()
-    self.versionCheck()
-    self.macroTemplates()
-    self.chapterHeaders()
-    footnote.relocateFootnotes(self.wb)
+    self.step(self.shortHeading)
+    self.step(self.addOptionsAndProperties)
+    self.step(self.addMeta)
+    self.step(self.versionCheck)
+    self.step(self.macroTemplates)
+    self.step(self.chapterHeaders)
+    self.step(footnote.relocateFootnotes, self.wb, self.footnoteIndex)
 
   def __str__(self):
     return "fpgen"
@@ -989,7 +1100,7 @@ class Book(object): #{
         keys = {}
         opts, chapHead = parseLineEntry("chap-head", line)
         j = i+1
-        while j < len(self.wb) and re.match(r"^\s*$", self.wb[j]):
+        while j < len(self.wb) and blank.match(self.wb[j]):
           j += 1
         if j == len(self.wb):
           fatal("End of file after <chap-head>")
@@ -1107,7 +1218,8 @@ def parseLgOptions(args):
   else:
     fatal("Cannot happen: " + args)
 
-  return (opts, align)
+  # A copy, since callers remove the options they deal with
+  return (opts.copy(), align)
 
 def parseTablePattern(line, isHTML, uprop = None):
   # pull the pattern
@@ -1336,25 +1448,30 @@ class Lint(Book): #{
       line = re.sub(open, "", line, 1)
 
   # Lint: Main logic: Override Book.processCommon
+  regexTb = patterns.compile("Lint.tb", r"<tb\/?>")
+  regexPb = patterns.compile("Lint.pb", r"<pb\/?>")
+  regexCloseL = patterns.compile("Lint.closeL", r"<\/l>$")
+  regexHeading = patterns.compile("Lint.heading", "<heading[> ]")
+
   def process(self):
     #### Do NOT call super()
     inLineGroup = False
     reports = []
     for i,line in enumerate(self.wb):
 
-      if re.match(r"<tb\/?>", line) and (not empty.match(self.wb[i+1]) or not empty.match(self.wb[i-1])):
+      if self.regexTb.match(line) and (not empty.match(self.wb[i+1]) or not empty.match(self.wb[i-1])):
         reports.append("non-isolated <tb> tag:\nline number: {}".format(i))
 
-      if re.match(r"<pb\/?>", line) and (not empty.match(self.wb[i+1]) or not empty.match(self.wb[i-1])):
+      if self.regexPb.match(line) and (not empty.match(self.wb[i+1]) or not empty.match(self.wb[i-1])):
         reports.append("non-isolated <pb> tag:\nline number: {}".format(i))
 
       # all lines stand alone
       standaloneL = line.startswith("<l ") or line.startswith("<l>")
       if standaloneL:
-        if not re.search(r"<\/l>$", line):
+        if not self.regexCloseL.search(line):
           reports.append("line missing closing </l>:\nline number: {}\n{}".format(i,line))
       else:
-        if re.search(r"<\/l>$", line):
+        if self.regexCloseL.search(line):
           reports.append("line missing opening <l>:\nline number: {}\n{}".format(i,line))
 
       # no nested line groups
@@ -1373,7 +1490,7 @@ class Lint(Book): #{
       if inLineGroup:
         self.balanced(reports, line, i, lineGroupStartLine)
 
-      if standaloneL or re.match("<heading[> ]", line):
+      if standaloneL or self.regexHeading.match(line):
         self.balanced(reports, line, i, None)
 
     logfile = "errorlog.txt"
@@ -1406,34 +1523,19 @@ class HTML(Book): #{
   def __init__(self, ifile, ofile, d, fmt):
     Book.__init__(self, ifile, ofile, d, fmt)
     self.css = self.CSS()
+    self.cssMinify = False # --css-minify
     self.srcfile = ifile
     self.dstfile = ofile
     self.cpn = 0
     self.showPageNumbers = False
     self.tableCount = 0
     self.styleClasses = {}
+    self.indexN = 0 # <index> blocks so far
+    self.cssc = 100 # next hr.tbkN class of a <tb> with attributes
 
 
-  # internal class to manage CSS as it is added at runtime
-  class CSS(object):
-    def __init__(self):
-      self.cssline = {}
-
-    def addcss(self, s):
-      if s in self.cssline:
-        self.cssline[s] += 1
-      else:
-        self.cssline[s] = 1
-
-    def show(self):
-      t = []
-      keys = list(self.cssline.keys())
-      keys.sort()
-      for s in keys:
-        lines = s[6:].split("\n")
-        for l in lines:
-          t.append("      " + l)
-      return t
+  # manages CSS as it is added at runtime; see stylesheet.py
+  CSS = stylesheet.Stylesheet
 
   def addcss(self, css):
     self.css.addcss(css)
@@ -1623,34 +1725,39 @@ class HTML(Book): #{
       self.lastLineRaw = thisLineRaw
     return s
 
-  def preprocessOneBlock(self, block):
-    i = 0
-    while i < len(block):
-      l = block[i]
+  # Special characters, protected in one scan of each line.  No two of
+  # these overlap, except that an escape wins over what follows its
+  # backslash, and the leftmost match does that.
+  preprocessMap = {
+    "\\ " : '⋀', # escaped (hard) spaces
+    "\u00a0" : '⋀', # unicode 0xA0, non-breaking space
+    "\\%" : '⊐', # escaped percent signs (macros)
+    "\\#" : '⊏', # escaped octothorpes (page links)
+    "\\<" : '≼', # escaped open tag marks
+    "\\>" : '≽', # escaped close tag marks
+
+    "<thinsp>" : "\u2009",
+    "<nnbsp>" : "\u202f",
+    "<figsp>" : "\u2007",
+    "<shy>" : "\u00ad",        # soft-hyphen
+    "<wjoiner>" : "\u2060",
+
+    ". " : '.⋀', # spaces in spaced-out ellipsis, only before another dot
+    "\\'" : '⧗', # escaped single quote
+    '\\"' : '⧢', # escaped double quote
+    "&" : '⧲', # ampersand
+    "<l/>" : "<l></l>", # allow user shortcut <l/> -> </l></l>
+  }
+  preprocessRegex = patterns.compile("preprocess", "|".join(re.escape(s) +
+    (r"(?=\.)" if s == ". " else "") for s in preprocessMap))
 
+  def preprocessOneBlock(self, block):
+    regex = self.preprocessRegex
+    table = self.preprocessMap
+    function = lambda m: table[m.group(0)]
+    for i, l in enumerate(block):
       if not l.startswith(config.FORMATTED_PREFIX):
-        # protect special characters
-        l = l.replace("\\ ", '⋀') # escaped (hard) spaces
-        l = l.replace(" ",   '⋀') # unicode 0xA0, non-breaking space
-        l = l.replace("\\%", '⊐') # escaped percent signs (macros)
-        l = l.replace("\\#", '⊏') # escaped octothorpes (page links)
-        l = l.replace("\\<", '≼') # escaped open tag marks
-        l = l.replace("\\>", '≽') # escaped close tag marks
-
-        l = l.replace("<thinsp>", "\u2009")
-        l = l.replace("<nnbsp>", "\u202f")
-        l = l.replace("<figsp>", "\u2007")
-        l = l.replace("<shy>", "\u00ad")        # soft-hyphen
-        l = l.replace("<wjoiner>", "\u2060")
-
-        while ". ." in l:
-          l = l.replace(". .", '.⋀.') # spaces in spaced-out ellipsis
-        l = l.replace("\\'",'⧗') # escaped single quote
-        l = l.replace('\\"','⧢') # escaped double quote
-        l = l.replace(r"&",'⧲') # ampersand
-        l = l.replace("<l/>","<l></l>") # allow user shortcut <l/> -> </l></l>
-        block[i] = l
-      i += 1
+        block[i] = regex.sub(function, l)
 
   # HTML: preprocess text
   def preprocess(self):
@@ -1691,34 +1798,36 @@ class HTML(Book): #{
 
     parseStandaloneTagBlock(self.wb, "lg", lgBlock)
 
-    i = 1
-    while i < len(self.wb)-1:
-      if self.wb[i].startswith("<quote") and not empty.match(self.wb[i+1]):
-        t = [self.wb[i], ""]
+    buf = LineBuffer(self.wb)
+    buf.advance()
+    while (buf.seek(lambda line: line.startswith(("<quote", "</quote>")))
+        and buf.index() < len(buf)-1):
+      if buf.current().startswith("<quote") and not empty.match(buf.peek(1)):
+        t = [buf.current(), ""]
         # inject blank line
-        self.wb[i:i+1] = t
-        i += 1
-      if self.wb[i].startswith("</quote>") and not empty.match(self.wb[i-1]):
+        buf.replace(1, t)
+        buf.advance()
+      if buf.current().startswith("</quote>") and not empty.match(buf.previous()):
         t = ["", "</quote>"]
         # inject blank line
-        self.wb[i:i+1] = t
-        i += 1
-      i += 1
+        buf.replace(1, t)
+        buf.advance()
+      buf.advance()
+    buf.close()
 
     # whitespace around <footnote and </footnote
-    i = 0
-    while i < len(self.wb):
-      if re.match(r"<\/?footnote", self.wb[i]):
-        self.wb[i:i+1] = ["", self.wb[i], ""]
-        i += 2
-      i += 1
+    buf = LineBuffer(self.wb)
+    while buf.seek(re.compile(r"<\/?footnote").match):
+      buf.replace(1, ["", buf.current(), ""])
+      buf.advance(3)
+    buf.close()
 
   # page numbers honored in HTML, if present
   # convert all page numbers to absolute
   def processPageNum(self):
     self.dprint(1,"processPageNum")
 
-    rePrefix = re.compile(r"<pnprefix=['\"](.+?)['\"]>")
+    rePrefix = self.regexPnPrefix
     rePN = re.compile(r"pn=['\"](\+?)(.+?)['\"]")
     pnPrefix = None
     cpn = ""
@@ -1756,21 +1865,28 @@ class HTML(Book): #{
           self.wb[i] = re.sub("<⪦","⪦", self.wb[i])
           self.wb[i] = re.sub("⪧>","⪧", self.wb[i])
 
+  regexTocloc = patterns.compile("userToc.tocloc", "<tocloc(.*?)>")
+  regexTocHeading = patterns.compile("userToc.heading", "heading=[\"'](.*?)[\"']")
+  regexTocLevel = patterns.compile("userToc.level", r"level=[\"'](\d)[\"']")
+  regexTocSingle = patterns.compile("userToc.tocSingle", r"toc='(.*?)'")
+  regexTocDouble = patterns.compile("userToc.tocDouble", r'toc="(.*?)"')
+  regexTocId = patterns.compile("userToc.id", r"id=[\"'](.*?)[\"']")
+
   def userToc(self):
     self.dprint(1,"userToc")
 
     needToc = False
     for i,line in enumerate(self.wb):
-      if re.match("<tocloc", line):
+      if line.startswith("<tocloc"):
         needToc = True
         break
 
     if needToc:
       headingNumber = 1
-      m = re.match("<tocloc(.*?)>", line)
+      m = self.regexTocloc.match(line)
       if m:
           attrib = m.group(1)
-      m = re.search("heading=[\"'](.*?)[\"']", attrib)
+      m = self.regexTocHeading.search(attrib)
       usehead = "Table of Contents"
       if m:
           usehead = m.group(1)
@@ -1783,13 +1899,13 @@ class HTML(Book): #{
       self.css.addcss("[971] .literal { display:inline-block; text-align:left; }")
       # now scan the book for headings with toc='' entries
       for i,line in enumerate(self.wb):
-        m1 = re.match(r"<heading",line)
-        m2 = re.search(r"level=[\"'](\d)[\"']",line)
-        if re.search(r"toc='", line): # single quote delimiter
-          m3 = re.search(r"toc='(.*?)'",line)
+        m1 = line.startswith("<heading")
+        m2 = self.regexTocLevel.search(line)
+        if "toc='" in line: # single quote delimiter
+          m3 = self.regexTocSingle.search(line)
         else:
-          m3 = re.search(r'toc="(.*?)"',line)
-        m4 = re.search(r"id=[\"'](.*?)[\"']",line)
+          m3 = self.regexTocDouble.search(line)
+        m4 = self.regexTocId.search(line)
         if m1 and m2: # we have a line for the TOC
           htoc = ""
           if m3:
@@ -1802,7 +1918,7 @@ class HTML(Book): #{
             # id is not optional.  Generate one, and add it into the <heading>
             hid = 'h_' + str(headingNumber)
             headingNumber += 1
-            self.wb[i] = re.sub("<heading", "<heading id='" + hid + "'", line)
+            self.wb[i] = line.replace("<heading", "<heading id='" + hid + "'")
 
           indent = 2*(int(m2.group(1))-1) # indent based on heading level
           if indent > 0:
@@ -1814,44 +1930,31 @@ class HTML(Book): #{
       t.append("</div>")
       # insert TOC into document
       for i,line in enumerate(self.wb):
-        if re.search("<tocloc", line):
+        if "<tocloc" in line:
           self.wb[i:i+1] = t
 
-  def processLinks(self):
-    self.dprint(1,"processLinks")
-
-    def oneLink(arg, content, orig):
-      attributes = parseTagAttributes("link", arg, [ "target", "url" ])
-      href = None;
-      if "target" in attributes and "url" in attributes:
-        fatal("<link> may only have one of target or url: " + orig);
-      if "target" in attributes:
-        href = '#' + attributes["target"]
-      elif "url" in attributes:
-        href = attributes["url"]
-      else:
-        fatal("<link> must always have either a target or a url attribute: " +
-          orig)
-      return "⩤a href='" + href + "'⩥" + content + "⩤/a⩥"
-
-    parseEmbeddedSingleLineTagWithContent(self.wb, "link", oneLink)
+  def oneLink(self, arg, content, orig):
+    attributes = parseTagAttributes("link", arg, [ "target", "url" ])
+    href = None;
+    if "target" in attributes and "url" in attributes:
+      fatal("<link> may only have one of target or url: " + orig);
+    if "target" in attributes:
+      href = '#' + attributes["target"]
+    elif "url" in attributes:
+      href = attributes["url"]
+    else:
+      fatal("<link> must always have either a target or a url attribute: " +
+        orig)
+    return "⩤a href='" + href + "'⩥" + content + "⩤/a⩥"
 
   dittoMark = "”";
-  def processDittoMarks(self):
-    self.dprint(1,"DittoMarks")
-
-    if "ditto-mark" in self.uprop.prop:
-      self.dittoMark = self.uprop.prop["ditto-mark"];
-
-    def oneDitto(arg, word, orig):
-      self.addcss(dittoMarkCSS);
-      return "<span class='ditto-outer'><span class='ditto-word'>" + \
-        word + \
-        "</span><span class='ditto-mark'>" + \
-        self.dittoMark + \
-        "</span></span>";
-
-    parseEmbeddedSingleLineTagWithContent(self.wb, "ditto", oneDitto)
+  def oneDitto(self, arg, word, orig):
+    self.addcss(dittoMarkCSS);
+    return "<span class='ditto-outer'><span class='ditto-word'>" + \
+      word + \
+      "</span><span class='ditto-mark'>" + \
+      self.dittoMark + \
+      "</span></span>";
 
   def getDropcapCSS(self):
     return dropCapCSS
@@ -1871,88 +1974,83 @@ class HTML(Book): #{
   dropCapParaMarker = '<!--para-->'
   dropCapMarker = '⩤!--dropcap--⩥'
   dropCapMarkerA = '<!--dropcap-->'
-  def processDropCaps(self):
-    self.dprint(1,"DropCaps")
-
-    def oneDrop(arg, letter, orig):
-      attributes = parseTagAttributes("drop", arg, [ "src", "rend" ])
-
-      hasquote = letter.startswith("“")
-      if hasquote:
-        letter = letter[1:]
-
-      imgFile = None
-      if "drop-"+letter in self.uprop.prop:
-        imgFile = self.uprop.prop["drop-" + letter]
-      else:
-        if "src" in attributes:
-          imgFile = attributes["src"]
-
-      # No image file? Generate simply a large letter
-      if imgFile == None:
-        self.addcss(self.getDropcapCSS())
-
-        # If starts with a double-quote, this will remove it completely,
-        # or it will be very large and look funny.
-        # This is what most printed texts do.
-        return self.dropCapMarker + "⩤span class='dropcap'⩥" + letter + "⩤/span⩥"
-
-      # Width is, in priority
-      # a) rend='w:XX%'
-      # b) property drop-width-Letter
-      # c) property drop-width
-      # d) unspecified, i.e. pixel width of image
-      width = None
-      sliced = False
-      if "rend" in attributes:
-        # Only a width
-        rendAtt = parseOption("drop", attributes["rend"], [ "w" ])
-        if "w" in rendAtt:
-          width = "width:" + rendAtt["w"] + ";"
-      if width == None:
-        if "drop-width-"+letter in self.uprop.prop:
-          width = "width:" + self.uprop.prop["drop-width-" + letter]
-        elif "drop-width" in self.uprop.prop:
-          width = "width:" + self.uprop.prop["drop-width"]
-        else:
-          width = ""
+  def oneDrop(self, arg, letter, orig):
+    attributes = parseTagAttributes("drop", arg, [ "src", "rend" ])
 
-      files, widths, imageWidth = self.getImageSlices(imgFile)
+    hasquote = letter.startswith("“")
+    if hasquote:
+      letter = letter[1:]
 
-      img = ""
-      if files:
-        img += "⩤div class='dropslice' style='" + width + "'⩥"
-        for i,file in enumerate(files):
-          dprint(1,file);
-          w = widths[i]
-          percent = 100 * float(w) / imageWidth
-          # Note we need clear:left, or if the sum of two image widths fits,
-          # they will be horizontally stacked.
-          img += "⩤img src='" + file + \
-            "' style='float:left;clear:left;width:" + str(percent) + "%' alt='" + \
-            letter + "'/⩥"
-        img += "⩤/div⩥"
-        img += self.dropCapParaMarker
-        needPara = False
+    imgFile = None
+    if "drop-"+letter in self.uprop.prop:
+      imgFile = self.uprop.prop["drop-" + letter]
+    else:
+      if "src" in attributes:
+        imgFile = attributes["src"]
+
+    # No image file? Generate simply a large letter
+    if imgFile == None:
+      self.addcss(self.getDropcapCSS())
+
+      # If starts with a double-quote, this will remove it completely,
+      # or it will be very large and look funny.
+      # This is what most printed texts do.
+      return self.dropCapMarker + "⩤span class='dropcap'⩥" + letter + "⩤/span⩥"
+
+    # Width is, in priority
+    # a) rend='w:XX%'
+    # b) property drop-width-Letter
+    # c) property drop-width
+    # d) unspecified, i.e. pixel width of image
+    width = None
+    sliced = False
+    if "rend" in attributes:
+      # Only a width
+      rendAtt = parseOption("drop", attributes["rend"], [ "w" ])
+      if "w" in rendAtt:
+        width = "width:" + rendAtt["w"] + ";"
+    if width == None:
+      if "drop-width-"+letter in self.uprop.prop:
+        width = "width:" + self.uprop.prop["drop-width-" + letter]
+      elif "drop-width" in self.uprop.prop:
+        width = "width:" + self.uprop.prop["drop-width"]
       else:
-        img += "⩤img class='dropcap' src='" + imgFile + "' style='float:left;" + \
-          width + "' alt='" + letter + "'/⩥"
-        needPara = True
-
-      # For image-based, we add an open quote in the left margin
-      # Note: Need to add the paragraph tag *after* all <div>s; so
-      # if only a quote, after it; if both quote and slices; after both;
-      # if only slices after slices.
-      ret = self.dropCapMarker
-      if hasquote:
-        ret += '⩤div style="position:absolute;margin-left:-.5em; font-size:150%;"⩥“⩤/div⩥'
-        if needPara:
-          ret += self.dropCapParaMarker
-      ret += img
-
-      return ret;
-
-    parseEmbeddedSingleLineTagWithContent(self.wb, "drop", oneDrop)
+        width = ""
+
+    files, widths, imageWidth = self.getImageSlices(imgFile)
+
+    img = ""
+    if files:
+      img += "⩤div class='dropslice' style='" + width + "'⩥"
+      for i,file in enumerate(files):
+        dprint(1,file);
+        w = widths[i]
+        percent = 100 * float(w) / imageWidth
+        # Note we need clear:left, or if the sum of two image widths fits,
+        # they will be horizontally stacked.
+        img += "⩤img src='" + file + \
+          "' style='float:left;clear:left;width:" + str(percent) + "%' alt='" + \
+          letter + "'/⩥"
+      img += "⩤/div⩥"
+      img += self.dropCapParaMarker
+      needPara = False
+    else:
+      img += "⩤img class='dropcap' src='" + imgFile + "' style='float:left;" + \
+        width + "' alt='" + letter + "'/⩥"
+      needPara = True
+
+    # For image-based, we add an open quote in the left margin
+    # Note: Need to add the paragraph tag *after* all <div>s; so
+    # if only a quote, after it; if both quote and slices; after both;
+    # if only slices after slices.
+    ret = self.dropCapMarker
+    if hasquote:
+      ret += '⩤div style="position:absolute;margin-left:-.5em; font-size:150%;"⩥“⩤/div⩥'
+      if needPara:
+        ret += self.dropCapParaMarker
+    ret += img
+
+    return ret;
 
   def getImageSlices(self, imgFile):
     # Either a single image, or the assembling vertically of multiple
@@ -1985,49 +2083,53 @@ class HTML(Book): #{
       fatal("Can't figure out image width for sliced image " + imgFile)
     return files, widths, imageWidth
 
-  def processTargets(self):
-    self.dprint(1,"processTargets")
+  def oneTarget(self, arg, orig):
+    attributes = parseTagAttributes("target", arg, [ "id" ])
+    if "id" not in attributes:
+      fatal("<target> must always have an id attribute: " + orig)
+    id = attributes["id"]
+    return "⩤a id='" + id + "'⩥⩤/a⩥"
+
+  # <link>, <drop>, <ditto> and <target>, in one scan of each line
+  def processInlineTags(self):
+    self.dprint(1,"processInlineTags")
+
+    if "ditto-mark" in self.uprop.prop:
+      self.dittoMark = self.uprop.prop["ditto-mark"];
 
-    def oneTarget(arg, orig):
-      attributes = parseTagAttributes("target", arg, [ "id" ])
-      if "id" not in attributes:
-        fatal("<target> must always have an id attribute: " + orig)
-      id = attributes["id"]
-      return "⩤a id='" + id + "'⩥⩤/a⩥"
+    parseEmbeddedTags(self.wb, [
+      ("link", self.oneLink, True),
+      ("drop", self.oneDrop, True),
+      ("ditto", self.oneDitto, True),
+      ("target", self.oneTarget, False),
+    ])
 
-    parseEmbeddedTagWithoutContent(self.wb, "target", oneTarget)
+  # The known inline font tags, all found in one scan of a line: group 1
+  # is a plain or closing tag, e.g. i or /fs, or <fn id=...> without its
+  # <>; groups 2 and 3 are the name and argument of <fs:size> and
+  # <font:name>
+  regexInline = patterns.compile("HTML.inline",
+    r"<(/?(?:em|i|sc|b|u|g|r|ol)|/fs|/font|fn id=['\"].*?['\"]/?)>" +
+    r"|<(fs|font):(.*?)>")
 
+  # Hide the known inline font tags from the passes which follow, by
+  # turning their <> into ⩤⩥, and <ol> into its internal characters
   def protectMarkup(self, block):
     self.dprint(1,"protectMarkup")
-    for i,line in enumerate(block):
-      block[i] = block[i].replace("<em>",'⩤em⩥')
-      block[i] = block[i].replace("</em>",'⩤/em⩥')
-      block[i] = block[i].replace("<i>",'⩤i⩥')
-      block[i] = block[i].replace("</i>",'⩤/i⩥')
-      block[i] = block[i].replace("<sc>",'⩤sc⩥')
-      block[i] = block[i].replace("</sc>",'⩤/sc⩥')
-      block[i] = block[i].replace("<b>",'⩤b⩥')
-      block[i] = block[i].replace("</b>",'⩤/b⩥')
-      block[i] = block[i].replace("<u>",'⩤u⩥')
-      block[i] = block[i].replace("</u>",'⩤/u⩥')
-      block[i] = block[i].replace("<g>",'⩤g⩥')
-      block[i] = block[i].replace("</g>",'⩤/g⩥')
-      block[i] = block[i].replace("<r>",'⩤r⩥')
-      block[i] = block[i].replace("</r>",'⩤/r⩥')
-      block[i] = re.sub(r"<(fn id=['\"].*?['\"]/?)>",r'⩤\1⩥', block[i])
-
-      # new inline tags 2014.01.27
-      block[i] = block[i].replace("</fs>", r'⩤/fs⩥')
-      block[i] = re.sub("<(fs:.+?)>", r'⩤\1⩥', block[i])
-
-      block[i] = block[i].replace("</font>", r'⩤/font⩥')
-      block[i] = re.sub("<(font:.+?)>", r'⩤\1⩥', block[i])
 
+    def protect(m):
       # overline 13-Apr-2014
-      if "<ol>" in block[i]:
+      if m.group(1) == "ol":
         self.css.addcss("[116] .ol { text-decoration:overline; }")
-      block[i] = block[i].replace("<ol>", config.OL_START) # overline
-      block[i] = block[i].replace("</ol>", config.OL_END) # overline
+        return config.OL_START
+      if m.group(1) == "/ol":
+        return config.OL_END
+      return '⩤' + m.group(0)[1:-1] + '⩥'
+
+    regex = self.regexInline
+    for i,line in enumerate(block):
+      if "<" in line:
+        block[i] = regex.sub(protect, line)
 
   # <caption>...</caption> tags are considered paragraphs themselves.
   # Extract them, and format them up separately.
@@ -2090,6 +2192,24 @@ class HTML(Book): #{
     'xs' : '⓲'
   }
 
+  # tag: (internal character, css it needs)
+  restoreMap = {
+    "i" : ("①", "[110] .it { font-style:italic; }"),
+    "b" : ("③", "[111] .bold { font-weight:bold; }"),
+    "sc" : ("④", "[112] .sc { font-variant:small-caps; }"),
+    "u" : ("⑤", "[113] .ul { text-decoration:underline; }"),
+    "g" : ("⑥", "[114] .gesp { letter-spacing:0.2em; }"),
+    "r" : ("⑦", "[115] .red { color: red; }"),
+    "/i" : ("②", None),
+    "/b" : ("②", None),
+    "/sc" : ("②", None),
+    "/u" : ("②", None),
+    "/g" : ("②", None),
+    "/r" : ("②", None),
+    "/fs" : ("⓳", None),
+    "/font" : (config.FONT_END, None),
+  }
+
   # protectMarkup was used to hide just our known, inline font-related tags
   # by converting <> into ⩤⩥.
   #
@@ -2100,65 +2220,37 @@ class HTML(Book): #{
   # actual html strings.
   def restoreMarkup(self, block):
     self.dprint(1,"restoreMarkup")
-    reFS = re.compile(r"<fs:(.*?)>")
-    reFont = re.compile(r"<font:(.*?)>")
-    allFonts = None
-    for i,line in enumerate(block):
-      block[i] = block[i].replace("⩤",'<')
-      block[i] = block[i].replace("⩥",'>')
-
-      if "<i>" in block[i]:
-        self.css.addcss("[110] .it { font-style:italic; }")
-      block[i] = block[i].replace("<i>","①")
-      block[i] = block[i].replace("</i>",'②')
-
-      if "<b>" in block[i]:
-        self.css.addcss("[111] .bold { font-weight:bold; }")
-      block[i] = block[i].replace("<b>","③")
-      block[i] = block[i].replace("</b>",'②')
-
-      if "<sc>" in block[i]:
-        self.css.addcss("[112] .sc { font-variant:small-caps; }")
-      block[i] = block[i].replace("<sc>","④")
-      block[i] = block[i].replace("</sc>",'②')
-
-      if "<u>" in block[i]:
-        self.css.addcss("[113] .ul { text-decoration:underline; }")
-      block[i] = block[i].replace("<u>","⑤")
-      block[i] = block[i].replace("</u>",'②')
-
-      if "<g>" in block[i]:
-        self.css.addcss("[114] .gesp { letter-spacing:0.2em; }")
-      block[i] = block[i].replace("<g>","⑥")
-      block[i] = block[i].replace("</g>",'②')
-
-      if "<r>" in block[i]:
-        self.css.addcss("[115] .red { color: red; }")
-      block[i] = block[i].replace("<r>","⑦")
-      block[i] = block[i].replace("</r>",'②')
 
-      # new inline tags 2014.01.27
-      while True:
-        m = reFS.search(block[i])
-        if not m:
-          break
-        size = m.group(1)
-        if not size in self.fontmap:
-          fatal("<fs> tag has an unknown or unsupported size " + size +
-              " in line " + block[i])
-        block[i] = block[i][:m.start()] + self.fontmap[size] + block[i][m.end():]
+    def restore(m):
+      tag = m.group(1)
+      if tag in self.restoreMap:
+        char, css = self.restoreMap[tag]
+        if css != None:
+          self.css.addcss(css)
+        return char
 
-      while True:
-        m = reFont.search(block[i])
-        if not m:
-          break
-        font = m.group(1)
-        fontChar = config.FONT_BASE + self.getFontIndex(font)
-        dprint(1, "Using font " + str(fontChar) + " to " + font)
-        block[i] = block[i][:m.start()] + str(chr(fontChar)) + block[i][m.end():]
-
-      block[i] = block[i].replace("</fs>",'⓳')
-      block[i] = block[i].replace("</font>", config.FONT_END)
+      # new inline tags 2014.01.27
+      name, arg = m.group(2), m.group(3)
+      if name == "fs":
+        if not arg in self.fontmap:
+          fatal("<fs> tag has an unknown or unsupported size " + arg +
+              " in line " + line)
+        return self.fontmap[arg]
+      if name == "font":
+        fontChar = config.FONT_BASE + self.getFontIndex(arg)
+        dprint(1, "Using font " + str(fontChar) + " to " + arg)
+        return str(chr(fontChar))
+
+      return m.group(0)
+
+    regex = self.regexInline
+    for i,line in enumerate(block):
+      if "⩤" in line:
+        line = line.replace("⩤", "<").replace("⩥", ">")
+      if "<" in line:
+        block[i] = regex.sub(restore, line)
+      else:
+        block[i] = line
 
   # Default margins, only for html
   def getMargins(self):
@@ -2284,73 +2376,98 @@ class HTML(Book): #{
   def cleanup(self):
     self.dprint(1,"cleanup")
 
-    # Add the mapping for any font properties
+    # Add the mapping for any font properties; to a copy, since the fonts
+    # are this book's
+    trans = dict(self.cleanTrans)
     fonts = self.getFonts()
     index = config.FONT_BASE
     for name,value in fonts.items():
       dprint(1, "Adding entry for " + str(index) + ": " + name)
-      self.cleanTrans[str(chr(index))] = font.getFontSpan(name, value)
+      trans[str(chr(index))] = font.getFontSpan(name, value)
       index += 1
 
-    trans = "".maketrans(self.cleanTrans)
-    for i in range(len(self.wb)):
+    # Every internal character in one scan of the line; most lines have
+    # none, or only a few, so this is quicker than str.translate, which
+    # looks up each character of the line
+    regex = re.compile("[" + "".join(re.escape(c) for c in trans) + "]")
+    function = lambda m: trans[m.group(0)] or ""
+    reSup1 = re.compile(r'\^\{(.*?)\}')
+    reSup2 = re.compile(r'\^(.)')
+    reSub = re.compile(r'_\{(.*?)\}')
+    for i, line in enumerate(self.wb):
 
-      self.wb[i] = self.wb[i].translate(trans)
+      line = regex.sub(function, line)
 
       # superscripts, subscripts
       # special cases first: ^{} and _{}
       # 8203 is ZERO WIDTH SPACE U+200B
-      self.wb[i] = self.wb[i].replace('^{}', r'<sup>&#8203;</sup>')
-      self.wb[i] = self.wb[i].replace('_{}', r'<sub>&#8203;</sub>')
-      self.wb[i] = re.sub(r'\^\{(.*?)\}', r'<sup>\1</sup>', self.wb[i]) # superscript format 1: Rob^{t}
-      self.wb[i] = re.sub(r'\^(.)', r'<sup>\1</sup>', self.wb[i]) # superscript format 2: Rob^t
-      self.wb[i] = re.sub(r'_\{(.*?)\}', r'<sub>\1</sub>', self.wb[i]) # subscript: H_{2}O
+      # Each of these works on the result of the last, so they stay apart.
+      if "^" in line or "_" in line:
+        line = line.replace('^{}', r'<sup>&#8203;</sup>')
+        line = line.replace('_{}', r'<sub>&#8203;</sub>')
+        line = reSup1.sub(r'<sup>\1</sup>', line) # superscript format 1: Rob^{t}
+        line = reSup2.sub(r'<sup>\1</sup>', line) # superscript format 2: Rob^t
+        line = reSub.sub(r'<sub>\1</sub>', line) # subscript: H_{2}O
+      self.wb[i] = line
 
   # page links
   # 2014.01.14 new in 3.02c
+  regexLinkTarget = patterns.compile("plinks.target", r"#(\d+):(.*?)#")
+  regexLinkPage = patterns.compile("plinks.page", r"#(\d+)#")
+  regexPnPrefix = patterns.compile("pnprefix", r"<pnprefix=['\"](.+?)['\"]>")
+
   def plinks(self):
     self.dprint(1,"plinks")
 
     # of the form #124:ch03#
     # displays 124, links to ch03
-    regex = re.compile(r"#\d+:.*?#")
+    regex = self.regexLinkTarget
     for i in range(len(self.wb)): # new 2014.01.13
+      if not "#" in self.wb[i]:
+        continue
       while True:
         m = regex.search(self.wb[i])
         if not m:
           break
-        self.wb[i] = re.sub(r"#(\d+):(.*?)#", r"<a href='#\2'>\1</a>", self.wb[i],1)
+        self.wb[i] = regex.sub(r"<a href='#\2'>\1</a>", self.wb[i],1)
 
     # of the form #274#
     # displays 274, links to Page_274
-    regex = re.compile(r"#\d+#")
+    regex = self.regexLinkPage
     tag = "Page_"
     pnPrefix = None
     repl = r"<a href='#" + tag + r"\1'>\1</a>"
-    rePrefix = re.compile(r"<pnprefix=['\"](.+?)['\"]>")
-    i = 0
-    while i < len(self.wb):
-      m = rePrefix.match(self.wb[i])
+    rePrefix = self.regexPnPrefix
+    buf = LineBuffer(self.wb)
+    while buf.seek(lambda line: "#" in line or line.startswith("<pnprefix")):
+      line = buf.current()
+      m = rePrefix.match(line)
       if m:
         pnPrefix = m.group(1)
         tag = "Page_" + pnPrefix + "_"
         repl = r"<a href='#" + tag + r"\1'>\1</a>"
-        del self.wb[i]
+        buf.delete()
         continue
 
       while True:
-        m = regex.search(self.wb[i])
+        m = regex.search(line)
         if not m:
           break
-        self.wb[i] = re.sub(r"#(\d+)#", repl, self.wb[i], 1)
-      i += 1
+        line = regex.sub(repl, line, 1)
+      buf.set(line)
+      buf.advance()
+    buf.close()
 
+  # Last, after cleanup, so that every class the book uses is in it, and
+  # the rules for the others can be dropped
   def placeCSS(self):
     self.dprint(1,"placeCSS")
+    self.css.minify = self.cssMinify
     i = 0
     while i < len(self.wb):
-      if re.search("CSS PLACEHOLDER", self.wb[i]):
-        self.wb[i:i+1] = self.css.show() + font.formatFonts(self.getFonts())
+      if "CSS PLACEHOLDER" in self.wb[i]:
+        self.wb[i:i+1] = self.css.show(stylesheet.usedClasses(self.wb)) + \
+          font.formatFonts(self.getFonts())
         break
       i += 1
 
@@ -2501,7 +2618,6 @@ class HTML(Book): #{
     self.css.addcss(summaryCSS[self.summaryStyle])
     return [ "<div class='summary'>" ] + block + [ "</div>" ]
 
-  indexN = 0
   def oneIndex(self, openTag, block):
     self.indexN += 1
     nCol = 2
@@ -2547,7 +2663,6 @@ class HTML(Book): #{
     return b
 
   def oneMulticol(self, openTag, block):
-    self.indexN += 1
     nCol = 2
 
     attributes = parseTagAttributes("multicol", openTag, [ "rend" ])
@@ -2744,7 +2859,6 @@ hr.tbk {
       self.wb[lineno]= "<hr class='tbk'/>"
 
 
-  cssc = 100
   def doBreaks(self): # 02-Apr-2014 rewrite
     self.dprint(1,"doBreaks")
 
@@ -3506,9 +3620,15 @@ hr.tbk {
   # to m2h, which will apply it to each line
   def doLines(self):
     self.dprint(1,"doLines")
+    self.rendopts = ""
+    self.inPoetry = False
+    units.run(self, self.doLinesUnit, [ "rendopts", "inPoetry", "lastLineRaw" ])
+
+  # The lines of one unit; what it carries to the next is in self
+  def doLinesUnit(self):
     i = 0
-    rendopts = ""
-    inPoetry = False
+    rendopts = self.rendopts
+    inPoetry = self.inPoetry
     while i < len(self.wb):
       if re.search("<l[ig]", self.wb[i]): # skip links or linegroups
         i += 1
@@ -3531,6 +3651,8 @@ hr.tbk {
       if m: # we have a line to rend
         self.wb[i] = self.m2h(self.wb[i], inPoetry, rendopts)
       i += 1
+    self.rendopts = rendopts
+    self.inPoetry = inPoetry
 
   def processPageNumDisp(self):
     inBlockElement = False
@@ -3588,42 +3710,40 @@ hr.tbk {
   # HTML: Main logic
   def process(self):
     super().process()
-    self.processPageNum()
-    self.protectMarkup(self.wb)
-    self.preprocess()
-    self.tweakSpacing()
-    self.userToc()
-    self.doIndex()
-    self.doMulticol()
-    self.processLinks()
-    self.processDropCaps()
-    self.processDittoMarks()
-    self.processTargets()
+    self.step(self.processPageNum)
+    self.step(self.protectMarkup, self.wb)
+    self.step(self.preprocess)
+    self.step(self.tweakSpacing)
+    self.step(self.userToc)
+    self.step(self.doBlocks, "index", "multicol")
+    self.step(self.processInlineTags)
     from drama import DramaHTML
-    DramaHTML(self.wb, self.css).doDrama();
-    self.markPara()
-    self.restoreMarkup(self.wb)
-    self.startHTML()
-
-    self.doHeadings()
-    self.doBlockq()
-    self.doSummary()
-    self.doBreaks()
-    self.doTables()
-    self.doIllustrations()
-    footnote.outOfBandFootnoteProcessing(self.processOneBlock)
-    footnote.footnotesToTags(self.wb)
-    self.doSidenotes()
-    self.doLineGroups()
-    self.doLines()
-
-    self.processPageNumDisp()
-    footnote.emitFootnotes(self.wb, self.css)
-    self.placeCSS()
-    self.placeMeta()
-    self.cleanup()
-    self.plinks()
-    self.endHTML()
+    self.step(DramaHTML(self.wb, self.css).doDrama)
+    self.step(self.markPara)
+    self.step(self.restoreMarkup, self.wb)
+    self.step(self.startHTML)
+
+    self.step(self.doHeadings)
+    self.step(self.doBlockq)
+    self.step(self.doBlocks, "summary")
+    self.step(self.doBreaks)
+    self.step(self.doTables)
+    self.step(self.doIllustrations)
+    self.step(footnote.outOfBandFootnoteProcessing, self.processOneBlock,
+      self.footnoteIndex)
+    self.step(footnote.footnotesToTags, self.wb, self.footnoteIndex)
+    self.step(self.doSidenotes)
+    self.step(self.doLineGroups)
+    self.step(self.doLines)
+
+    self.step(self.processPageNumDisp)
+    self.step(footnote.emitFootnotes, self.wb, self.css)
+    self.step(self.placeMeta)
+    self.step(self.cleanup)
+    self.step(self.plinks)
+    self.step(stylesheet.compactStyles, self.wb, self.css)
+    self.step(self.placeCSS)
+    self.step(self.endHTML)
 
   # Footnotes may be removed from the main flow if they are converted to
   # sidenotes, and only added back during footnotesToTags.
@@ -3853,6 +3973,9 @@ class Text(Book): #{
   # convert all inline markup to text equivalent at start of run
   # Text version
   def processInline(self):
+    units.run(self, self.processInlineUnit, [])
+
+  def processInlineUnit(self):
     if self.italicdef == "decorative":
         replacewith = "" # decorative. ignore
     else:
@@ -3988,60 +4111,48 @@ class Text(Book): #{
 
   def processPageNum(self):
     self.dprint(1,"processPageNum")
-    i = 0
-    while i < len(self.wb):
-      if self.wb[i].startswith("<pn"):
-        del self.wb[i]
-        continue
-      i += 1
-
-  # strip links and targets and dropcaps
-  def stripLinks(self):
-    self.dprint(1,"stripLinks")
-    i = 0
-    while i < len(self.wb):
-      self.wb[i] = re.sub(r"<\/?link.*?>", "", self.wb[i])
-      self.wb[i] = re.sub(r"<target.*?>", "", self.wb[i])
-      i += 1
+    self.wb[:] = [ l for l in self.wb if not l.startswith("<pn") ]
 
   dittoMark = "”"
-  def processDittoMarks(self):
-    self.dprint(1,"DittoMarks")
-
-    def oneDitto(arg, word, orig):
-      if "ditto-mark" in self.uprop.prop:
-        self.dittoMark = self.uprop.prop["ditto-mark"];
-      wlen = len(word)
-      half = wlen // 2
-      odd = wlen % 2
-      right = half if odd == 1 else half-1
-      return config.HARD_SPACE * half + self.dittoMark + config.HARD_SPACE * right
-
-    parseEmbeddedSingleLineTagWithContent(self.wb, "ditto", oneDitto)
+  def oneDitto(self, arg, word, orig):
+    if "ditto-mark" in self.uprop.prop:
+      self.dittoMark = self.uprop.prop["ditto-mark"];
+    wlen = len(word)
+    half = wlen // 2
+    odd = wlen % 2
+    right = half if odd == 1 else half-1
+    return config.HARD_SPACE * half + self.dittoMark + config.HARD_SPACE * right
 
   # Dropcap in text either is stripped or replaced with property text
-  def processDropCaps(self):
-    self.dprint(1,"DropCaps")
-
-    def oneDrop(arg, letter, orig):
-
-      if "drop-text-"+letter in self.uprop.prop:
-        repl = self.uprop.prop["drop-text-"+letter]
-      else:
-        repl = letter
-      return repl
-
-    parseEmbeddedSingleLineTagWithContent(self.wb, "drop", oneDrop)
+  def oneDrop(self, arg, letter, orig):
+    if "drop-text-"+letter in self.uprop.prop:
+      repl = self.uprop.prop["drop-text-"+letter]
+    else:
+      repl = letter
+    return repl
+
+  # strip links and targets, and do dropcaps and ditto marks, in one scan
+  # of each line
+  def processInlineTags(self):
+    self.dprint(1,"processInlineTags")
+    parseEmbeddedTags(self.wb, [
+      ("link", lambda arg, content, orig: content, True),
+      ("target", lambda arg, orig: "", False),
+      ("drop", self.oneDrop, True),
+      ("ditto", self.oneDitto, True),
+    ])
 
   # simplify footnotes, move <l> to left, unadorn page links
   # preformat hr+footnotemark
   def preProcess(self):
     self.dprint(1,"preProcess")
+    units.run(self, self.preProcessUnit, [])
 
-    i = 0
+  def preProcessUnit(self):
     matchFN = re.compile(r"<fn\s+(.*?)/?>")
-    while i < len(self.wb):
-      line = self.wb[i]
+    buf = LineBuffer(self.wb)
+    while not buf.atEnd():
+      line = buf.current()
 
       # Remove all paragraph style tags, all ignored in text output
       for tag in para.paraTags:
@@ -4065,23 +4176,24 @@ class Text(Book): #{
         l = line[0:m.start(0)] + fmid
         off = len(l)    # Next loop
         line = l + line[m.end(0):]
-      self.wb[i] = line
 
-      m = re.match(r"\s+(<l.*)$", self.wb[i])
+      m = re.match(r"\s+(<l.*)$", line)
       if m:
-        self.wb[i] = m.group(1)
+        line = m.group(1)
 
       # allow user shortcut <l/> -> </l></l>
-      self.wb[i] = re.sub(r"<l\/>","<l></l>", self.wb[i])
+      line = re.sub(r"<l\/>","<l></l>", line)
+      buf.set(line)
 
-      if self.wb[i].startswith("<hr rend='footnotemark'>"):
-        s = re.sub("<hr rend='footnotemark'>", "▹-----", self.wb[i])
-        self.wb[i:i+1] = [".rs 1", s, ".rs 1"]
+      if line.startswith("<hr rend='footnotemark'>"):
+        s = re.sub("<hr rend='footnotemark'>", "▹-----", line)
+        buf.replace(1, [".rs 1", s, ".rs 1"])
 
       # remove any target tags
-      if re.search(r"<target.*?\/>", self.wb[i]):
-        self.wb[i] = re.sub(r"<target.*?\/>", "", self.wb[i])
-      i += 1
+      if re.search(r"<target.*?\/>", buf.current()):
+        buf.set(re.sub(r"<target.*?\/>", "", buf.current()))
+      buf.advance()
+    buf.close()
 
     # leading spaces inside pre-marked standalong line
     # example:       <l>  This was indented.</l>
@@ -4098,6 +4210,9 @@ class Text(Book): #{
   # protect inline markup
   def protectInline(self):
     self.dprint(1,"protectInline")
+    units.run(self, self.protectInlineUnit, [])
+
+  def protectInlineUnit(self):
     i = 0
     while i < len(self.wb):
       s = self.wb[i]
@@ -4250,135 +4365,158 @@ class Text(Book): #{
   def removeSidenotes(self):
     sidenoteBreak = (config.uopt.getopt('sidenote-breaks-paragraphs', True) == True)
     regexSidenote = re.compile("<sidenote>")
-    i = 0
-    while i < len(self.wb):
-      m = regexSidenote.search(self.wb[i])
-      if m:
-        m1 = re.search(r"<sidenote>.*<\/sidenote>", self.wb[i])
-        if m1:
-          # Remove <sidenote>...</sidenote>
-          self.wb[i] = (self.wb[i][0:m1.start(0)] + self.wb[i][m1.end(0):]).strip()
-          # Remove it completely if it was the whole line
-          if self.wb[i] == "":
-            del self.wb[i]
+    buf = LineBuffer(self.wb)
+    while buf.seek(regexSidenote.search):
+      line = buf.current()
+      m = regexSidenote.search(line)
+      m1 = re.search(r"<sidenote>.*<\/sidenote>", line)
+      if m1:
+        # Remove <sidenote>...</sidenote>
+        line = (line[0:m1.start(0)] + line[m1.end(0):]).strip()
+        # Remove it completely if it was the whole line
+        if line == "":
+          buf.delete()
+          continue
+        buf.set(line)
+      else:
+        # Remove <sidenote>...
+        line = line[0:m.start(0)]
+        buf.set(line)
+        buf.advance()
+        while not buf.atEnd():
+          m = re.search(r"<\/sidenote>", buf.current())
+          if m:
+            # Remove ...</sidenote>
+            buf.set(buf.current()[m.end(0):])
+            if not sidenoteBreak:
+              if buf.current() == "":
+                buf.delete()
+            break
+          # Remove line between <sidenote>\n...\n</sidenote>
+          buf.delete()
+        buf.retreat()
+        if not sidenoteBreak:
+          if line == "":
+            buf.delete()
             continue
-        else:
-          # Remove <sidenote>...
-          self.wb[i] = self.wb[i][0:m.start(0)]
-          j = i+1
-          while j < len(self.wb):
-            m = re.search(r"<\/sidenote>", self.wb[j])
-            if m:
-              # Remove ...</sidenote>
-              self.wb[j] = self.wb[j][m.end(0):]
-              if not sidenoteBreak:
-                if self.wb[j] == "":
-                  del self.wb[j]
-              break
-            # Remove line between <sidenote>\n...\n</sidenote>
-            del self.wb[j]
-          if not sidenoteBreak:
-            if self.wb[i] == "":
-              del self.wb[i]
-              continue
-      i += 1
+      buf.advance()
+    buf.close()
 
-  def last(self, i):
+  def last(self, lines, i):
     while True:
       i -= 1;
       if i == 0:
         return ""
-      if self.wb[i]:
-        return "\nPrevious lines: " + "\n".join(self.wb[i-5:i])
+      if lines[i]:
+        return "\nPrevious lines: " + "\n".join(lines[i-5:i])
     return ""
 
   # rewrap
   # doesn't touch lines that are already formatted
   # honors <quote> level
+  regexRewrapQuote = patterns.compile("rewrap.quote", r"<quote rend='w:(.*?)em'>")
+  regexRewrapTable = patterns.compile("rewrap.table", r"<table(.*?)>")
+  regexRewrapLg = patterns.compile("rewrap.lg", r"<lg(.*?)>")
+  regexRewrapL = patterns.compile("rewrap.l", r"<l(.*?)>(.*?)<\/l>")
+  regexRewrapFootnote = patterns.compile("rewrap.footnote", r"<footnote\s+(.*?)>")
+  regexRewrapHeading = patterns.compile("rewrap.heading", r"<heading(.*?)>(.*?)</heading>")
+  regexRewrapRend = patterns.compile("rewrap.rend", "rend='(.*?)'")
+  regexRewrapLevel = patterns.compile("rewrap.level", "level=[\"'](.*?)[\"']")
+  regexRewrapBr = patterns.compile("rewrap.br", r"<br(\/)?>")
+  regexRewrapHr = patterns.compile("rewrap.hr", r"rend='(.*?)'\/?>")
+
   def rewrap(self):
     self.dprint(1,"rewrap")
     self.qstack = [""] # no initial indent
-    i = 0
-    regexTable = re.compile(r"<table(.*?)>")
-    regexLg = re.compile(r"<lg(.*?)>")
-    regexL = re.compile(r"<l(.*?)>(.*?)<\/l>")
-    regexFootnote = re.compile(r"<footnote\s+(.*?)>")
-    regexHeading = re.compile(r"<heading(.*?)>(.*?)</heading>")
-    while i < len(self.wb):
-      self.dprint(2,"[rewrap] {}: {}".format(i,self.wb[i]))
-      if self.wb[i].startswith("<quote"):
+    units.run(self, self.rewrapUnit, [ "qstack" ])
+
+  # A <quote> may run over several units, the others are all within one
+  def rewrapUnit(self):
+    buf = LineBuffer(self.wb)
+    regexTable = self.regexRewrapTable
+    regexLg = self.regexRewrapLg
+    regexL = self.regexRewrapL
+    regexFootnote = self.regexRewrapFootnote
+    regexHeading = self.regexRewrapHeading
+    while not buf.atEnd():
+      self.dprint(2,"[rewrap] {}: {}".format(buf.index(),buf.current()))
+      if buf.current().startswith("<quote"):
         # is there a prescribed width?
-        m = re.match(r"<quote rend='w:(.*?)em'>", self.wb[i])
+        m = self.regexRewrapQuote.match(buf.current())
         if m:
           rendw = int(m.group(1))
           # user-specified width (in characters). calculate indent
           indent = " " * ((config.LINE_WIDTH - rendw) // 2)
           self.qstack.append(indent)
-          del(self.wb[i])
+          buf.delete()
           continue
         newlevel = self.qstack[-1] + "    "
         self.qstack.append(newlevel)
-        del(self.wb[i])
+        buf.delete()
         continue
 
-      if re.match(r"<\/quote>", self.wb[i]):
+      if buf.current().startswith("</quote>"):
         self.qstack.pop()
         if len(self.qstack) == 0:
-          fatal("</quote> encountered without matching open <quote>" + self.last(i))
-        del(self.wb[i])
+          fatal("</quote> encountered without matching open <quote>" +
+          self.last(buf.before, buf.index()))
+        buf.delete()
         continue
 
       # Already formatted?
-      if self.wb[i].startswith(config.FORMATTED_PREFIX):
-        i += 1
+      if buf.current().startswith(config.FORMATTED_PREFIX):
+        buf.advance()
         continue
 
-      if empty.match(self.wb[i]): # toss blank lines
-        del(self.wb[i])
+      if empty.match(buf.current()): # toss blank lines
+        buf.delete()
         continue
 
       # ----- footnotes -------------------------------------------------------
 
-      m = regexFootnote.match(self.wb[i])
+      m = regexFootnote.match(buf.current())
       if m:
         # strip blank lines leading the footnote
-        j = i+1;
-        while j < len(self.wb):
-          if self.wb[j] != '':
+        buf.advance()
+        while not buf.atEnd():
+          if buf.current() != '':
             break
-          del self.wb[j]
+          buf.delete()
+        buf.retreat()
         opts = m.group(1)
         args = parseTagAttributes("footnote", opts, [ "id", "target" ])
         id = args["id"]
         # Put the first line on the same line as the footnote number [#]
         # unless it is formatting itself, e.g. <lg>...</lg>
         fn = id + " "
-        if self.wb[j][0] != '<':
-          self.wb[i] = fn + self.wb[j];
-          del self.wb[i+1:j+1]
+        if buf.peek(1)[0] != '<':
+          buf.set(fn + buf.peek(1));
+          buf.advance()
+          buf.delete()
+          buf.retreat()
         else:
-          self.wb[i] = fn
-          del self.wb[i+1:j]
+          buf.set(fn)
         # continue & wrap
 
-      if self.wb[i].startswith("</footnote"):
-        del self.wb[i]
+      if buf.current().startswith("</footnote"):
+        buf.delete()
         continue
 
       # ----- headings --------------------------------------------------------
-      m = regexHeading.match(self.wb[i])
+      m = regexHeading.match(buf.current())
       if m:
-        m1 = re.search("rend='(.*?)'", self.wb[i])
+        m1 = self.regexRewrapRend.search(buf.current())
         if m1:
           rendatt = m1.group(1)
-          if re.search("hidden", rendatt):
-            del self.wb[i]
-            i -= 1
+          if "hidden" in rendatt:
+            buf.delete()
+            if buf.index() > 0:
+              buf.retreat()
             continue
         level = 1 # default
         att = m.group(1)
         head = m.group(2)
-        m = re.search("level=[\"'](.*?)[\"']", att)
+        m = self.regexRewrapLevel.search(att)
         if m:
           level = int(m.group(1))
         if level == 1:
@@ -4391,10 +4529,10 @@ class Text(Book): #{
           t = [] # sub-sub-sections
         # this may be an empty header element
         if empty.match(head):
-          self.wb[i:i+1] = t
+          buf.replace(1, t)
         else:
           s = self.detag(head)
-          s1 = re.sub(r"<br(\/)?>", "|", s)
+          s1 = self.regexRewrapBr.sub("|", s)
           t1 = s1.split("|")
           for s2 in t1:
             if s2 == "":
@@ -4407,28 +4545,28 @@ class Text(Book): #{
             t.append("▹.rs 2")
           else:
             t.append("▹.rs 1")
-          self.wb[i:i+1] = t
-          i += 1
-        i += 1
+          buf.replace(1, t)
+          buf.advance()
+        buf.advance()
         continue
 
       # ----- thought breaks and hr/footnotemark ------------------------------
 
       # any thought break in text is just centered asterisks
       # but the text:hidden rend option makes it just go away in text
-      if self.wb[i].startswith("<tb"):
-        if self.isTbHidden(self.wb[i]):
+      if buf.current().startswith("<tb"):
+        if self.isTbHidden(buf.current()):
           t = []
         else:
           t = ["▹.rs 1", textTbLine, "▹.rs 1" ]
-        self.wb[i:i+1] = t
-        i += 1
+        buf.replace(1, t)
+        buf.advance()
         continue
 
       # ----- testing ---------------------------------------------------------
 
       # 19-Sep-2013
-      if self.wb[i].startswith("<x"):
+      if buf.current().startswith("<x"):
         t = ["If you had stood there in the edge of the bleak",
         "spruce forest, with the wind moaning dismally",
         "through the twisting trees—midnight of deep",
@@ -4450,84 +4588,77 @@ class Text(Book): #{
         "darkness of the night that hung like a sable",
         "curtain ten feet from the car windows."]
         s = " ".join(t)
-        if re.match("<x1", self.wb[i]):
+        if buf.current().startswith("<x1"):
             t = wrap2(s)
-        if re.match("<x2", self.wb[i]):
+        if buf.current().startswith("<x2"):
             t = wrap2(s, 2, 2, 2, -2)
-        if re.match("<x3", self.wb[i]):
+        if buf.current().startswith("<x3"):
             t = wrap2(s, 2, 2, 2, 2)
-        self.wb[i:i+1] = ["▹.rs 1"] + t + ["▹.rs 1"]
-        i += len(t) + 2
+        buf.replace(1, ["▹.rs 1"] + t + ["▹.rs 1"])
+        buf.advance(len(t) + 2)
         continue
 
       # ----- footnote marker ----------------------------------------------
-      if self.wb[i].startswith("<hr"):
-        m = re.search(r"rend='(.*?)'\/?>",self.wb[i])
+      if buf.current().startswith("<hr"):
+        m = self.regexRewrapHr.search(buf.current())
         t = ["▹.rs 1"]
-        if re.search("footnotemark", m.group(1)):
+        if "footnotemark" in m.group(1):
           t.append("▹-----")
         else: # all other hr's default to tb styling
           t.append("▹                   *     *     *     *     *")
         t.append("▹.rs 1")
-        self.wb[i:i+1] = t
-        i += 1
+        buf.replace(1, t)
+        buf.advance()
         continue
 
       # ----- page breaks --------------------------------------------------
-      if self.wb[i].startswith("<pb"):
-        self.wb[i] = "▹.rs 4"
-        i += 1
+      if buf.current().startswith("<pb"):
+        buf.set("▹.rs 4")
+        buf.advance()
         continue
 
       # ----- process standalone line -----------------------------------------
-      m = regexL.match(self.wb[i])
+      m = regexL.match(buf.current())
       if m:
         handled = False
         args = m.group(1).strip()
         contents = m.group(2)
         block = self.oneL({}, args, contents)
-        self.wb[i:i+1] = block
-        i += len(block)
+        buf.replace(1, block)
+        buf.advance(len(block))
         continue
 
       # ----- tables ----------------------------------------------------------
 
-      m = regexTable.match(self.wb[i])
+      m = regexTable.match(buf.current())
       if m:
-        startloc = i
-        j = i
-        while not re.match(r"<\/table>", self.wb[j]):
+        j = 0
+        while not buf.peek(j).startswith("</table>"):
           j += 1
-        endloc = j
-        block = self.makeTable(self.wb[startloc:endloc+1])
-        self.wb[startloc:endloc+1] = block
-        i += len(block)
+        block = self.makeTable(buf.delete(j+1))
+        buf.insert(block)
+        buf.advance(len(block))
         continue
 
       # ----- process line group ----------------------------------------------
-      m = regexLg.match(self.wb[i])
+      m = regexLg.match(buf.current())
       if m:
-        startloc = i
-        j = i
-        while not self.wb[j].startswith("</lg>"):
+        j = 0
+        while not buf.peek(j).startswith("</lg>"):
           j += 1
-        endloc = j
-        self.wb[startloc:endloc+1] = self.oneLineGroup(m, self.wb[startloc:endloc+1])
+        buf.insert(self.oneLineGroup(m, buf.delete(j+1)))
 
       # ----- wrap ------------------------------------------------------------
 
       # if it's not been handled, it's wrappable.
       # if it's still a tag, then it's unhandled. fatal.
-      if re.match("<", self.wb[i]):
-        self.fatal("unhandled tag@{}: {}".format(i, self.wb[i]))
+      if buf.current().startswith("<"):
+        self.fatal("unhandled tag@{}: {}".format(buf.index(), buf.current()))
       t = []
-      mark1 = i
-      while (i < len(self.wb)
-          and not empty.match(self.wb[i])
-          and not re.match("[<▹]",self.wb[i])):
-        t.append(self.wb[i])
-        i += 1
-      mark2 = i
+      while (not buf.atEnd()
+          and not empty.match(buf.current())
+          and not buf.current().startswith(("<", "▹"))):
+        t.extend(buf.delete())
       # here at end of para or eof
       llen = config.LINE_WIDTH - (2 * len(self.qstack[-1]))
       leader = self.qstack[-1]
@@ -4550,8 +4681,9 @@ class Text(Book): #{
 
       u.insert(0, ".rs 1")
       u.append(".rs 1")
-      self.wb[mark1:mark2] = u
-      i = mark1 + len(u)
+      buf.insert(u)
+      buf.advance(len(u))
+    buf.close()
 
   def getAlignment(self, opts):
     for o in [ "left", "right", "center", "ml", "mr" ]:
@@ -4965,18 +5097,15 @@ class Text(Book): #{
     self.dprint(1,"finalSpacing")
 
     # merge user-forced lines
-    i = 0
-    while i < len(self.wb):
-      if config.FORMATTED_PREFIX == self.wb[i]:
-        startloc = i
-        spacecount = 1
-        i += 1
-        while i < len(self.wb) and config.FORMATTED_PREFIX == self.wb[i]:
-          spacecount += 1
-          i += 1
-        self.wb[startloc:i] = [".rs {}".format(spacecount)]
-        i -= 1
-      i += 1
+    buf = LineBuffer(self.wb)
+    while buf.seek(lambda line: config.FORMATTED_PREFIX == line):
+      spacecount = 0
+      while not buf.atEnd() and config.FORMATTED_PREFIX == buf.current():
+        spacecount += 1
+        buf.delete()
+      buf.insert([".rs {}".format(spacecount)])
+      buf.advance(spacecount)
+    buf.close()
 
     for i in range(len(self.wb)):
       self.wb[i] = re.sub(r"\s+\.rs",".rs", self.wb[i])
@@ -4985,14 +5114,18 @@ class Text(Book): #{
     if len(self.wb) > 0:
       while re.match(r"▹?\.rs", self.wb[i]): # no initial vertical space
         del self.wb[0]
-    while i < len(self.wb)-1:
-      m1 = re.match(r"▹?\.rs (\d+)", self.wb[i])
-      m2 = re.match(r"▹?\.rs (\d+)", self.wb[i+1])
+    buf = LineBuffer(self.wb)
+    while buf.index() < len(buf)-1:
+      m1 = re.match(r"▹?\.rs (\d+)", buf.current())
+      m2 = re.match(r"▹?\.rs (\d+)", buf.peek(1))
       if m1 and m2:
-        self.wb[i] = ".rs {}".format(max(int(m1.group(1)),int(m2.group(1))))
-        del(self.wb[i+1])
+        buf.set(".rs {}".format(max(int(m1.group(1)),int(m2.group(1)))))
+        buf.advance()
+        buf.delete()
+        buf.retreat()
       else:
-        i += 1
+        buf.advance()
+    buf.close()
 
   # convert space requests to real (vertical) spaces
   # convert space markers to real spaces
@@ -5006,9 +5139,9 @@ class Text(Book): #{
     regexSC = re.compile(r"\[\[\/?sc\]\]")
     regexRS = re.compile(r".rs (\d+)")
 
-    i = 0
-    while i < len(self.wb):
-      l = self.wb[i]
+    buf = LineBuffer(self.wb)
+    while not buf.atEnd():
+      l = buf.current()
 
       l = regexI.sub("_", l) # italics
       l = regexB.sub("=", l) # bold
@@ -5058,11 +5191,12 @@ class Text(Book): #{
         while nlines > 0:
           t.append("")
           nlines -= 1
-        self.wb[i:i+1] = t
-        i += len(t)
+        buf.replace(1, t)
+        buf.advance(len(t))
       else:
-        self.wb[i] = l
-        i += 1
+        buf.set(l)
+        buf.advance()
+    buf.close()
 
   def headers(self, chapHead, subHead, pn, id, emittitle, nobreak, book, usingBook):
     result = []
@@ -5084,25 +5218,21 @@ class Text(Book): #{
   # TEXT: Main Logic
   def process(self):
     super().process()
-    self.processInline()
-    self.processPageNum()
-    self.stripLinks()
-    self.processDropCaps()
-    self.processDittoMarks()
-    self.preProcess()
-    self.protectInline() # should be superfluous as of 19-Sep-13
-    self.illustrations()
-    self.genToc()
+    self.step(self.processInline)
+    self.step(self.processPageNum)
+    self.step(self.processInlineTags)
+    self.step(self.preProcess)
+    self.step(self.protectInline) # should be superfluous as of 19-Sep-13
+    self.step(self.illustrations)
+    self.step(self.genToc)
     from drama import DramaText
-    DramaText(self.wb).doDrama()
-    self.markLines()
-    self.doSummary()
-    self.doIndex()
-    self.doMulticol()
-    self.removeSidenotes()
-    self.rewrap()
-    self.finalSpacing()
-    self.finalRend()
+    self.step(DramaText(self.wb).doDrama)
+    self.step(self.markLines)
+    self.step(self.doBlocks, "summary", "index", "multicol")
+    self.step(self.removeSidenotes)
+    self.step(self.rewrap)
+    self.step(self.finalSpacing)
+    self.step(self.finalRend)
 #}
 # END OF CLASS Text
 
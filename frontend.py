@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import re
+import os
+import sys
+import tempfile
+import contextlib
+import unittest
+
+import msgs
+import config
+from msgs import dprint
+
+# The FrontEnd loads the -src.txt file once per invocation, instead of once
+# for every Lint and every output format.
+#
+# Book.loadFile is split in two.  Book.commonPasses does not depend on the
+# output format, and is run once, giving a format neutral buffer.
+# Book.formatPasses is the per-format projection of that buffer: it starts
+# with the <if> conditionals, and the deprecated <I>/<B> handling, which
+# are the only things in it that depend on the format.  So two formats
+# which include exactly the same <if> blocks, and are either both text or
+# both not text, end up with the same buffer; the projection is only run
+# for the first, and the rest get a copy.
+#
+# Typically a book has no <if> blocks at all, and so the html, epub, kindle
+# and pdf books, and the html Lint, all share a single projection.
+#
+# With a build cache (cache.py), each format's projection is also kept on
+# disk, keyed by the hash of the source file, the format and the fpgen
+# version; so generating another format, or the same again after a failed
+# build, of an unchanged source skips loading it altogether, including
+# the UTF-8 check.  What was printed while loading, such as <warning>s,
+# is kept with it and shown again.
+class FrontEnd(object):
+  def __init__(self, srcfile, buildCache = None):
+    self.srcfile = srcfile
+    self.common = None
+    self.projections = {}
+    self.cache = buildCache
+
+  # Called from Book.run, instead of loadFile
+  def load(self, book):
+    if self.cache is None or int(book.debug) > 0:
+      self.loadProjection(book)
+      return
+
+    key = self.cache.key([ config.VERSION, "front end", book.gentype,
+      self.cache.hashFile(self.srcfile) ])
+    hit, value = self.cache.restore(key, [])
+    if hit:
+      dprint(1, "Loaded source for format " + book.gentype + " from the cache")
+      wb, supphd, templates, directives, output = value
+      sys.stdout.write(output)
+      self.setProjection(book, wb, supphd, templates, directives)
+      return
+
+    out = io.StringIO()
+    try:
+      with msgs.capture(out):
+        self.loadProjection(book)
+    finally:
+      sys.stdout.write(out.getvalue())
+    self.cache.store(key, [], (book.wb, book.supphd, book.userTemplates,
+      book.directives, out.getvalue()))
+
+  def loadProjection(self, book):
+    self.loadCommon(book)
+
+    key = self.projectionKey(book)
+    if key in self.projections:
+      dprint(1, "Sharing loaded source for format " + book.gentype)
+      self.setProjection(book, *self.projections[key])
+      return
+
+    book.wb = self.common[:]
+    book.step(book.formatPasses)
+    self.projections[key] = \
+      (book.wb[:], book.supphd[:], book.userTemplates[:], book.directives[:])
+
+  # The source through the common passes, with the given book, unless it
+  # has already been loaded.  With --jobs, main loads it before the
+  # FrontEnd is sent to the worker processes, so they are sent the loaded
+  # buffer, rather than each loading it again.
+  def loadCommon(self, book):
+    if self.common is None:
+      book.dprint(1, "loadFile")
+      book.step(book.loadSource, self.srcfile)
+      book.step(book.commonPasses)
+      self.common = book.wb[:]
+
+  def setProjection(self, book, wb, supphd, templates, directives):
+    book.wb = wb[:]
+    book.supphd = supphd[:]
+    book.directives = directives[:]
+    book.replayUserDefinedTemplates(templates)
+
+  # Two books with the same key get the same result from formatPasses
+  def projectionKey(self, book):
+    included = []
+    for line in self.common:
+      m = regexIf.match(line)
+      if not m:
+        continue
+      include = book.conditionalIncludes(m.group(1), book.gentype)
+      if include is None:
+        # Badly formatted, don't share, formatPasses will complain
+        return book.gentype
+      included.append(include)
+    return (book.gentype == 't', tuple(included))
+
+# Same pattern parseStandaloneTagBlock uses to find the <if> blocks
+regexIf = re.compile("<if(.*?)(/)?>")
+
+class TestFrontEnd(unittest.TestCase):
+  source = [
+    "<macro m=\"macro text\"/>",
+    "<template name='t1' type='macro'>",
+    "<l><expand word></l>",
+    "</template>",
+    "<lit section='head'>",
+    "<style>.x { }</style>",
+    "</lit>",
+    "// comment",
+    "text %m% <I>italic</I>",
+    "<pn='1'>",
+    "<heading level='1'>head</heading>",
+    "<footnote id='1'>note</footnote>",
+  ]
+
+  def setUp(self):
+    fd, self.srcfile = tempfile.mkstemp(suffix="-src.txt")
+    os.close(fd)
+
+  def tearDown(self):
+    os.remove(self.srcfile)
+    config.setContext(config.BuildContext())
+
+  def write(self, lines):
+    with open(self.srcfile, "w", encoding='utf-8') as f:
+      f.write("\n".join(lines) + "\n")
+
+  # Load each format both directly, and through one FrontEnd
+  def verify(self, formats):
+    from fpgen import Book
+    frontEnd = FrontEnd(self.srcfile)
+    for fmt in formats:
+      direct = Book(self.srcfile, None, 0, fmt)
+      direct.loadFile(self.srcfile)
+      shared = Book(self.srcfile, None, 0, fmt)
+      frontEnd.load(shared)
+      self.assertSequenceEqual(shared.wb, direct.wb)
+      self.assertSequenceEqual(shared.supphd, direct.supphd)
+      self.assertSequenceEqual(shared.userTemplates, direct.userTemplates)
+      self.assertSequenceEqual(shared.directives, direct.directives)
+      self.assertEqual(shared.templates.byType["macro"].get("t1").source,
+        direct.templates.byType["macro"].get("t1").source)
+    return frontEnd
+
+  def test_frontend_no_conditionals(self):
+    self.write(self.source)
+    frontEnd = self.verify("thekp")
+    # text, and everything else
+    self.assertEqual(len(frontEnd.projections), 2)
+
+  def test_frontend_conditionals(self):
+    self.write(self.source + [
+      "<if type='hk'>",
+      "html or kindle",
+      "</if>",
+      "<if type='!p'>",
+      "not pdf",
+      "</if>",
+    ])
+    frontEnd = self.verify("thekp")
+    # t; h&k; e; p
+    self.assertEqual(len(frontEnd.projections), 4)
+
+  def test_frontend_conditional_macro(self):
+    self.write(self.source + [
+      "<if type='t'>",
+      "<macro m=\"text macro\"/>",
+      "</if>",
+      "%m%",
+    ])
+    self.verify("th")
+
+  def test_frontend_modify_copy(self):
+    from fpgen import Book
+    self.write(self.source)
+    frontEnd = FrontEnd(self.srcfile)
+    b1 = Book(self.srcfile, None, 0, 'h')
+    frontEnd.load(b1)
+    expected = b1.wb[:]
+    b1.wb[1] = "changed"
+    b2 = Book(self.srcfile, None, 0, 'e')
+    frontEnd.load(b2)
+    self.assertSequenceEqual(b2.wb, expected)
+
+  # As sent to a worker process: loaded once here, and not again there
+  def test_frontend_load_common(self):
+    import pickle
+    from fpgen import Book
+    self.write(self.source)
+    frontEnd = FrontEnd(self.srcfile)
+    frontEnd.loadCommon(Book(self.srcfile, None, 0, 'h'))
+    expected = Book(self.srcfile, None, 0, 'e')
+    expected.loadFile(self.srcfile)
+    self.write([ "changed" ])
+    sent = pickle.loads(pickle.dumps(frontEnd))
+    book = Book(self.srcfile, None, 0, 'e')
+    sent.load(book)
+    self.assertSequenceEqual(book.wb, expected.wb)
+
+  def test_frontend_bad_conditional(self):
+    from fpgen import Book
+    self.write(self.source + [ "<if foo>", "</if>" ])
+    frontEnd = FrontEnd(self.srcfile)
+    with self.assertRaises(SystemExit) as cm:
+      frontEnd.load(Book(self.srcfile, None, 0, 'h'))
+    self.assertEqual(cm.exception.code, 1)
+
+  # A second FrontEnd, as in the next build, loads nothing at all
+  def test_frontend_disk_cache(self):
+    import cache
+    self.write(self.source + [ "<warning>careful</warning>" ])
+    with tempfile.TemporaryDirectory() as dir:
+      buildCache = cache.BuildCache(os.path.join(dir, "cache"))
+      from fpgen import Book
+      outputs = []
+      for build in range(2):
+        frontEnd = FrontEnd(self.srcfile, buildCache)
+        book = Book(self.srcfile, None, 0, 'h')
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+          frontEnd.load(book)
+        outputs.append(out.getvalue())
+        direct = Book(self.srcfile, None, 0, 'h')
+        with contextlib.redirect_stdout(io.StringIO()):
+          direct.loadFile(self.srcfile)
+        self.assertSequenceEqual(book.wb, direct.wb)
+        self.assertSequenceEqual(book.supphd, direct.supphd)
+        self.assertSequenceEqual(book.directives, direct.directives)
+        self.assertEqual(book.templates.byType["macro"].get("t1").source,
+          direct.templates.byType["macro"].get("t1").source)
+      self.assertIsNone(frontEnd.common)
+      self.assertEqual(outputs, [ "warning: careful\n" ] * 2)
+
+      # A changed source is loaded again
+      self.write(self.source)
+      frontEnd = FrontEnd(self.srcfile, buildCache)
+      frontEnd.load(Book(self.srcfile, None, 0, 'h'))
+      self.assertIsNotNone(frontEnd.common)
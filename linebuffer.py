@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+# A gap buffer over a list of lines, for passes which edit Book.wb as they
+# walk down it.  Deleting or inserting at an index of a list moves every
+# line after it, so a pass doing that all the way down a long book is
+# quadratic; here the lines before the cursor and those after are kept
+# apart, and edits at the cursor cost nothing for the rest of the book.
+#
+# The operations are those of the old loops, so a pass converts line for
+# line:
+#   self.wb[i]                    buf.current()
+#   self.wb[i+n]                  buf.peek(n)
+#   self.wb[i-n]                  buf.previous(n)
+#   i < len(self.wb)              not buf.atEnd()
+#   i += n                        buf.advance(n)
+#   i -= n                        buf.retreat(n)
+#   self.wb[i] = line             buf.set(line)
+#   del self.wb[i:i+n]            buf.delete(n)
+#   self.wb[i:i+n] = lines        buf.replace(n, lines)
+#   i                             buf.index()
+# and when the pass is done, buf.close() puts the result back in the list.
+#
+# Most passes only change a few lines; buf.seek(match) moves quickly over
+# the ones they leave alone.
+
+class LineBuffer(object):
+  def __init__(self, lines):
+    self.lines = lines
+    self.before = [] # lines before the cursor, in order
+    self.after = [] # lines inserted after the cursor, nearest last
+    self.next = 0 # the first line of self.lines not yet reached
+
+  def __len__(self):
+    return len(self.before) + len(self.after) + len(self.lines) - self.next
+
+  def index(self):
+    return len(self.before)
+
+  def atEnd(self):
+    return not self.after and self.next >= len(self.lines)
+
+  # Lines at and after the cursor; IndexError past the end, like a list
+  def peek(self, n = 0):
+    if n < len(self.after):
+      return self.after[-1-n]
+    n -= len(self.after)
+    if self.next + n >= len(self.lines):
+      raise IndexError("line buffer index out of range")
+    return self.lines[self.next + n]
+
+  def current(self):
+    if self.after:
+      return self.after[-1]
+    return self.lines[self.next]
+
+  # Lines before the cursor
+  def previous(self, n = 1):
+    return self.before[-n]
+
+  def set(self, line):
+    if self.after:
+      self.after[-1] = line
+    else:
+      self.after.append(line)
+      self.next += 1
+
+  # Remove n lines at the cursor, and return them
+  def delete(self, n = 1):
+    removed = []
+    for i in range(n):
+      if len(self.after) > 0:
+        removed.append(self.after.pop())
+      elif self.next < len(self.lines):
+        removed.append(self.lines[self.next])
+        self.next += 1
+      else:
+        break
+    return removed
+
+  # Insert lines at the cursor, which stays before them
+  def insert(self, lines):
+    self.after.extend(reversed(lines))
+
+  def replace(self, n, lines):
+    removed = self.delete(n)
+    self.insert(lines)
+    return removed
+
+  def advance(self, n = 1):
+    if n == 1:
+      # The usual case, kept quick
+      if self.after:
+        self.before.append(self.after.pop())
+      elif self.next < len(self.lines):
+        self.before.append(self.lines[self.next])
+        self.next += 1
+      return
+    self.before.extend(self.delete(n))
+
+  # Advance to the next line for which match is true; False if none is left
+  def seek(self, match):
+    while self.after:
+      if match(self.after[-1]):
+        return True
+      self.before.append(self.after.pop())
+    lines = self.lines
+    n = len(lines)
+    start = i = self.next
+    while i < n and not match(lines[i]):
+      i += 1
+    self.before.extend(lines[start:i])
+    self.next = i
+    return i < n
+
+  def retreat(self, n = 1):
+    for i in range(n):
+      self.after.append(self.before.pop())
+
+  # Put the edited lines back into the original list
+  def close(self):
+    self.before.extend(reversed(self.after))
+    self.before.extend(self.lines[self.next:])
+    self.lines[:] = self.before
+    self.before = []
+    self.after = []
+    self.next = len(self.lines)
+    return self.lines
+
+class TestLineBuffer(unittest.TestCase):
+  # Every operation, done the same way on a list with an index
+  def test_linebuffer_same_as_list(self):
+    lines = [ "a", "b", "c", "d", "e" ]
+    buf = LineBuffer(list(lines))
+    i = 0
+    buf.advance(); i += 1
+    self.assertEqual(buf.current(), lines[i])
+    self.assertEqual(buf.peek(2), lines[i+2])
+    self.assertEqual(buf.previous(), lines[i-1])
+    self.assertEqual(buf.replace(1, [ "x", "y" ]), [ "b" ])
+    lines[i:i+1] = [ "x", "y" ]
+    buf.advance(); i += 1
+    buf.set("Y"); lines[i] = "Y"
+    self.assertEqual(buf.delete(2), [ "Y", "c" ])
+    del lines[i:i+2]
+    self.assertEqual(buf.current(), lines[i])
+    buf.retreat(2); i -= 2
+    self.assertEqual(buf.current(), lines[i])
+    self.assertEqual(buf.peek(1), lines[i+1])
+    self.assertEqual((len(buf), buf.index()), (len(lines), i))
+    buf.advance(len(lines))
+    self.assertTrue(buf.atEnd())
+    self.assertEqual(buf.close(), lines)
+
+  def test_linebuffer_in_place(self):
+    lines = [ "a", "b" ]
+    buf = LineBuffer(lines)
+    buf.insert([ "0" ])
+    buf.advance(2)
+    buf.delete()
+    self.assertIs(buf.close(), lines)
+    self.assertEqual(lines, [ "0", "a" ])
+
+  def test_linebuffer_seek(self):
+    buf = LineBuffer([ "a", "<b", "c", "<d" ])
+    buf.insert([ "0", "<1" ])
+    found = []
+    while buf.seek(lambda line: line.startswith("<")):
+      found.append(buf.index())
+      buf.set(buf.current()[1:])
+      buf.advance()
+    self.assertEqual(found, [ 1, 3, 5 ])
+    self.assertEqual(buf.close(), [ "0", "1", "a", "b", "c", "d" ])
+
+  def test_linebuffer_past_end(self):
+    buf = LineBuffer([ "a" ])
+    buf.insert([ "0" ])
+    self.assertEqual(buf.peek(1), "a")
+    with self.assertRaises(IndexError):
+      buf.peek(2)
+    self.assertEqual(buf.delete(3), [ "0", "a" ])
+    self.assertTrue(buf.atEnd())
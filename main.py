@@ -4,11 +4,23 @@ import sys, os
 import unittest
 import zipfile
 import fnmatch
+import functools
+import hashlib
+import threading
+import time
 
 import config
-from fpgen import Lint, Text, HTML
-from kindle import Kindle, EPub, PDF
+import cache
+from fpgen import Lint
+from frontend import FrontEnd
+from formats import generateFormat, generateInWorker, makeBook, \
+  makePool, FORMATS
+from scheduler import Scheduler, FunctionTask, CommandTask
+from tracing import TraceRecorder
+from memprofile import MemoryProfiler
 import msgs
+import passes
+import patterns
 from msgs import fatal
 
 def main():
@@ -31,6 +43,42 @@ def main():
   parser.add_option("", "--ebookid",
       dest="ebookid", default="",
       help="Create fadedpage zip file")
+  parser.add_option("-j", "--jobs",
+      dest="jobs", type="int", default=1,
+      help="run up to N steps of the build at once")
+  parser.add_option("", "--resume",
+      action="store_true", dest="resume", default=False,
+      help="continue a failed build, skipping the steps which completed")
+  parser.add_option("", "--cache",
+      action="store_true", dest="cache", default=False,
+      help="keep the outputs of each step in the build cache in " + cache.CACHE_DIR + ", and copy them from it while its inputs are unchanged")
+  parser.add_option("", "--no-cache",
+      action="store_false", dest="cache",
+      help="do not use the build cache; the default")
+  parser.add_option("", "--unit-cache",
+      action="store_true", dest="unitCache", default=False,
+      help="with --cache, also keep each chapter of the line by line passes in the build cache, and rerun them only on the chapters which changed")
+  parser.add_option("-w", "--watch",
+      action="store_true", dest="watch", default=False,
+      help="rebuild whenever the source or an image changes, with timings")
+  parser.add_option("", "--batch",
+      action="store_true", dest="batch", default=False,
+      help="build every *-src.txt under the directories given")
+  parser.add_option("", "--summary",
+      dest="summary", default="",
+      help="--batch summary file, .json or .csv")
+  parser.add_option("", "--trace",
+      dest="trace", default="",
+      help="write a Chrome trace of every pass and build step to this file")
+  parser.add_option("", "--memprofile",
+      action="store_true", dest="memprofile", default=False,
+      help="report the memory used by each pass, and where it was allocated")
+  parser.add_option("", "--regex-stats",
+      action="store_true", dest="regexStats", default=False,
+      help="report the calls of, and time in, each regular expression of the passes")
+  parser.add_option("", "--css-minify",
+      action="store_true", dest="cssMinify", default=False,
+      help="write the style block of the HTML formats on one line, without comments")
   (options, args) = parser.parse_args()
 
   print("fpgen {}".format(config.VERSION))
@@ -46,6 +94,20 @@ def main():
         TestTextFormatLineGroup
     from footnote import TestFootnote
     from template import TestTemplate
+    from frontend import TestFrontEnd
+    from formats import TestFormats
+    from scheduler import TestScheduler
+    from cache import TestBuildCache
+    from passes import TestPasses
+    from batch import TestBatch
+    from tracing import TestTracing
+    from memprofile import TestMemProfile
+    from benchmark import TestBenchmark
+    from parsebench import TestParseBench
+    from linebuffer import TestLineBuffer
+    from patterns import TestPatterns
+    from units import TestUnits
+    from stylesheet import TestStylesheet
     from testhtml import TestHTMLPara
     from testother import TestBookVarious
     for cl in [
@@ -53,7 +115,10 @@ def main():
       TestParseTagAttributes, TestOneDramaBlockMethod, TestTextRewrap,
       TestTextInline, TestTableCellFormat, TestTemplate, TestFootnote,
       TestHTMLPara, TestTextoneL, TestTextFormatLineGroup,
-      TestBookVarious
+      TestBookVarious, TestFrontEnd, TestFormats, TestScheduler,
+      TestBuildCache, TestPasses, TestBatch, TestTracing, TestMemProfile,
+      TestBenchmark, TestParseBench, TestLineBuffer, TestPatterns,
+      TestUnits, TestStylesheet
     ]:
       tests.append(l.loadTestsFromTestCase(cl))
     tests = l.suiteClass(tests)
@@ -65,6 +130,9 @@ def main():
     if not re.match("^20[012]\d[01]\d[0-9a-zA-Z][0-9a-zA-Z]$", options.ebookid):
       fatal("Ebookid doesn't look correct: " + options.ebookid)
 
+  if options.jobs < 1:
+    fatal("--jobs must be at least 1: " + str(options.jobs))
+
   tmp = options.formats
   tmp = re.sub('a|h|t|k|e|p', '', tmp)
   if not tmp == '':
@@ -74,6 +142,14 @@ def main():
   if options.formats == 'a':
     options.formats = "htpek"
 
+  # Positional arguments are directories
+  if options.batch:
+    if options.infile != '' or options.ebookid != '' or options.watch:
+      fatal("--batch is incompatible with -i/--infile, --ebookid and --watch")
+    from batch import runBatch
+    runBatch(options, args if len(args) > 0 else [ "." ])
+    return
+
   # Can either use -i file, or just file.
   if len(args) > 1:
     fatal("Too many positional options")
@@ -103,38 +179,99 @@ def main():
   else:
     input = m.group(1)
 
+  if options.watch:
+    watch(options, input)
+    return
+
   try:
     processFile(options, input)
   except FileNotFoundError:
     fatal(options.infile + ": File not found")
 
-def getConvertArgs(modelArgs, infile, outfile, hb):
+# How often --watch looks for changes, in seconds
+WATCH_INTERVAL = 0.25
+
+# What --watch looks at: the source, and everything in images
+def watchedFiles(infile):
+  files = {}
+  for dir, subdirs, names in os.walk("images"):
+    for name in names:
+      files[os.path.join(dir, name)] = None
+  files[infile] = None
+  for file in files:
+    try:
+      st = os.stat(file)
+      files[file] = (st.st_mtime_ns, st.st_size)
+    except OSError:
+      pass
+  return files
+
+# Build, then build again each time the source or an image changes.
+# Everything stays loaded in this process, so only the first build pays
+# for starting up.  Each build shows how long every pass took.
+def watch(options, bn):
+  try:
+    while True:
+      timer = passes.addListener(passes.PassTimer())
+      start = time.time()
+      try:
+        processFile(options, bn)
+      except FileNotFoundError:
+        msgs.cprint(options.infile + ": File not found")
+      except SystemExit:
+        # fatal has said what is wrong; wait for it to be fixed
+        pass
+      finally:
+        passes.removeListener(timer)
+      timer.report(msgs.cprint)
+      msgs.cprint("Built in {:.2f}s; watching {} and images for changes".format(
+        time.time() - start, options.infile))
+
+      # Taken after the build, since it can write into images (fonts)
+      files = watchedFiles(options.infile)
+      while True:
+        time.sleep(WATCH_INTERVAL)
+        changed = watchedFiles(options.infile)
+        if changed != files:
+          break
+      # Wait until the editor has finished writing
+      while True:
+        time.sleep(WATCH_INTERVAL)
+        files = watchedFiles(options.infile)
+        if files == changed:
+          break
+        changed = files
+  except KeyboardInterrupt:
+    print("")
+
+def getConvertArgs(modelArgs, infile, outfile, result):
+  uopt = result.uopt
   args = []
   args.append("ebook-convert")
   args.append(infile)
   args.append(outfile)
-  if config.pn_cover != "":
+  if result.pnCover != "":
     args.append("--cover")
-    args.append(config.pn_cover)
+    args.append(result.pnCover)
 
-  fonts = hb.getFonts()
+  fonts = result.getFonts()
   if len(fonts) > 0:
     args.append("--embed-all-fonts")
 
   args.extend(OPT_COMMON_ARGS)
   args.extend(modelArgs)
 
-  if config.uopt.getopt('preserve-line-height', 'false') == 'true':
+  if uopt.getopt('preserve-line-height', 'false') == 'true':
     args.append("--minimum-line-height")
     args.append("0")
 
-  extra = config.uopt.getopt('extra-css')
+  extra = uopt.getopt('extra-css')
   if extra:
     args.append("--extra-css")
     args.append("\"" + extra + "\"")
 
   # Normally have two levels of TOC, but allow for none, one or three
-  tocLevels = config.uopt.getopt('toc-levels', '2')
+  tocLevels = uopt.getopt('toc-levels', '2')
   try:
     tocLevels = int(tocLevels)
   except Exception:
@@ -153,140 +290,295 @@ def getConvertArgs(modelArgs, infile, outfile, hb):
     args.append(extra)
   return args
 
-def processFile(options, bn):
+# The ebook-convert command lines.  They are built when the conversion
+# starts, from the result of generating the format being converted.
+
+def epubCommand(result, bn):
+  uopt = result.uopt
+  preserveMargins = (uopt.getopt('preserve-margins', 'false') == 'true')
+  args = getConvertArgs(OPT_EPUB_ARGS, result.outfile, "{}.epub".format(bn), result)
+
+  if uopt.getopt('epub-margin-left') != "": # added 27-Mar-2014
+    args.append("--margin-left")
+    args.append("{}".format(uopt.getopt('epub-margin-left')))
+  elif preserveMargins:
+    args.append("--margin-left -1")
+
+  if uopt.getopt('epub-margin-right') != "": # added 27-Mar-2014
+    args.append("--margin-right")
+    args.append("{}".format(uopt.getopt('epub-margin-right')))
+  elif preserveMargins:
+    args.append("--margin-right -1")
+
+  # call(OPT_EPUB_ARGS, shell=False)
+  js = " ".join(args)
+  msgs.dprint(1, js)
+  return js
+
+def kindleCommand(result, bn):
+  # make epub as source for kindle
+  preserveMargins = (result.uopt.getopt('preserve-margins', 'false') == 'true')
+  args = getConvertArgs(OPT_EPUB_ARGS, result.outfile, "{}-k.epub".format(bn), result)
+  if preserveMargins:
+    args.extend(OPT_PRESERVE_MARGINS)
+
+  # call(OPT_EPUB_ARGS, shell=False)
+  js = " ".join(args)
+  msgs.dprint(1, js)
+  return js
+
+def kindlegenCommand(bn):
+  # generate mobi with Kindlegen based on epub made by ebook-convert
+  # os.system("kindlegen {0}-k.html -o {0}.mobi".format(bn))
+  js = "kindlegen {0}-k.epub -o {0}.mobi".format(bn)
+  msgs.dprint(1, js)
+  return js
+
+def pdfCommand(result, bn):
+  uopt = result.uopt
+  preserveMargins = (uopt.getopt('preserve-margins', 'false') == 'true')
+  args = getConvertArgs(OPT_PDF_ARGS, result.outfile, "{}-a5.pdf".format(bn), result)
+
+  if preserveMargins:
+    args.extend(OPT_PRESERVE_MARGINS)
+    args.append('--pdf-default-font-size')
+    args.append(uopt.getopt('pdf-default-font-size', "13"))
+  else:
+    args.extend(OPT_PDF_ARGS_RL)
+    # fpgen option -> [ebook-convert option, value]
+    for k,v in PDF_CONFIG_OPTS.items():
+      args.append(v[0])
+      args.append(uopt.getopt(k, v[1]))
+
+  extra = os.environ.get('FPGEN_EBOOK_CONVERT_EXTRA_ARGS_PDF')
+  if extra:
+    print("Extra pdf conversion args: " + extra)
+    args.append(extra)
+
+  # call(OPT_PDF_ARGS, shell=False)
+  js = " ".join(args)
+
+  msgs.dprint(0, js)
+  return js
+
+# Create a zip file with the ebook id, and all the output formats
+# appropriately named
+def writeZip(epubid, bn):
+  zipname = epubid + ".zip"
+  print("Writing zip file " + zipname)
+  zip = zipfile.ZipFile(zipname, "w", compression = zipfile.ZIP_DEFLATED)
+  print("Adding " + bn + "-src.txt")
+  zip.write(bn + "-src.txt")
+  for suffix in [ ".txt", ".html", ".mobi", ".epub", "-k.epub", "-a5.pdf" ]:
+    src = bn + suffix
+    target = epubid + suffix
+    print("Adding " + src + " as " + target)
+    zip.write(src, target)
+  for dir, subdirs, files in os.walk("images"):
+    for file in files:
+      image = dir + "/" + file
+      print("Adding image: " + image)
+      zip.write(image)
+  zip.close()
+
+# A state file from a different source, version or set of options is
+# not resumed from
+def buildSignature(options):
+  with open(options.infile, "rb") as f:
+    source = hashlib.sha256(f.read()).hexdigest()
+  return (config.VERSION, source, options.formats, options.saveint,
+    options.ebookid, options.cssMinify)
+
+# The images a file refers to, which the outputs made from it depend on
+def referencedImages(filename, extra = []):
+  with open(filename, "r", encoding='utf-8', errors='replace') as f:
+    images = set(re.findall("images/[^'\"\\s<>()]+", f.read()))
+  images.update(e for e in extra if e)
+  return sorted(images)
+
+# The build is a graph of tasks: lint, then generate each format, then
+# run the converters on the generated file, then the zip.  Independent
+# tasks run at the same time with --jobs; with one job they run in the
+# order added here.  Returns the Scheduler, whose tasks say how each
+# step went.
+def build(options, bn):
+
+  # With --cache, a step whose inputs are unchanged since it was last run
+  # is not run; its outputs are copied from the cache
+  buildCache = None
+  if options.cache:
+    buildCache = cache.BuildCache(
+      volatile = re.compile(b"<!-- created with fpgen.py .* on .* -->"))
+
+  # The source is loaded once, and shared by every Lint and format; and
+  # with the cache, not at all while it is unchanged
+  frontEnd = FrontEnd(options.infile, buildCache)
+
+  scheduler = Scheduler(options.jobs, "{}-fpgen.state".format(bn),
+    buildSignature(options))
 
   # run Lint for every format specified
   # user may have included conditional code blocks
+  # Each Lint prints what it finds, so the second waits for the first
+  lints = []
   if 't' in options.formats:
     lint = Lint(options.infile, "", options.debug, 't')
-    lint.run()
+    lints.append(scheduler.add(FunctionTask("lint text",
+      functools.partial(lint.run, frontEnd), deps=lints)))
   # all HTML derivatives
   if re.search('h|k|e|p', options.formats):
     lint = Lint(options.infile, "", options.debug, 'h')
-    lint.run()
-
-  # generate desired output formats
+    lints.append(scheduler.add(FunctionTask("lint html",
+      functools.partial(lint.run, frontEnd), deps=lints)))
+
+  # generate desired output formats, in a pool of processes with --jobs.
+  # Not with --watch: new workers would pay for starting up on every build,
+  # and the pass timings are collected here; nor --memprofile or
+  # --regex-stats, which measure this process.
+  pool = None
+  if options.jobs > 1 and not options.watch and not options.memprofile \
+      and not options.regexStats:
+    pool = makePool(options.jobs)
+
+  # --trace records passes run here through the pass listener; those
+  # run in a worker come back with the result
+  recorder = None
+  if options.trace:
+    recorder = TraceRecorder()
+    passes.addListener(recorder)
+    scheduler.listeners.append(recorder)
+
+  profiler = None
+  if options.memprofile:
+    profiler = MemoryProfiler()
+    passes.addListener(profiler)
+    profiler.start()
+
+  if options.regexStats:
+    patterns.reset()
+    patterns.count()
+
+  # Each book has its own context, but what books generated at once in
+  # this process print would be interleaved, and passes.listeners, such
+  # as --watch's timer, expect one book at a time; so one at a time
+  lock = threading.Lock()
+  # Only with --unit-cache: it writes every chapter of every format to
+  # the cache, which most builds would not use
+  unitCache = options.cache and options.unitCache
+  # The workers are sent the source already through the common passes, so
+  # none of them loads it again; the first format sent loads it here
+  commonLock = threading.Lock()
+  def generate(fmt):
+    args = (fmt, options.infile, bn, options.debug, frontEnd)
+    if pool is None:
+      with lock:
+        return generateFormat(*args, unitCache=unitCache,
+          cssMinify=options.cssMinify)
+    with commonLock:
+      if frontEnd.common is None:
+        frontEnd.loadCommon(makeBook(fmt, options.infile, "", options.debug))
+    result = pool.submit(generateInWorker, *args, recorder is not None,
+      unitCache, options.cssMinify).result()
+    sys.stdout.write(result.output)
+    result.output = ""
+    if recorder:
+      recorder.merge(result.events)
+      result.events = []
+    return result
+
+  # The source, and its <option>s and <property>s, are the input
+  def addGenerate(fmt, outputs, temporaries = []):
+    outfile = FORMATS[fmt][0].format(bn)
+    task = scheduler.add(FunctionTask(outfile,
+      functools.partial(generate, fmt), deps=lints, outputs=outputs,
+      inputs=[options.infile], temporaries=temporaries))
+    task.group = fmt
+    if buildCache:
+      task.setCache(buildCache, [ config.VERSION, fmt,
+        str(options.cssMinify), str(options.debug) ],
+        lambda: referencedImages(options.infile, [ "images/cover.jpg" ]))
+    return task
+
+  # Cached by the generated file, and the ebook-convert command line
+  def addConvert(gen, outfile, command):
+    task = scheduler.add(CommandTask(outfile,
+      lambda: command(gen.result, bn), deps=[gen], outputs=[outfile],
+      inputs=[gen.name]))
+    task.group = gen.group
+    if buildCache:
+      task.setCache(buildCache, [ config.VERSION ],
+        lambda: referencedImages(gen.name, [ gen.result.pnCover ]))
+    return task
+
+  # The generated file is only an input to the converter
+  def addRemove(gen, after):
+    if not options.saveint:
+      task = scheduler.add(FunctionTask("remove " + gen.name,
+        functools.partial(os.remove, gen.name), deps=[after]))
+      task.group = gen.group
 
   if 't' in options.formats:
-    outfile = "{}.txt".format(bn)
-    tb = Text(options.infile, outfile, options.debug, 't')
-    print("creating UTF-8 text")
-    tb.run()
+    addGenerate('t', [ "{}.txt".format(bn) ])
 
   if 'h' in options.formats:
-    outfile = "{}.html".format(bn)
-    hb = HTML(options.infile, outfile, options.debug, 'h')
-    print("creating HTML")
-    hb.run()
+    addGenerate('h', [ "{}.html".format(bn) ])
 
-  madeEpub = False
   if 'e' in options.formats:
-    outfile = "{}-e.html".format(bn)
-    hb = EPub(options.infile, outfile, options.debug)
-    print("creating Epub")
-    hb.run()
-
-    preserveMargins = (config.uopt.getopt('preserve-margins', 'false') == 'true')
-    args = getConvertArgs(OPT_EPUB_ARGS, outfile, "{}.epub".format(bn), hb)
-
-    if config.uopt.getopt('epub-margin-left') != "": # added 27-Mar-2014
-      args.append("--margin-left")
-      args.append("{}".format(config.uopt.getopt('epub-margin-left')))
-    elif preserveMargins:
-      args.append("--margin-left -1")
-
-    if config.uopt.getopt('epub-margin-right') != "": # added 27-Mar-2014
-      args.append("--margin-right")
-      args.append("{}".format(config.uopt.getopt('epub-margin-right')))
-    elif preserveMargins:
-      args.append("--margin-right -1")
-
-    # call(OPT_EPUB_ARGS, shell=False)
-    js = " ".join(args)
-    msgs.dprint(1, js)
-    os.system(js)
-
-    if not options.saveint:
-      os.remove(outfile)
-    madeEpub = True
+    gen = addGenerate('e', [], [ "{}-e.html".format(bn) ])
+    epub = addConvert(gen, "{}.epub".format(bn), epubCommand)
+    addRemove(gen, epub)
 
   if 'k' in options.formats:
-    print("creating Kindle (.mobi & -k.epub)")
-    # make epub as source for kindle
-    outfile = "{}-e2.html".format(bn)
-    hb = Kindle(options.infile, outfile, options.debug)
-    hb.run()
-    preserveMargins = (config.uopt.getopt('preserve-margins', 'false') == 'true')
-    args = getConvertArgs(OPT_EPUB_ARGS, outfile, "{}-k.epub".format(bn), hb)
-    if preserveMargins:
-      args.extend(OPT_PRESERVE_MARGINS)
-
-    # call(OPT_EPUB_ARGS, shell=False)
-    js = " ".join(args)
-    msgs.dprint(1, js)
-    os.system(js)
-
-    # generate mobi with Kindlegen based on epub made by ebook-convert
-    # os.system("kindlegen {0}-k.html -o {0}.mobi".format(bn))
-    msgs.dprint(1, "kindlegen {0}-k.epub -o {0}.mobi".format(bn))
-    os.system("kindlegen {0}-k.epub -o {0}.mobi".format(bn))
-
-    if not options.saveint:
-      os.remove("{0}-e2.html".format(bn))
+    gen = addGenerate('k', [], [ "{}-e2.html".format(bn) ])
+    epub = addConvert(gen, "{}-k.epub".format(bn), kindleCommand)
+    # kindlegen exits with 1 when there are only warnings
+    mobi = scheduler.add(CommandTask("{}.mobi".format(bn),
+      functools.partial(kindlegenCommand, bn), deps=[epub],
+      outputs=[ "{}.mobi".format(bn) ], inputs=[epub.name], okCodes=[0, 1]))
+    mobi.group = 'k'
+    if buildCache:
+      mobi.setCache(buildCache, [ config.VERSION ])
+    addRemove(gen, mobi)
 
   if 'p' in options.formats:
-    outfile = "{}-p.html".format(bn)
-    hb = PDF(options.infile, outfile, options.debug)
-    print("creating PDF")
-    hb.run()
-    preserveMargins = (config.uopt.getopt('preserve-margins', 'false') == 'true')
-    args = getConvertArgs(OPT_PDF_ARGS, outfile, "{}-a5.pdf".format(bn), hb)
-
-    if preserveMargins:
-      args.extend(OPT_PRESERVE_MARGINS)
-      args.append('--pdf-default-font-size')
-      args.append(config.uopt.getopt('pdf-default-font-size', "13"))
-    else:
-      args.extend(OPT_PDF_ARGS_RL)
-      # fpgen option -> [ebook-convert option, value]
-      for k,v in PDF_CONFIG_OPTS.items():
-        args.append(v[0])
-        args.append(config.uopt.getopt(k, v[1]))
-
-    extra = os.environ.get('FPGEN_EBOOK_CONVERT_EXTRA_ARGS_PDF')
-    if extra:
-      print("Extra pdf conversion args: " + extra)
-      args.append(extra)
+    gen = addGenerate('p', [], [ "{}-p.html".format(bn) ])
+    pdf = addConvert(gen, "{}-a5.pdf".format(bn), pdfCommand)
+    addRemove(gen, pdf)
 
-    # call(OPT_PDF_ARGS, shell=False)
-    js = " ".join(args)
-
-    msgs.dprint(0, js)
-    os.system(js)
+  if options.ebookid != "":
+    zipname = options.ebookid + ".zip"
+    scheduler.add(FunctionTask(zipname,
+      functools.partial(writeZip, options.ebookid, bn),
+      deps=scheduler.tasks[:], outputs=[zipname]))
 
-    if not options.saveint:
-      os.remove(outfile)
+  try:
+    scheduler.run(options.resume)
+  finally:
+    if pool is not None:
+      pool.shutdown()
+    if buildCache:
+      buildCache.evict()
+    if recorder:
+      passes.removeListener(recorder)
+      recorder.save(options.trace)
+      msgs.cprint("Trace written to " + options.trace)
+    if profiler:
+      passes.removeListener(profiler)
+      profiler.stop()
+      profiler.report(msgs.cprint)
+    if options.regexStats:
+      patterns.count(False)
+      patterns.report(msgs.cprint)
+  return scheduler
 
-  # Create a zip file with the ebook id, and all the output formats
-  # appropriately named
-  if options.ebookid != "":
-    epubid = options.ebookid
-    zipname = epubid + ".zip"
-    print("Writing zip file " + zipname)
-    zip = zipfile.ZipFile(zipname, "w", compression = zipfile.ZIP_DEFLATED)
-    print("Adding " + bn + "-src.txt")
-    zip.write(bn + "-src.txt")
-    for suffix in [ ".txt", ".html", ".mobi", ".epub", "-k.epub", "-a5.pdf" ]:
-      src = bn + suffix
-      target = epubid + suffix
-      print("Adding " + src + " as " + target)
-      zip.write(src, target)
-    for dir, subdirs, files in os.walk("images"):
-      for file in files:
-        image = dir + "/" + file
-        print("Adding image: " + image)
-        zip.write(image)
-    zip.close()
+def processFile(options, bn):
+  scheduler = build(options, bn)
+  failed = [ task for task in scheduler.tasks if task.status == "failed" ]
+  if len(failed) > 0:
+    message = "Failed: " + ", ".join(task.name for task in failed)
+    if not options.watch:
+      message += "; use --resume to continue from where this build stopped"
+    fatal(message)
 
 # set defaults
 #  --remove-paragraph-spacing removed
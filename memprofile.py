@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import linecache
+import tracemalloc
+import unittest
+
+import passes
+
+# --memprofile: the memory used by each pass of each Book, from tracemalloc.
+# For every pass, the peak traced memory while it ran, and the memory it
+# allocated and did not free (retained); with the source lines which
+# retained the most.  At the end, the lines holding the most memory,
+# over the whole build.
+#
+# tracemalloc only has one peak, so when a pass starts inside another, the
+# peak so far is saved in the outer one, and the inner one's peak added
+# back when it ends.
+#
+# The snapshot taken as each pass starts, to find the lines which
+# allocated during it, is itself traced memory; its size is taken off
+# everything measured while it is held.
+
+# How many source lines are shown for each pass, and for the whole build
+TOP_LINES = 3
+TOP_LINES_BUILD = 10
+
+class PassMemory(object):
+  def __init__(self, book, name, depth):
+    self.book = book
+    self.name = name
+    self.depth = depth
+    self.start = 0
+    self.peak = 0
+    self.retained = 0
+    self.lines = []
+    self.snapshot = None
+    self.overhead = 0
+
+def takeSnapshot():
+  return tracemalloc.take_snapshot().filter_traces([
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, linecache.__file__),
+  ])
+
+class MemoryProfiler(passes.PassListener):
+  def __init__(self):
+    self.entries = []
+    self.open = []
+    self.overhead = 0 # size of the snapshots held
+
+  def start(self):
+    tracemalloc.start()
+
+  def stop(self):
+    self.final = takeSnapshot()
+    tracemalloc.stop()
+
+  # Current and peak, less the snapshots
+  def traced(self):
+    current, peak = tracemalloc.get_traced_memory()
+    return current - self.overhead, peak - self.overhead
+
+  def begin(self, book, name):
+    current, peak = self.traced()
+    if len(self.open) > 0:
+      outer = self.open[-1]
+      outer.peak = max(outer.peak, peak)
+    entry = PassMemory(passes.bookName(book), name, len(self.open))
+    entry.snapshot = takeSnapshot()
+    entry.overhead = tracemalloc.get_traced_memory()[0] - self.overhead - current
+    self.overhead += entry.overhead
+    entry.start = current
+    entry.peak = current
+    tracemalloc.reset_peak()
+    self.entries.append(entry)
+    self.open.append(entry)
+
+  def end(self, book, name):
+    entry = self.open.pop()
+    current, peak = self.traced()
+    entry.peak = max(entry.peak, peak)
+    entry.retained = current - entry.start
+    diff = takeSnapshot().compare_to(entry.snapshot, 'lineno')
+    entry.lines = [ (str(d.traceback[0]), d.size_diff)
+      for d in diff[:TOP_LINES] if d.size_diff > 0 ]
+    diff = None
+    entry.snapshot = None
+    self.overhead -= entry.overhead
+    tracemalloc.reset_peak()
+    if len(self.open) > 0:
+      outer = self.open[-1]
+      outer.peak = max(outer.peak, entry.peak)
+
+  def report(self, out = print):
+    out("Memory by pass, KB: peak while running, and retained after")
+    book = None
+    for e in self.entries:
+      if e.book != book:
+        book = e.book
+        peak = max(x.peak for x in self.entries
+          if x.book == book and x.depth == 0)
+        out("{}: peak {:.1f}KB".format(book, peak / 1024))
+      out("{:<40} {:10.1f} {:10.1f}".format("  " * (e.depth+1) + e.name,
+        e.peak / 1024, e.retained / 1024))
+      for line, size in e.lines:
+        out("{:<40} {:>21}  {}".format("", "+{:.1f}".format(size / 1024),
+          line))
+    if hasattr(self, "final"):
+      out("Memory still held at the end, KB, by source line")
+      for stat in self.final.statistics('lineno')[:TOP_LINES_BUILD]:
+        out("{:10.1f}  {}".format(stat.size / 1024, stat.traceback[0]))
+
+class TestMemProfile(unittest.TestCase):
+  def setUp(self):
+    from fpgen import Book
+    self.book = Book("x-src.txt", "x.html", 0, 'h')
+    self.profiler = passes.addListener(MemoryProfiler())
+    self.profiler.start()
+
+  def tearDown(self):
+    passes.removeListener(self.profiler)
+    if tracemalloc.is_tracing():
+      tracemalloc.stop()
+    import config
+    config.setContext(config.BuildContext())
+
+  def test_memprofile_retained(self):
+    kept = []
+    def keep():
+      kept.append([ str(i) for i in range(10000) ])
+    self.book.step(keep)
+    e = self.profiler.entries[0]
+    self.assertGreater(e.retained, 10000 * 40)
+    self.assertGreaterEqual(e.peak - e.start, e.retained)
+    self.assertIn("memprofile.py", e.lines[0][0])
+
+  def test_memprofile_peak(self):
+    def temporary():
+      x = [ str(i) for i in range(10000) ]
+      return len(x)
+    self.book.step(temporary)
+    e = self.profiler.entries[0]
+    self.assertLess(e.retained, 10000)
+    self.assertGreater(e.peak - e.start, 10000 * 40)
+
+  def test_memprofile_nested(self):
+    def inner():
+      x = [ str(i) for i in range(10000) ]
+      return len(x)
+    def outer():
+      self.book.step(inner)
+      return len([ 1 ])
+    self.book.step(outer)
+    o, i = self.profiler.entries
+    self.assertEqual((o.depth, i.depth), (0, 1))
+    self.assertGreaterEqual(o.peak, i.peak)
+    self.assertGreater(o.peak - o.start, 10000 * 40)
+
+  def test_memprofile_report(self):
+    self.book.step(lambda: [ 1 ] * 10)
+    self.profiler.stop()
+    lines = []
+    self.profiler.report(lines.append)
+    self.assertTrue(lines[1].startswith("Book x.html: peak"))
+    self.assertTrue(lines[2].startswith("  <lambda>"))
@@ -3,6 +3,8 @@
 
 import sys
 import re
+import threading
+import contextlib
 
 # safe print of possible UTF-8 character strings on ISO-8859 terminal
 def cprint(s, end=None):
@@ -29,17 +31,62 @@ def fatal(message):
   sys.stderr.write("fatal: " + message + "\n")
   exit(1)
 
-warningTag = {}
-
 def wprint(tag, message, end=None):
   if giveWarning(tag):
     cprint(message, end=end)
 
+# The suppressed warnings are those of the current build; see config.py
 def setWarnings(tagList):
+  from config import context
   tags = tagList.split()
   for tag in tags:
-    warningTag[tag] = False
+    context().warnings[tag] = False
 
 # Give a warning if tag is **not** in the list of suppressed warnings
 def giveWarning(tag):
-  return tag not in warningTag
+  from config import context
+  return tag not in context().warnings
+
+# What this thread prints while in the block goes to out, instead of to
+# sys.stdout; what other threads print does not.  While any thread is
+# capturing, sys.stdout is a ThreadStdout, which sends what is written to
+# the capturing thread's out, or to the stdout it replaced.
+class ThreadStdout(object):
+  def __init__(self, stdout):
+    self.stdout = stdout
+    self.local = threading.local()
+    self.captures = 0
+
+  def out(self):
+    outs = getattr(self.local, "outs", None)
+    return outs[-1] if outs else self.stdout
+
+  def write(self, s):
+    return self.out().write(s)
+
+  def flush(self):
+    self.out().flush()
+
+  def __getattr__(self, name):
+    return getattr(self.out(), name)
+
+captureLock = threading.Lock()
+
+@contextlib.contextmanager
+def capture(out):
+  with captureLock:
+    stdout = sys.stdout
+    if not isinstance(stdout, ThreadStdout):
+      stdout = sys.stdout = ThreadStdout(stdout)
+    stdout.captures += 1
+  if not hasattr(stdout.local, "outs"):
+    stdout.local.outs = []
+  stdout.local.outs.append(out)
+  try:
+    yield out
+  finally:
+    stdout.local.outs.pop()
+    with captureLock:
+      stdout.captures -= 1
+      if stdout.captures == 0 and sys.stdout is stdout:
+        sys.stdout = stdout.stdout
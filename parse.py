@@ -5,6 +5,8 @@ import unittest
 import re
 import sys
 import collections
+import functools
+import types
 from msgs import fatal, cprint
 
 # parseEmbeddedTagWithoutContent: (e.g. <fn>, <target>)
@@ -16,6 +18,9 @@ from msgs import fatal, cprint
 # parseStandaloneSingleLineTagWithContent: (e.g. <heading>)
 #   <tag arg>content</tag>
 #
+# parseEmbeddedTags: several of the embedded tags at once, in one scan
+#   text<tag1 arg>text<tag2 arg>content</tag2>text
+#
 # parseEmbeddedTagBlock:
 #   text<tag>...\n...</tag>text
 #
@@ -38,24 +43,19 @@ def _parseEmbeddedTagWithoutContent(line, tag, function):
     startTagOff = line.find(startTag, off)
     if startTagOff == -1:
       return line
-    s = list(line)
-    s.append('\0')
     startArg = startTagOff + startLen
-    c = s[startArg]
-    i = startArg
+    c = line[startArg:startArg+1]
     if c != '>' and c != ' ' and c != '/':
       # Nope, not really this tag
-      off = i
+      off = startArg
       continue
     # Look for end of arg
-    while s[i] != '>' and s[i] != '\0':
-      i += 1
-    if s[i] == '\0':
+    i = line.find('>', startArg)
+    if i == -1:
       # Again, not really this tag?  <tag xxx without closing greater...
-      off = i
-      continue
+      return line
     startTagEnd = i+1
-    endArgOff = i-1 if s[i-1] == '/' else i
+    endArgOff = i-1 if line[i-1] == '/' else i
 
     arg = line[startArg:endArgOff].strip()
     repl = function(arg, origLine)
@@ -84,23 +84,19 @@ def _parseEmbeddedSingleLineTagWithContent(line, tag, function, wholeLine = Fals
       if endTag in line:
         fatal("Found closing tag " + endTag + " without open tag: " + line)
       return line
-    s = list(line)
-    s.append('\0')
     startArg = startTagOff + startLen
-    c = s[startArg]
-    i = startArg
+    c = line[startArg:startArg+1]
     if c != '>' and c != ' ':
       # Nope, not really this tag
-      off = i
+      off = startArg
       continue
     # Look for end of arg
-    while s[i] != '>' and s[i] != '\0':
-      i += 1
-    if s[i] == '\0':
+    i = line.find('>', startArg)
+    if i == -1:
       # Again, not really this tag?  <tag xxx without closing greater...
-      off = i
+      off = len(line)
       continue
-    if s[i-1] == '/':
+    if line[i-1] == '/':
       fatal("Open tag " + tag + " is marked for close; this tag requires an open and close tag, with text between: " + line)
     arg = line[startArg:i].strip()
     startContent = i+1
@@ -121,6 +117,108 @@ def _parseEmbeddedSingleLineTagWithContent(line, tag, function, wholeLine = Fals
           ">: This tag must be alone on the line. Line: " + origLine +
           " >>>" + leftPart + "<<<>>>" + rightPart + "<<<")
 
+# The embedded tags of several passes, found in a single scan of each
+# line.  handlers is a list of (tag, function, withContent), in the order
+# the passes would have run: a tag withContent is handled as by
+# parseEmbeddedSingleLineTagWithContent, its function called as
+# function(arg, content, line); one without, as by
+# parseEmbeddedTagWithoutContent, function(arg, line).
+#
+# The result is the same as running the passes one after the other.  All
+# the tag names go into one regular expression, and each line is scanned
+# once, left to right; what is inside a tag's content has been through the
+# handlers before it when its function gets it, and its replacement goes
+# through the handlers after it.
+def parseEmbeddedTags(block, handlers):
+  scanner = EmbeddedTags(handlers)
+  for i,line in enumerate(block):
+    block[i] = scanner.parseLine(line)
+  return block
+
+class EmbeddedTags(object):
+  def __init__(self, handlers):
+    self.handlers = handlers
+    self.index = {}
+    for k, (tag, function, withContent) in enumerate(handlers):
+      self.index[tag] = k
+    self.regexes = {}
+
+  # The regex for the tags of handlers[lo:hi]; group 1 is the tag, and
+  # group 2 the character after it
+  def regex(self, lo, hi):
+    key = (lo, hi)
+    if key not in self.regexes:
+      tags = sorted([ handler[0] for handler in self.handlers[lo:hi] ],
+        key = len, reverse = True)
+      self.regexes[key] = re.compile("<(" +
+        "|".join(re.escape(tag) for tag in tags) + ")([ >/])")
+    return self.regexes[key]
+
+  def parseLine(self, line):
+    if not "<" in line:
+      return line
+    result = self.scan(line, 0, len(self.handlers), line)
+    for tag, function, withContent in self.handlers:
+      endTag = "</" + tag + ">"
+      if withContent and endTag in result:
+        fatal("Found closing tag " + endTag + " without open tag: " + result)
+    return result
+
+  def scan(self, line, lo, hi, origLine):
+    if lo >= hi or not "<" in line:
+      return line
+    regex = self.regex(lo, hi)
+    parts = []
+    copied = 0 # line[:copied] is in parts
+    off = 0
+    while True:
+      m = regex.search(line, off)
+      if not m:
+        break
+      tag, c = m.groups()
+      k = self.index[tag]
+      function, withContent = self.handlers[k][1], self.handlers[k][2]
+      startArg = m.end(1)
+      if withContent and c == '/':
+        # Nope, not really this tag
+        off = startArg
+        continue
+      # Look for end of arg
+      i = line.find('>', startArg)
+      if i == -1:
+        # Not really a tag, nor anything after it
+        break
+
+      if withContent:
+        if line[i-1] == '/':
+          fatal("Open tag " + tag + " is marked for close; this tag requires an open and close tag, with text between: " + line)
+        arg = line[startArg:i].strip()
+        endTag = "</" + tag + ">"
+        endTagOff = line.find(endTag, i+1)
+        if endTagOff == -1:
+          fatal("Open tag " + tag + " found, no closing tag: " + line)
+        content = line[i+1:endTagOff]
+        if k > lo:
+          content = self.scan(content, lo, k, origLine)
+        repl = function(arg, content, origLine)
+        off = endTagOff + len(endTag)
+      else:
+        endArgOff = i-1 if line[i-1] == '/' else i
+        arg = line[startArg:endArgOff].strip()
+        repl = function(arg, origLine)
+        off = i+1
+
+      parts.append(line[copied:m.start(0)])
+      if k+1 < hi:
+        repl = self.scan(repl, k+1, hi, origLine)
+      parts.append(repl)
+      copied = off
+
+    if copied == 0:
+      return line
+    parts.append(line[copied:])
+    return "".join(parts)
+
 # Extract the text on a line which looks like <tag>XXXX</tag>
 def parseLineEntry(tag, line):
   pattern = "^<" + tag + "\s*(.*?)>(.*)</" + tag + ">$"
@@ -239,23 +337,57 @@ def parseEmbeddedTagBlock(lines, tag, function):
 # to that function, and the function may return a list of lines which
 # are replace that line.  Only the last line of that block is processed
 def parseStandaloneTagBlock(lines, tag, function, allowClose = False, lineFunction = None):
+  return parseStandaloneTagBlocks(lines, [ (tag, function, allowClose) ],
+    lineFunction)
+
+# parseStandaloneTagBlock for several tags, in a single traversal.
+# handlers is a list of (tag, function) or (tag, function, allowClose),
+# in the order the separate passes would have been run; the result is the
+# same as running them one after the other.  So a block's lines have
+# already been through the handlers before its own when its function gets
+# them, and what it is replaced with goes through the handlers after it.
+#
+# The result is built as a new list, and put back in lines at the end,
+# rather than splicing each replacement into the middle of the buffer.
+def parseStandaloneTagBlocks(lines, handlers, lineFunction = None):
+  blocks = []
+  for handler in handlers:
+    tag = handler[0]
+    blocks.append((tag, handler[1], len(handler) > 2 and handler[2],
+      "<" + tag, "</" + tag + ">", re.compile("<" + tag + "(.*?)(/)?>")))
+  lines[:] = _parseStandaloneTagBlocks(lines, blocks, lineFunction)
+  return lines
+
+def _parseStandaloneTagBlocks(lines, blocks, lineFunction = None):
+  if len(blocks) == 0:
+    return lines
+  result = []
   i = 0
-  startTag = "<" + tag
-  endTag = "</" + tag + ">"
-  regex = re.compile(startTag + "(.*?)(/)?>")
-  while i < len(lines):
+  n = len(lines)
+  while i < n:
+    line = lines[i]
+    i += 1
 
     if lineFunction != None:
-      insertion = lineFunction(i, lines[i])
-      lines[i:i+1] = insertion
-      i += len(insertion)-1
-
-    m = regex.match(lines[i])
+      insertion = lineFunction(len(result), line)
+      if len(insertion) == 0:
+        continue
+      result.extend(insertion[:-1])
+      line = insertion[-1]
+
+    m = None
+    if line.startswith("<"):
+      for k, (tag, function, allowClose, startTag, endTag, regex) in \
+          enumerate(blocks):
+        if line.startswith(startTag):
+          m = regex.match(line)
+          if m:
+            break
     if not m:
-      i += 1
+      result.append(line)
       continue
 
-    openLine = lines[i]
+    openLine = line
     openArgs = m.group(1)
 
     block = []
@@ -263,28 +395,24 @@ def parseStandaloneTagBlock(lines, tag, function, allowClose = False, lineFuncti
     if close != None:
       if not allowClose:
         fatal("Open tag " + tag + " marked for close. " + openLine)
-      j = i
     else:
-      j = i+1
-      while j < len(lines):
-        line = lines[j]
+      while True:
+        if i == n:
+          fatal("No closing tag found for " + tag + "; open line: " + openLine)
+        line = lines[i]
+        i += 1
         if line.startswith(endTag):
           break
         if line.startswith(startTag):
           fatal("No closing tag found for " + tag + "; open line: " + openLine +
             "; found another open tag: " + line)
         block.append(line)
-        j += 1
 
-      if j == len(lines):
-        fatal("No closing tag found for " + tag + "; open line: " + openLine)
-    
-    replacement = function(openArgs, block)
+    replacement = function(openArgs,
+      _parseStandaloneTagBlocks(block, blocks[:k]))
+    result.extend(_parseStandaloneTagBlocks(replacement, blocks[k+1:]))
 
-    lines[i:j+1] = replacement
-    i += len(replacement)
-
-  return lines
+  return result
 
 class TestParsing(unittest.TestCase):
 
@@ -539,6 +667,68 @@ class TestParsing(unittest.TestCase):
     replacementBlocks = [ [ "R1", "R2", "R3" ], [ "R4" ] ]
     self.verify(lines, expectedResult, expectedBlocks, replacementBlocks)
 
+  #
+  # Tests of parseEmbeddedTags
+  #
+  def test_parse_embedded_tags_same_as_separate(self):
+    line = "<b x>a</b> <a>1<b>2</b><c/></a> <c y/><b><c/></b> <bx> z"
+    def wrap(name):
+      def f(arg, content, orig):
+        return name + "(" + arg + ":" + content + ")"
+      return f
+    def c(arg, orig):
+      return "C" + arg
+
+    separate = [ line ]
+    parseEmbeddedSingleLineTagWithContent(separate, "a", wrap("A"))
+    parseEmbeddedTagWithoutContent(separate, "c", c)
+    parseEmbeddedSingleLineTagWithContent(separate, "b", wrap("B"))
+    together = [ line ]
+    parseEmbeddedTags(together, [ ("a", wrap("A"), True), ("c", c, False),
+      ("b", wrap("B"), True) ])
+    self.assertSequenceEqual(together, separate)
+    self.assertEqual(together[0],
+      "B(x:a) A(:1B(:2)C) CyB(:C) <bx> z")
+
+  def test_parse_embedded_tags_no_open(self):
+    with self.assertRaises(SystemExit) as cm:
+      parseEmbeddedTags([ "x</a>" ], [ ("a", None, True) ])
+    self.assertEqual(cm.exception.code, 1)
+
+  #
+  # Tests of parseStandaloneTagBlocks
+  #
+  def test_parse_blocks_same_as_separate(self):
+    lines = [
+      "l0", "<a>", "a1", "<b>", "b1", "</b>", "</a>",
+      "<b x>", "<a/>", "</b>", "<c>", "<a>", "a2", "</a>", "</c>", "l1",
+    ]
+    # Each wraps its block, so what came from which shows
+    def wrap(name):
+      def f(openArgs, block):
+        return [ name + "(" + openArgs ] + block + [ ")" + name ]
+      return f
+    def handlers():
+      return [ ("a", wrap("A"), True), ("b", wrap("B")), ("c", wrap("C")) ]
+
+    separate = list(lines)
+    for handler in handlers():
+      parseStandaloneTagBlock(separate, *handler)
+    together = list(lines)
+    parseStandaloneTagBlocks(together, handlers())
+    self.assertSequenceEqual(together, separate)
+    self.assertSequenceEqual(together[:7], [ "l0", "A(", "a1", "B(", "b1", ")B", ")A" ])
+
+  def test_parse_blocks_line_function(self):
+    lines = [ "l0", "x", "<tag>", "l1", "</tag>", "l2" ]
+    def lineFunction(i, line):
+      if line == "x":
+        return []
+      return [ str(i), line ]
+    parseStandaloneTagBlocks(lines, [ ("tag", lambda openArgs, block: block) ],
+      lineFunction)
+    self.assertSequenceEqual(lines, [ "0", "l0", "2", "l1", "4", "l2" ])
+
   def verifyEmbedded(self, lines, expectedResult, expectedBlocks, replacementBlocks, open=""):
     self.callbackN = -1
     def f(l0, block):
@@ -730,7 +920,23 @@ class TestParsing(unittest.TestCase):
     replacementBlocks = [ [ "R1" ] ]
     self.verifyEmbedded(lines, expectedResult, expectedBlock, replacementBlocks)
 
+# The same attribute lists and rend= options turn up over and over in a
+# book, on every <l> of a poem for instance, so parseTagAttributes and
+# parseOption keep the results of the last CACHE_SIZE arguments.  What they
+# return is shared between callers, and so read-only: copy it to change it.
+# An error is kept as its message, and reported against the tag each time.
+CACHE_SIZE = 4096
+
 def parseTagAttributes(tag, arg, legalAttributes = None):
+  if legalAttributes != None:
+    legalAttributes = tuple(legalAttributes)
+  attributes, error = _parseTagAttributes(arg, legalAttributes)
+  if error != None:
+    fatal(tag + ": " + error)
+  return attributes
+
+@functools.lru_cache(maxsize = CACHE_SIZE)
+def _parseTagAttributes(arg, legalAttributes):
   try:  # TODO: Move this up
     attributes = parseTagAttributes1(arg)
 
@@ -740,8 +946,8 @@ def parseTagAttributes(tag, arg, legalAttributes = None):
           raise Exception("Keyword " + attribute + ": Unknown keyword in " + arg)
 
   except Exception as e:
-    fatal(tag + ": " + str(e))
-  return attributes
+    return None, str(e)
+  return types.MappingProxyType(attributes), None
 
 # A tag looks like:
 #   <tag key1='value1' key2="value2" ...>
@@ -770,6 +976,15 @@ def parseTagAttributes1(arg):
   return attributes
 
 def parseOption(tag, arg, legalOptions = None):
+  if legalOptions != None:
+    legalOptions = tuple(legalOptions)
+  options, error = _parseOption(arg, legalOptions)
+  if error != None:
+    fatal(tag + ": " + error)
+  return options
+
+@functools.lru_cache(maxsize = CACHE_SIZE)
+def _parseOption(arg, legalOptions):
   try:
     options = parseOption1(arg)
 
@@ -778,8 +993,19 @@ def parseOption(tag, arg, legalOptions = None):
         if not option in legalOptions:
           raise Exception("Option " + option + ": Unknown option in " + arg)
   except Exception as e:
-    fatal(tag + ": " + str(e))
-  return options
+    return None, str(e)
+  return types.MappingProxyType(options), None
+
+# Hits and misses of the parseTagAttributes and parseOption caches, so far
+def cacheCounts():
+  attributes = _parseTagAttributes.cache_info()
+  options = _parseOption.cache_info()
+  return {
+    "attribute hits" : attributes.hits,
+    "attribute misses" : attributes.misses,
+    "option hits" : options.hits,
+    "option misses" : options.misses,
+  }
 
 
 # Parse a single attribute list
@@ -851,6 +1077,21 @@ class TestParseTagAttributes(unittest.TestCase):
     with self.assertRaises(SystemExit) as cm:
       parseTagAttributes("x", "k1='a' kx='b'", [ 'k1', 'k2' ]) == { 'k1':'a', 'k2':'b' }
     self.assertEqual(cm.exception.code, 1)
+  def test_WithAttCached(self):
+    a = parseTagAttributes("x", "k1='a' k3='c'", [ 'k1', 'k3' ])
+    self.assertIs(parseTagAttributes("y", "k1='a' k3='c'", ( 'k1', 'k3' )), a)
+    with self.assertRaises(TypeError):
+      a['k1'] = 'b'
+    self.assertEqual(a.copy(), { 'k1':'a', 'k3':'c' })
+  def test_WithAttBadCached(self):
+    # The error is kept, and reported against each tag
+    import io, contextlib
+    for tag in [ "x", "y" ]:
+      err = io.StringIO()
+      with self.assertRaises(SystemExit) as cm, contextlib.redirect_stderr(err):
+        parseTagAttributes(tag, "k1='a' kx='b'", [ 'k1' ])
+      self.assertEqual(cm.exception.code, 1)
+      self.assertTrue(err.getvalue().startswith("fatal: " + tag + ": Keyword kx"))
 
   def test_Option(self):
     assert parseOption1('mr:5em   mb:1em italic') ==  { 'mr' : '5em', 'mb' : '1em', 'italic' : '' }
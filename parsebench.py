@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from optparse import OptionParser
+import os
+import json
+import time
+import random
+import unittest
+
+import config
+import parse
+
+# parsebench: microbenchmarks of the tag scanning functions in parse.py,
+# which every part of fpgen goes through, away from the rest of the
+# pipeline.  Each case runs one function over a fixed input, shaped like
+# the lines it sees in real books; the result is in operations (calls of
+# the function) per second, the best of several rounds.
+#
+# The results can be saved as a baseline (--save), and later runs are
+# compared with it: the ratio is the new speed over the baseline's, so
+# over 1 is faster.  Cases with the same name in the baseline are compared;
+# --baseline from another machine is meaningless.
+
+DEFAULT_BASELINE = "parsebench-baseline.json"
+ROUND_TIME = 0.2 # seconds, at least, in each round
+ROUNDS = 3
+
+WORDS = "the of and to in that was his he it with is for as had you".split()
+
+def words(r, n):
+  return " ".join(r.choice(WORDS) for i in range(n))
+
+# Inputs for each case; all from the one seed, so every run is the same
+class Inputs(object):
+  def __init__(self, seed = 1):
+    r = random.Random(seed)
+
+    # A file of many small <lg> blocks, among paragraphs
+    self.blocks = []
+    for i in range(200):
+      self.blocks += [ words(r, 12), words(r, 10), "" ]
+      self.blocks += [ "<lg rend='center'>" ] + \
+        [ words(r, 6) for j in range(r.randint(2, 6)) ] + [ "</lg>", "" ]
+
+    # Inline tags which run over several lines
+    self.embedded = []
+    for i in range(200):
+      self.embedded += [ words(r, 8) + " <sc>" + words(r, 3), words(r, 8),
+        words(r, 2) + "</sc> " + words(r, 5), "" ]
+
+    # Long lines with many tags in each
+    self.links = []
+    self.notes = []
+    for i in range(50):
+      self.links.append(" ".join(words(r, 4) + " <link target='t{}'>{}</link>"
+        .format(j, words(r, 2)) for j in range(20)))
+      self.notes.append(" ".join(words(r, 6) + "<fn id='{}'>".format(j)
+        for j in range(20)) + " <fnote/>")
+
+    # Attribute lists with the same attributes over and over
+    self.attributes = [ " ".join("{}{}='{}'".format(name, j, words(r, 2))
+      for j in range(4) for name in [ "id", "rend", "title" ])
+      for i in range(50) ]
+    self.options = [ " ".join("m{}:{}em;italic".format(side, j)
+      for j in range(4) for side in "tblr") for i in range(50) ]
+
+def same(arg, block):
+  return block
+
+def linkFunction(arg, content, orig):
+  return content
+
+# Works in place, so return the lines to check them
+def parseLinks(lines):
+  parse.parseEmbeddedSingleLineTagWithContent(lines, "link", linkFunction)
+  return lines
+
+def noteFunction(arg, orig):
+  return "[" + arg + "]"
+
+# The tags of both the link and note inputs, in one scan
+def parseTags(lines):
+  return parse.parseEmbeddedTags(lines, [ ("link", linkFunction, True),
+    ("fn", noteFunction, False) ])
+
+# name: (what it runs over, function to time)
+def cases(inputs):
+  return {
+    "parseStandaloneTagBlock" : ("{} lines, {} <lg> blocks".format(
+        len(inputs.blocks), inputs.blocks.count("</lg>")),
+      lambda: parse.parseStandaloneTagBlock(list(inputs.blocks), "lg", same)),
+    "parseEmbeddedTagBlock" : ("{} lines, {} <sc> over 3 lines".format(
+        len(inputs.embedded), len(inputs.embedded) // 4),
+      lambda: parse.parseEmbeddedTagBlock(list(inputs.embedded), "sc", same)),
+    "parseEmbeddedSingleLineTagWithContent" : ("{} lines of 20 <link>"
+        .format(len(inputs.links)),
+      lambda: parseLinks(list(inputs.links))),
+    "_parseEmbeddedTagWithoutContent" : ("{} lines of 20 <fn> and a <fnote/>"
+        .format(len(inputs.notes)),
+      lambda: [ parse._parseEmbeddedTagWithoutContent(line, "fn", noteFunction)
+        for line in inputs.notes ]),
+    "parseEmbeddedTags" : ("{} lines of 20 <link>, {} of 20 <fn>".format(
+        len(inputs.links), len(inputs.notes)),
+      lambda: parseTags(inputs.links + inputs.notes)),
+    "parseTagAttributes1" : ("{} lists of 12 attributes".format(
+        len(inputs.attributes)),
+      lambda: [ parse.parseTagAttributes1(arg) for arg in inputs.attributes ]),
+    "parseOption1" : ("{} lists of 32 options".format(len(inputs.options)),
+      lambda: [ parse.parseOption1(arg) for arg in inputs.options ]),
+    "parseOption" : ("{} lists of 32 options, cached".format(
+        len(inputs.options)),
+      lambda: [ parse.parseOption("bench", arg) for arg in inputs.options ]),
+  }
+
+# Calls per second of function; the best of rounds rounds
+def opsPerSecond(function, roundTime = ROUND_TIME, rounds = ROUNDS):
+  # Find how many calls take roundTime
+  n = 1
+  while True:
+    start = time.perf_counter()
+    for i in range(n):
+      function()
+    elapsed = time.perf_counter() - start
+    if elapsed >= roundTime / 10:
+      break
+    n *= 2
+  n = max(1, int(n * roundTime / elapsed))
+
+  best = None
+  for r in range(rounds):
+    start = time.perf_counter()
+    for i in range(n):
+      function()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return n / best
+
+def run(names = None, roundTime = ROUND_TIME, rounds = ROUNDS):
+  results = {}
+  for name, (input, function) in cases(Inputs()).items():
+    if names and name not in names:
+      continue
+    results[name] = {
+      "input" : input,
+      "ops" : round(opsPerSecond(function, roundTime, rounds), 1),
+    }
+  return results
+
+def report(results, baseline, out = print):
+  out("{:<40} {:>12} {:>10}".format("", "ops/sec", "vs base"))
+  for name, result in results.items():
+    ratio = ""
+    if name in baseline:
+      ratio = "{:.2f}x".format(result["ops"] / baseline[name]["ops"])
+    out("{:<40} {:>12.1f} {:>10}  {}".format(name, result["ops"], ratio,
+      result["input"]))
+
+def main():
+  parser = OptionParser(usage="usage: %prog [options] [function...]")
+  parser.add_option("-b", "--baseline", dest="baseline",
+    default=DEFAULT_BASELINE, help="baseline file, default " +
+    DEFAULT_BASELINE)
+  parser.add_option("--save", dest="save", action="store_true",
+    default=False, help="save the results as the baseline")
+  parser.add_option("-t", "--time", dest="time", type="float",
+    default=ROUND_TIME, help="seconds in each round, default " +
+    str(ROUND_TIME))
+  parser.add_option("-r", "--rounds", dest="rounds", type="int",
+    default=ROUNDS, help="rounds, keeping the fastest, default " +
+    str(ROUNDS))
+  (options, args) = parser.parse_args()
+
+  baseline = {}
+  if os.path.exists(options.baseline):
+    with open(options.baseline, "r", encoding='utf-8') as f:
+      baseline = json.load(f)["results"]
+
+  results = run(args, options.time, options.rounds)
+  report(results, baseline)
+
+  if options.save:
+    with open(options.baseline, "w", encoding='utf-8') as f:
+      json.dump({ "version" : config.VERSION, "results" : results }, f,
+        indent=2)
+      f.write("\n")
+    print("Saved as baseline in " + options.baseline)
+
+class TestParseBench(unittest.TestCase):
+  # Each case parses what it is meant to
+  def test_parsebench_cases(self):
+    inputs = Inputs()
+    c = cases(inputs)
+    blocks = c["parseStandaloneTagBlock"][1]()
+    self.assertNotIn("</lg>", blocks)
+    self.assertLess(len(blocks), len(inputs.blocks))
+    self.assertNotIn("</sc>", "".join(c["parseEmbeddedTagBlock"][1]()))
+    links = c["parseEmbeddedSingleLineTagWithContent"][1]()
+    self.assertNotIn("<link", links[0])
+    notes = c["_parseEmbeddedTagWithoutContent"][1]()
+    self.assertIn("[id='19']", notes[0])
+    self.assertIn("<fnote/>", notes[0])
+    tags = c["parseEmbeddedTags"][1]()
+    self.assertNotIn("<link", tags[0])
+    self.assertEqual(tags[len(inputs.links)], notes[0])
+    self.assertEqual(len(c["parseTagAttributes1"][1]()[0]), 12)
+    self.assertEqual(len(c["parseOption1"][1]()[0]), 5)
+
+  def test_parsebench_report(self):
+    results = run([ "parseOption1" ], 0.001, 1)
+    self.assertGreater(results["parseOption1"]["ops"], 0)
+    lines = []
+    report(results, { "parseOption1" : { "ops" :
+      results["parseOption1"]["ops"] / 2 } }, lines.append)
+    self.assertIn(" 2.00x ", lines[1])
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+# The processing of a Book is a sequence of passes over self.wb, each run
+# through Book.step.  Listeners added here are told as each pass begins and
+# ends; this is how the --watch timings are collected.  Passes nest: the
+# steps of loadFile are inside loadFile.
+#
+# With no listeners, a pass is just a function call.
+
+listeners = []
+
+class PassListener(object):
+  def begin(self, book, name):
+    pass
+
+  def end(self, book, name):
+    pass
+
+def addListener(listener):
+  listeners.append(listener)
+  return listener
+
+def removeListener(listener):
+  listeners.remove(listener)
+
+def run(book, name, function, args):
+  if len(listeners) == 0:
+    return function(*args)
+  for listener in listeners:
+    listener.begin(book, name)
+  try:
+    return function(*args)
+  finally:
+    for listener in reversed(listeners):
+      listener.end(book, name)
+
+# What a Book is called in reports
+def bookName(book):
+  name = type(book).__name__
+  if book.dstfile:
+    name += " " + book.dstfile
+  else:
+    name += " " + book.gentype
+  return name
+
+# Wall time of each pass, in the order they started
+class PassTimer(PassListener):
+  def __init__(self):
+    self.entries = []
+    self.open = []
+
+  def begin(self, book, name):
+    entry = [ bookName(book), name, len(self.open), time.perf_counter(), 0 ]
+    self.entries.append(entry)
+    self.open.append(entry)
+
+  def end(self, book, name):
+    entry = self.open.pop()
+    entry[4] = time.perf_counter() - entry[3]
+
+  def report(self, out = print):
+    book = None
+    for name, passName, depth, start, elapsed in self.entries:
+      if name != book:
+        book = name
+        out(book)
+      out("{:<40} {:8.1f}ms".format("  " * (depth+1) + passName,
+        elapsed * 1000))
+
+class TestPasses(unittest.TestCase):
+  def setUp(self):
+    self.timer = addListener(PassTimer())
+
+  def tearDown(self):
+    removeListener(self.timer)
+    import config
+    config.setContext(config.BuildContext())
+
+  def test_passes_nested(self):
+    from fpgen import Book
+    book = Book("x-src.txt", "x.html", 0, 'h')
+    def inner(x):
+      return x + 1
+    def outer():
+      return book.step(inner, 1)
+    self.assertEqual(book.step(outer), 2)
+    self.assertEqual([ (e[1], e[2]) for e in self.timer.entries ],
+      [ ("outer", 0), ("inner", 1) ])
+    self.assertGreaterEqual(self.timer.entries[0][4],
+      self.timer.entries[1][4])
+    lines = []
+    self.timer.report(lines.append)
+    self.assertEqual(lines[0], "Book x.html")
+    self.assertTrue(lines[2].startswith("    inner "))
+
+  def test_passes_failure(self):
+    from fpgen import Book
+    book = Book("x-src.txt", "x.html", 0, 'h')
+    def fails():
+      raise ValueError()
+    with self.assertRaises(ValueError):
+      book.step(fails)
+    self.assertEqual(len(self.timer.open), 0)
+
+  def test_passes_html(self):
+    from fpgen import HTML
+    book = HTML("x-src.txt", "x.html", 0, 'h')
+    book.wb = [ "", "<heading level='1'>H</heading>", "", "Text.", "" ]
+    book.process()
+    names = [ e[1] for e in self.timer.entries ]
+    for name in [ "relocateFootnotes", "protectMarkup", "doDrama",
+        "markPara", "cleanup" ]:
+      self.assertIn(name, names)
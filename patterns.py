@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import time
+import unittest
+
+# The regular expressions of the passes which run over every line, each
+# compiled once, when its module is loaded, instead of going through the
+# cache in the re module on every call; with a name, so that they can be
+# counted.
+#
+# A Pattern has the methods of the compiled expression: match, search,
+# sub, and so on.  Normally they are the compiled expression's own, so
+# they cost nothing more; with --regex-stats, every call is counted and
+# timed, and the patterns which took the most time are reported at the
+# end of the build.  The time of finditer is only that of starting the
+# scan, not of going through the matches.
+
+METHODS = [ "match", "search", "fullmatch", "sub", "subn", "split",
+  "findall", "finditer" ]
+
+# How many patterns the report shows
+TOP_PATTERNS = 20
+
+registry = {} # name: Pattern
+counting = False
+
+class Pattern(object):
+  def __init__(self, name, regex):
+    self.name = name
+    self.regex = regex
+    self.pattern = regex.pattern
+    self.calls = 0
+    self.time = 0.0
+    self.bind()
+
+  # Point each method at the compiled expression, or at a counter of it
+  def bind(self):
+    for method in METHODS:
+      function = getattr(self.regex, method)
+      if counting:
+        function = self.counted(function)
+      setattr(self, method, function)
+
+  def counted(self, function):
+    def call(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return function(*args, **kwargs)
+      finally:
+        self.calls += 1
+        self.time += time.perf_counter() - start
+    return call
+
+# The one Pattern of this name; the same name with a different expression
+# is a mistake in the code
+def compile(name, pattern, flags = 0):
+  regex = re.compile(pattern, flags)
+  if name in registry:
+    if registry[name].regex != regex:
+      raise ValueError("Pattern " + name + " is already " +
+        repr(registry[name].pattern))
+    return registry[name]
+  registry[name] = Pattern(name, regex)
+  return registry[name]
+
+# Turn the counters on or off, for every pattern, now and to come
+def count(on = True):
+  global counting
+  counting = on
+  for p in registry.values():
+    p.bind()
+
+def reset():
+  for p in registry.values():
+    p.calls = 0
+    p.time = 0.0
+
+# The patterns which were called, most time first
+def stats():
+  return sorted([ p for p in registry.values() if p.calls > 0 ],
+    key=lambda p: -p.time)
+
+def report(out = print, top = TOP_PATTERNS):
+  called = stats()
+  out("Regular expressions, by time: {} of {} used".format(len(called),
+    len(registry)))
+  out("{:<32} {:>10} {:>10}  {}".format("", "calls", "ms", "pattern"))
+  for p in called[:top]:
+    out("{:<32} {:>10} {:>10.1f}  {}".format(p.name, p.calls,
+      p.time * 1000, p.pattern))
+
+class TestPatterns(unittest.TestCase):
+  def tearDown(self):
+    count(False)
+    registry.pop("test.digits", None)
+
+  def test_patterns_same(self):
+    p = compile("test.digits", r"\d+")
+    self.assertIs(compile("test.digits", r"\d+"), p)
+    with self.assertRaises(ValueError):
+      compile("test.digits", r"\d*")
+    self.assertEqual(p.sub("#", "a12b3"), "a#b#")
+    self.assertEqual(p.match("12b").group(0), "12")
+    self.assertEqual(p.calls, 0)
+
+  def test_patterns_count(self):
+    p = compile("test.digits", r"\d+")
+    count()
+    self.assertEqual([ m.group(0) for m in p.finditer("1 22 333") ],
+      [ "1", "22", "333" ])
+    self.assertIsNone(p.search("none"))
+    self.assertEqual(p.calls, 2)
+    self.assertIn(p, stats())
+    self.assertGreater(p.time, 0)
+    lines = []
+    report(lines.append)
+    self.assertTrue(any(line.startswith("test.digits") and " 2 " in line
+      for line in lines))
+    count(False)
+    p.search("1")
+    self.assertEqual(p.calls, 2)
+    reset()
+    self.assertEqual((p.calls, p.time), (0, 0))
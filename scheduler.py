@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import abc
+import sys
+import time
+import pickle
+import tempfile
+import unittest
+import subprocess
+import concurrent.futures
+
+from msgs import cprint, capture
+
+# A small scheduler for the steps of a build: lint, generating each format,
+# the external converters run on the generated files, and the zip.  Each
+# step is a Task, which is started once all the tasks it depends on have
+# completed; up to jobs tasks are run at once.
+#
+# When a task fails, everything depending on it is skipped, but tasks which
+# do not depend on it still run.  The tasks which completed are recorded in
+# a state file as the build goes, so that a failed build can be resumed:
+# a task which completed, and whose outputs still exist, is not run again.
+#
+# A task given a BuildCache is looked up in it before it is run: the key
+# is its inputs, and whatever else it says it depends on; on a hit its
+# outputs and result come from the cache, and what it printed is shown
+# again, so its warnings are not lost.
+#
+# Listeners are told as each task begins, with taskBegin(task), and ends,
+# with taskEnd(task, ok); in the thread running it.
+
+class TaskError(Exception):
+  pass
+
+class Task(abc.ABC):
+  # deps: the tasks which must complete before this one starts
+  # outputs: files this task creates, which must exist for it to be reused
+  # inputs: files this task reads, usually created by its deps; if they
+  #   no longer exist when the task is run, the deps are run again
+  # temporaries: files this task creates, which a later task removes
+  def __init__(self, name, deps = [], outputs = [], inputs = [],
+      temporaries = []):
+    self.name = name
+    self.group = None # for reports, such as the format the task is part of
+    self.deps = list(deps)
+    self.outputs = list(outputs)
+    self.inputs = list(inputs)
+    self.temporaries = list(temporaries)
+    self.cache = None
+    self.status = "pending"
+    self.result = None
+    self.elapsed = 0
+    self.cached = False
+
+  # Look this task up in the cache.  keyFiles are files other than the
+  # inputs whose contents it depends on, or a function returning them,
+  # called when the task starts; keyParts strings.
+  def setCache(self, cache, keyParts = [], keyFiles = []):
+    self.cache = cache
+    self.keyParts = list(keyParts)
+    self.keyFiles = keyFiles
+
+  def getKey(self):
+    parts = [ self.name ] + self.keyParts
+    keyFiles = self.keyFiles() if callable(self.keyFiles) else self.keyFiles
+    for f in self.inputs + list(keyFiles):
+      parts.append(f)
+      parts.append(self.cache.hashFile(f))
+    return self.cache.key(parts)
+
+  # What the scheduler calls
+  def perform(self):
+    if self.cache is None:
+      return self.execute()
+    key = self.getKey()
+    files = self.outputs + self.temporaries
+    hit, value = self.cache.restore(key, files)
+    if hit:
+      self.cached = True
+      result, output = value
+      sys.stdout.write(output)
+      return result
+    out = io.StringIO()
+    try:
+      with capture(out):
+        result = self.execute()
+    finally:
+      sys.stdout.write(out.getvalue())
+    self.cache.store(key, files, (result, out.getvalue()))
+    return result
+
+  # Does the work, and returns the result, which is kept in the state file.
+  # Failure is an exception; including SystemExit, from fatal.
+  @abc.abstractmethod
+  def execute(self):
+    pass
+
+class FunctionTask(Task):
+  def __init__(self, name, function, deps = [], outputs = [], inputs = [],
+      temporaries = []):
+    Task.__init__(self, name, deps, outputs, inputs, temporaries)
+    self.function = function
+
+  def execute(self):
+    return self.function()
+
+# A shell command, or a function returning one, called when the task starts,
+# since it usually depends on the results of earlier tasks.  The command
+# is part of the cache key.
+# The output is captured, and printed all at once when the command is done,
+# so the output of commands running at the same time is not interleaved.
+# An exit status which is not one of okCodes fails the task, and so the
+# build, and skips what depends on it; when the converters were run with
+# os.system, their status was ignored, and the build carried on.
+class CommandTask(Task):
+  def __init__(self, name, command, deps = [], outputs = [], inputs = [],
+      temporaries = [], okCodes = [ 0 ]):
+    Task.__init__(self, name, deps, outputs, inputs, temporaries)
+    self.command = command
+    self.commandLine = None
+    self.okCodes = okCodes
+    self.output = ""
+
+  def getCommand(self):
+    if self.commandLine is None:
+      if callable(self.command):
+        self.commandLine = self.command()
+      else:
+        self.commandLine = self.command
+    return self.commandLine
+
+  def getKey(self):
+    return self.cache.key([ Task.getKey(self), self.getCommand() ])
+
+  def execute(self):
+    p = subprocess.run(self.getCommand(), shell=True,
+      stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    self.output = p.stdout.decode('utf-8', 'replace')
+    if self.output != "":
+      print(self.output, end='' if self.output.endswith('\n') else '\n')
+    if p.returncode not in self.okCodes:
+      raise TaskError("exit status " + str(p.returncode))
+    return p.returncode
+
+class Scheduler(object):
+  # signature identifies the build; a state file left by a build with
+  # a different signature is not resumed from.
+  def __init__(self, jobs = 1, stateFile = None, signature = None):
+    self.jobs = jobs
+    self.stateFile = stateFile
+    self.signature = signature
+    self.tasks = []
+    self.done = {}
+    self.listeners = []
+
+  def add(self, task):
+    for dep in task.deps:
+      if dep not in self.tasks:
+        raise ValueError(task.name + ": dependency not added: " + dep.name)
+    self.tasks.append(task)
+    return task
+
+  # Run everything; returns the list of tasks which failed.
+  def run(self, resume = False):
+    if resume:
+      self.done = self.loadState()
+    else:
+      self.done = {}
+    todo = self.plan()
+    for task in self.tasks:
+      if task not in todo:
+        task.status = "reused"
+        task.result = self.done[task.name]
+        cprint(task.name + ": completed earlier")
+    self.saveState()
+
+    pending = [ task for task in self.tasks if task in todo ]
+    running = {}
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      while True:
+        # Start what we can, in the order the tasks were added
+        for task in pending[:]:
+          if any(dep.status in ("failed", "skipped") for dep in task.deps):
+            task.status = "skipped"
+            pending.remove(task)
+            continue
+          if len(running) >= self.jobs:
+            continue
+          if all(dep.status in ("done", "reused") for dep in task.deps):
+            pending.remove(task)
+            task.status = "running"
+            task.start = time.time()
+            running[pool.submit(self.perform, task)] = task
+        if len(running) == 0:
+          break
+
+        finished, notFinished = concurrent.futures.wait(running,
+          return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+          task = running.pop(future)
+          task.elapsed = time.time() - task.start
+          try:
+            task.result = future.result()
+          except (Exception, SystemExit) as e:
+            task.status = "failed"
+            failed.append(task)
+            # fatal has already written its message
+            if not isinstance(e, SystemExit):
+              sys.stderr.write(task.name + ": failed: " + str(e) + "\n")
+            continue
+          task.status = "done"
+          self.done[task.name] = task.result
+          self.saveState()
+          cprint("{}: {:.2f}s{}".format(task.name, task.elapsed,
+            " (cached)" if task.cached else ""))
+
+    for task in pending:
+      task.status = "skipped"
+    if len(failed) == 0 and self.stateFile and os.path.exists(self.stateFile):
+      os.remove(self.stateFile)
+    return failed
+
+  def perform(self, task):
+    for listener in self.listeners:
+      listener.taskBegin(task)
+    ok = False
+    try:
+      result = task.perform()
+      ok = True
+      return result
+    finally:
+      for listener in reversed(self.listeners):
+        listener.taskEnd(task, ok)
+
+  # The set of tasks which need to be run
+  def plan(self):
+    todo = set()
+    for task in self.tasks:
+      if task.name not in self.done or \
+          any(not os.path.exists(f) for f in task.outputs):
+        todo.add(task)
+
+    # Anything whose inputs are gone needs what produced them to run again
+    changed = True
+    while changed:
+      changed = False
+      for task in self.tasks:
+        if task in todo and any(not os.path.exists(f) for f in task.inputs):
+          for dep in task.deps:
+            if dep not in todo:
+              todo.add(dep)
+              changed = True
+    return todo
+
+  def loadState(self):
+    if not self.stateFile or not os.path.exists(self.stateFile):
+      cprint("Nothing to resume, building everything")
+      return {}
+    try:
+      with open(self.stateFile, "rb") as f:
+        state = pickle.load(f)
+    except Exception:
+      cprint("Cannot read " + self.stateFile + ", building everything")
+      return {}
+    if state.get("signature") != self.signature:
+      cprint(self.stateFile + " is from a different build, building everything")
+      return {}
+    return state["done"]
+
+  def saveState(self):
+    if not self.stateFile:
+      return
+    with open(self.stateFile, "wb") as f:
+      pickle.dump({ "signature" : self.signature, "done" : self.done }, f)
+
+class TestScheduler(unittest.TestCase):
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.dir = tempfile.TemporaryDirectory()
+    os.chdir(self.dir.name)
+    self.log = []
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    self.dir.cleanup()
+
+  def function(self, name, result = None, fail = False):
+    def f():
+      self.log.append(name)
+      if fail:
+        raise TaskError("failed")
+      return result
+    return f
+
+  def touch(self, name):
+    def f():
+      self.log.append(name)
+      with open(name, "w") as out:
+        out.write(name)
+    return f
+
+  def test_scheduler_order(self):
+    s = Scheduler()
+    a = s.add(FunctionTask("a", self.function("a")))
+    b = s.add(FunctionTask("b", self.function("b"), deps=[a]))
+    c = s.add(FunctionTask("c", self.function("c"), deps=[b]))
+    d = s.add(FunctionTask("d", self.function("d"), deps=[a]))
+    self.assertEqual(s.run(), [])
+    # One at a time, in the order added whenever ready
+    self.assertSequenceEqual(self.log, [ "a", "b", "c", "d" ])
+
+  def test_scheduler_missing_dep(self):
+    s = Scheduler()
+    a = FunctionTask("a", self.function("a"))
+    with self.assertRaises(ValueError):
+      s.add(FunctionTask("b", self.function("b"), deps=[a]))
+
+  def test_scheduler_results(self):
+    s = Scheduler()
+    a = s.add(FunctionTask("a", self.function("a", 3)))
+    b = s.add(FunctionTask("b", lambda: a.result * 2, deps=[a]))
+    s.run()
+    self.assertEqual(b.result, 6)
+
+  def test_scheduler_concurrent(self):
+    s = Scheduler(3)
+    tasks = []
+    for i in range(3):
+      tasks.append(s.add(CommandTask(str(i), "sleep 0.3")))
+    start = time.time()
+    self.assertEqual(s.run(), [])
+    self.assertLess(time.time() - start, 0.8)
+    for t in tasks:
+      self.assertGreaterEqual(t.elapsed, 0.25)
+
+  def test_scheduler_abstract(self):
+    with self.assertRaises(TypeError):
+      Task("a")
+
+  def test_scheduler_command(self):
+    s = Scheduler()
+    a = s.add(CommandTask("a", "echo hello"))
+    b = s.add(CommandTask("b", lambda: "echo " + str(a.result + 1), deps=[a]))
+    c = s.add(CommandTask("c", "exit 1", okCodes=[0, 1]))
+    self.assertEqual(s.run(), [])
+    self.assertEqual(a.output, "hello\n")
+    self.assertEqual(b.output, "1\n")
+    self.assertEqual(c.result, 1)
+
+  def test_scheduler_failure(self):
+    s = Scheduler(1, "state")
+    a = s.add(FunctionTask("a", self.function("a")))
+    b = s.add(CommandTask("b", "exit 2", deps=[a]))
+    c = s.add(FunctionTask("c", self.function("c"), deps=[b]))
+    d = s.add(FunctionTask("d", self.function("d"), deps=[a]))
+    self.assertEqual(s.run(), [ b ])
+    self.assertEqual(c.status, "skipped")
+    self.assertEqual(d.status, "done")
+    self.assertSequenceEqual(self.log, [ "a", "d" ])
+    self.assertTrue(os.path.exists("state"))
+
+  def test_scheduler_fatal(self):
+    def f():
+      sys.exit(1)
+    s = Scheduler()
+    a = s.add(FunctionTask("a", f))
+    b = s.add(FunctionTask("b", self.function("b"), deps=[a]))
+    self.assertEqual(s.run(), [ a ])
+    self.assertEqual(b.status, "skipped")
+
+  def build(self, failC):
+    s = Scheduler(1, "state", "sig")
+    a = s.add(FunctionTask("a", self.function("a", 1)))
+    b = s.add(FunctionTask("b", self.touch("b"), deps=[a], outputs=["b"]))
+    c = s.add(FunctionTask("c", self.function("c", fail=failC), deps=[b],
+      inputs=["b"]))
+    return s, a
+
+  def test_scheduler_resume(self):
+    s, a = self.build(True)
+    self.assertEqual(len(s.run()), 1)
+    self.log = []
+    s, a = self.build(False)
+    self.assertEqual(s.run(True), [])
+    self.assertSequenceEqual(self.log, [ "c" ])
+    self.assertEqual(a.status, "reused")
+    self.assertEqual(a.result, 1)
+    # Success removes the state
+    self.assertFalse(os.path.exists("state"))
+
+  def test_scheduler_resume_missing_input(self):
+    s, a = self.build(True)
+    s.run()
+    os.remove("b")
+    self.log = []
+    s, a = self.build(False)
+    s.run(True)
+    self.assertSequenceEqual(self.log, [ "b", "c" ])
+
+  def test_scheduler_resume_signature(self):
+    s, a = self.build(True)
+    s.run()
+    self.log = []
+    s, a = self.build(False)
+    s.signature = "other"
+    s.run(True)
+    self.assertSequenceEqual(self.log, [ "a", "b", "c" ])
+
+  def cached(self, cache, contents):
+    self.write("in", contents)
+    s = Scheduler()
+    a = s.add(FunctionTask("a", self.touch("out"), inputs=["in"],
+      outputs=["out"]))
+    a.setCache(cache, [ "x" ])
+    b = s.add(CommandTask("b", "cat in out > both; echo b", deps=[a],
+      inputs=["in"], outputs=["both"]))
+    b.setCache(cache)
+    self.assertEqual(s.run(), [])
+    return a, b
+
+  def test_scheduler_cache(self):
+    from cache import BuildCache
+    cache = BuildCache()
+    a, b = self.cached(cache, "one")
+    self.assertFalse(a.cached or b.cached)
+    os.remove("out")
+    os.remove("both")
+    import contextlib
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+      a, b = self.cached(cache, "one")
+    self.assertTrue(a.cached and b.cached)
+    # What b printed the first time, shown again
+    self.assertIn("b\n", out.getvalue())
+    self.assertSequenceEqual(self.log, [ "out" ])
+    self.assertEqual(b.output, "")
+    with open("both") as f:
+      self.assertEqual(f.read(), "oneout")
+    a, b = self.cached(cache, "two")
+    self.assertFalse(a.cached or b.cached)
+    self.assertEqual(b.output, "b\n")
+
+  def write(self, name, contents):
+    with open(name, "w") as f:
+      f.write(contents)
+
+  def test_scheduler_no_resume(self):
+    s, a = self.build(True)
+    s.run()
+    self.log = []
+    s, a = self.build(False)
+    s.run()
+    self.assertSequenceEqual(self.log, [ "a", "b", "c" ])
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import unittest
+
+# The CSS of an HTML book, as the passes add it with HTML.addcss.  Each
+# string added is "[priority] text": the text of one or more rules, or
+# sometimes only a part of one, such as the page number rule, which is
+# added a line at a time with consecutive priorities.  The style block is
+# all the texts, in order of priority, and of text within a priority.
+#
+# Adding is a dictionary lookup, since the same string is added for every
+# line or block which needs it; the priority is only parsed the first time
+# a string is seen.  When the style block is made, it is parsed into its
+# rules, and:
+#   - a rule whose selectors all need a class which is not in the book
+#     is dropped;
+#   - of two identical rules, the first is dropped, since the second
+#     overrides all of it anyway;
+#   - with minify, comments and white space are dropped, and consecutive
+#     rules with the same selector are merged.
+# Otherwise the text of each rule is kept as it was added.
+
+# The priority, and the space or newline after it, as the old CSS.show
+# sliced them off
+regexPriority = re.compile(r"\s*\[(\d+)\][ \n]?")
+regexClass = re.compile(r"\.(-?[_a-zA-Z][\w-]*)")
+regexClassAttribute = re.compile(r"""class=(['"])(.*?)\1""")
+
+# A rule of the style block: text[start:end] is all of it, from the
+# selector to the closing brace.  selector is None for an @ rule, such as
+# @media or @font-face, which are kept whole.
+class Rule(object):
+  def __init__(self, start, end, selector, declarations):
+    self.start = start
+    self.end = end
+    self.selector = selector
+    self.declarations = declarations
+
+  # The classes which each selector of the rule needs
+  def classes(self):
+    return [ regexClass.findall(s) for s in self.selector.split(",") ]
+
+  def key(self):
+    return (" ".join(self.selector.split()), normalize(self.declarations))
+
+def normalize(declarations):
+  return ";".join(d.strip() for d in declarations.split(";") if d.strip())
+
+# Where the comment, string, or block starting at text[i] ends
+def skip(text, i):
+  c = text[i]
+  if text.startswith("/*", i):
+    end = text.find("*/", i + 2)
+    return len(text) if end == -1 else end + 2
+  if c == '"' or c == "'":
+    end = text.find(c, i + 1)
+    return len(text) if end == -1 else end + 1
+  if c == '{':
+    i += 1
+    while i < len(text):
+      if text[i] == '}':
+        return i + 1
+      if text[i] in "{\"'" or text.startswith("/*", i):
+        i = skip(text, i)
+      else:
+        i += 1
+    return len(text)
+  return i + 1
+
+# The rules of the style block text; a rule which is not closed runs to
+# the end, and is kept like an @ rule
+def parse(text):
+  rules = []
+  i = 0
+  n = len(text)
+  while i < n:
+    if text[i].isspace():
+      i += 1
+      continue
+    if text.startswith("/*", i):
+      i = skip(text, i)
+      continue
+    start = i
+    while i < n and text[i] not in "{;":
+      i = skip(text, i)
+    if i == n:
+      rules.append(Rule(start, n, None, None))
+      break
+    if text[i] == ';':
+      # e.g. @import
+      i += 1
+      rules.append(Rule(start, i, None, None))
+      continue
+    open = i
+    i = skip(text, i)
+    selector = text[start:open].strip()
+    if selector.startswith("@") or text[i-1] != '}':
+      rules.append(Rule(start, i, None, None))
+    else:
+      rules.append(Rule(start, i, selector, text[open+1:i-1]))
+  return rules
+
+# The classes used in the lines of html
+def usedClasses(lines):
+  classes = set()
+  for line in lines:
+    if "class=" in line:
+      for m in regexClassAttribute.finditer(line):
+        classes.update(m.group(2).split())
+  return classes
+
+class Stylesheet(object):
+  def __init__(self):
+    self.added = {} # string: (priority, text)
+    self.minify = False
+    self.recorded = None
+
+  def addcss(self, s):
+    if self.recorded is not None:
+      self.recorded.append(s)
+    if s not in self.added:
+      m = regexPriority.match(s)
+      if m:
+        self.added[s] = (int(m.group(1)), s[m.end():])
+      else:
+        self.added[s] = (0, s)
+
+  # Every string added from now on is also appended to the list returned,
+  # until stopRecording; for the unit cache (units.py)
+  def record(self):
+    self.recorded = []
+    return self.recorded
+
+  def stopRecording(self):
+    self.recorded = None
+
+  # The text of the style block, before it is cleaned up
+  def text(self):
+    return "\n".join(text for priority, text in sorted(self.added.values()))
+
+  # The rules to keep; all of them, if the classes of the book are not
+  # known
+  def keep(self, rules, classes):
+    kept = []
+    last = {} # rule.key(): its index in kept
+    for rule in rules:
+      if rule.selector != None:
+        if classes != None and \
+            not any(set(c) <= classes for c in rule.classes()):
+          continue
+        key = rule.key()
+        if key in last:
+          kept[last[key]] = None
+        last[key] = len(kept)
+      kept.append(rule)
+    return [ rule for rule in kept if rule != None ]
+
+  # The lines of the style block; classes is the set of classes in the
+  # html, or None to keep every rule
+  def show(self, classes = None):
+    text = self.text()
+    rules = parse(text)
+    kept = self.keep(rules, classes)
+    if self.minify:
+      return [ "      " + minify(text, kept) ]
+
+    # Take out what was dropped; and the lines which are then empty, but
+    # were not before
+    dropped = [ False ] * len(text)
+    kept = set(kept)
+    for rule in rules:
+      if rule not in kept:
+        dropped[rule.start:rule.end] = [ True ] * (rule.end - rule.start)
+    t = []
+    off = 0
+    for line in text.split("\n"):
+      flags = dropped[off:off+len(line)]
+      off += len(line) + 1
+      if any(flags):
+        line = "".join(c for c, d in zip(line, flags) if not d)
+        if line.strip() == "":
+          continue
+      t.append("      " + line)
+    return t
+
+  def __len__(self):
+    return len(self.added)
+
+# The rules as one line
+def minify(text, rules):
+  result = []
+  previous = None
+  for rule in rules:
+    if rule.selector == None:
+      result.append(minifyText(text[rule.start:rule.end]))
+      previous = None
+      continue
+    selector = ",".join(" ".join(s.split()) for s in rule.selector.split(","))
+    declarations = normalize(minifyText(rule.declarations))
+    if declarations == "":
+      continue
+    if previous != None and previous[0] == selector:
+      previous[1] += ";" + declarations
+      continue
+    previous = [ selector, declarations ]
+    result.append(previous)
+  return "".join(r if isinstance(r, str) else r[0] + "{" + r[1] + "}"
+    for r in result)
+
+# Comments and extra white space out of css text; but not out of strings
+def minifyText(text):
+  out = []
+  i = 0
+  n = len(text)
+  while i < n:
+    c = text[i]
+    if text.startswith("/*", i):
+      i = skip(text, i)
+      continue
+    if c == '"' or c == "'":
+      end = skip(text, i)
+      out.append(text[i:end])
+      i = end
+      continue
+    if c.isspace():
+      while i < n and text[i].isspace():
+        i += 1
+      if out and out[-1][-1:] not in "{};:," and i < n and \
+          text[i] not in "{};:,":
+        out.append(" ")
+      continue
+    if c in "{};:,":
+      while out and out[-1] == " ":
+        out.pop()
+    out.append(c)
+    i += 1
+  return "".join(out).replace(";}", "}")
+
+# Inline styles which are used more than once in the book are replaced by
+# a class, with a rule in the stylesheet, when that makes the book
+# smaller, as oneTableBlock does for the styles of table cells; so each
+# long style='...' is written once.  An inline style overrides every rule
+# of the stylesheet, so the rule's declarations are !important, or a rule
+# for a more specific selector, such as div.blockquote p, would now win.
+# An !important declaration of the book's own <style> did win over the
+# inline style, and would lose to the class, which comes after it; so a
+# style which sets a property the book declares !important is left alone.
+# So is a style with parentheses, as in a url, a quote, or its own
+# !important, and an empty one; and one which the ebook-convert command
+# line looks for, such as the page-break-before:always of a <div> which
+# --page-breaks-before matches, since a class would not match.
+regexTag = re.compile(r"<[a-zA-Z][^<>]*\sstyle=[^<>]*>")
+regexStyleAttribute = re.compile(r"""\sstyle=(['"])(.*?)\1""")
+regexClassInTag = re.compile(r"""\sclass=(['"])(.*?)\1""")
+regexImportant = re.compile(r"([-\w]+)\s*:[^;:{}]*!\s*important", re.I)
+regexXPathStyle = re.compile(r"@style='(.*?)'")
+
+STYLE_PRIORITY = 990
+STYLE_CLASS = "style"
+
+# The styles the ebook-convert arguments match with @style='...'
+def converterStyles():
+  from main import OPT_COMMON_ARGS
+  return set(regexXPathStyle.findall(" ".join(OPT_COMMON_ARGS)))
+
+def compactable(style, important, converter):
+  if style.strip() == "" or style in converter or \
+      any(c in style for c in "!'\"("):
+    return False
+  return not any(d.split(":")[0].strip().lower() in important
+    for d in style.split(";"))
+
+# The properties which the lines, or the css, declare !important
+def importantProperties(lines, css):
+  important = set()
+  for text in lines + [ css.text() ]:
+    if "important" in text:
+      important.update(p.lower() for p in regexImportant.findall(text))
+  return important
+
+def compactStyles(lines, css):
+  counts = {}
+  for line in lines:
+    if "style=" in line:
+      for tag in regexTag.finditer(line):
+        for m in regexStyleAttribute.finditer(tag.group(0)):
+          style = m.group(2)
+          counts[style] = counts.get(style, 0) + 1
+
+  used = usedClasses(lines)
+  important = importantProperties(lines, css)
+  converter = converterStyles()
+  classes = {}
+  n = 0
+  for style, count in counts.items():
+    if count < 2 or not compactable(style, important, converter):
+      continue
+    while STYLE_CLASS + str(n) in used:
+      n += 1
+    name = STYLE_CLASS + str(n)
+    declarations = [ d.strip() for d in style.split(";") if d.strip() ]
+    rule = "[{}] .{} {{ {}; }}".format(STYLE_PRIORITY, name,
+      "; ".join(d + " !important" for d in declarations))
+    # Only if it makes the book smaller
+    if count * (len(style) - len(name)) <= len(rule):
+      continue
+    n += 1
+    classes[style] = name
+    css.addcss(rule)
+  if len(classes) == 0:
+    return
+
+  def replaceTag(tag):
+    tag = tag.group(0)
+    m = regexStyleAttribute.search(tag)
+    if m is None or m.group(2) not in classes:
+      return tag
+    name = classes[m.group(2)]
+    c = regexClassInTag.search(tag)
+    if c is None:
+      return tag[:m.start()] + " class='" + name + "'" + tag[m.end():]
+    tag = tag[:m.start()] + tag[m.end():]
+    c = regexClassInTag.search(tag)
+    value = (c.group(2) + " " + name).strip()
+    return tag[:c.start(2)] + value + tag[c.end(2):]
+
+  for i, line in enumerate(lines):
+    if "style=" in line:
+      lines[i] = regexTag.sub(replaceTag, line)
+
+class TestStylesheet(unittest.TestCase):
+  def sheet(self, *strings):
+    s = Stylesheet()
+    for string in strings:
+      s.addcss(string)
+    return s
+
+  # By number, not as strings; with the text of each as it was
+  def test_stylesheet_order(self):
+    s = self.sheet("[1234] .summary { }", "[411] .a { x:1; }",
+      " [411] .footnote-id {\n  y:2;\n}", "[170] p { text-indent:0;",
+      "[171]     text-align:justify; }", "[411] .a { x:1; }")
+    self.assertEqual(len(s), 5)
+    self.assertEqual(s.show(), [
+      "      p { text-indent:0;",
+      "          text-align:justify; }",
+      "      .a { x:1; }",
+      "      .footnote-id {",
+      "        y:2;",
+      "      }",
+      "      .summary { }",
+    ])
+
+  def test_stylesheet_parse(self):
+    text = "/* c */ a.x, b { c: \"}\" }\n@media print { .y { z:1 } }\n.q {"
+    rules = parse(text)
+    self.assertEqual([ r.selector for r in rules ], [ "a.x, b", None, None ])
+    self.assertEqual(rules[0].declarations, " c: \"}\" ")
+    self.assertEqual(text[rules[1].start:rules[1].end],
+      "@media print { .y { z:1 } }")
+    self.assertEqual(rules[0].classes(), [ [ "x" ], [] ])
+
+  def test_stylesheet_prune(self):
+    s = self.sheet("[100] body { margin:0; }", "[200] .it { a:1; }",
+      "[200] .gone, .gone2 { b:2; }", "[300] .it.gone { c:3; }\n.it { d:4; }",
+      "[400] td.x:after { content:'.gone {' }", "[500] p.it { a:1; }")
+    classes = usedClasses([ "<p class='it x'>", '<td class="x">' ])
+    self.assertEqual(classes, { "it", "x" })
+    self.assertEqual(s.show(classes), [
+      "      body { margin:0; }",
+      "      .it { a:1; }",
+      "      .it { d:4; }",
+      "      td.x:after { content:'.gone {' }",
+      "      p.it { a:1; }",
+    ])
+
+  # The first of two the same is dropped
+  def test_stylesheet_duplicate(self):
+    s = self.sheet("[100] .a { x:1; }", "[200] .b { x:2; }",
+      "[300] .a {\n  x:1;\n}")
+    self.assertEqual(s.show(), [ "      .b { x:2; }", "      .a {",
+      "        x:1;", "      }" ])
+
+  def test_stylesheet_minify(self):
+    s = self.sheet("[100] body { margin-left : 10%;\n  margin-right:10%; }",
+      "[200] /* note */ .a ,\n .b  { font-family: 'Times New Roman', serif; }",
+      "[201] .a , .b { color:red }", "[300] .empty { }",
+      "[400] @media print { .a { x : 1 } }")
+    s.minify = True
+    self.assertEqual(s.show(), [ "      body{margin-left:10%;margin-right:10%}"
+      ".a,.b{font-family:'Times New Roman',serif;color:red}"
+      "@media print{.a{x:1}}" ])
+
+  def test_stylesheet_compact(self):
+    def book(td, p1, p2):
+      return [ td ] * 8 + [ p1, p2 ] * 4 + [ "<div style='only:once'>",
+        "<span style='url(x)'></span>" * 8, "<i style='a:b'>" * 8,
+        "style='vertical-align:top;' in text, <p class='style0'>" ]
+    lines = book("<td style='vertical-align:top;'>a</td>",
+      "<p class='pindent' style=\"margin-top:1em; text-align:center\">x",
+      "<p style='margin-top:1em; text-align:center' class=\"c\">")
+    s = Stylesheet()
+    compactStyles(lines, s)
+    self.assertEqual(lines, book("<td class='style1'>a</td>",
+      "<p class='pindent style2'>x", "<p class=\"c style2\">"))
+    self.assertEqual(s.show(), [
+      "      .style1 { vertical-align:top !important; }",
+      "      .style2 { margin-top:1em !important; text-align:center !important; }",
+    ])
+
+  # ebook-convert still finds the page breaks
+  def test_stylesheet_compact_page_break(self):
+    self.assertIn("page-break-before:always", converterStyles())
+    lines = [ "<div style='page-break-before:always'></div>" ] * 8
+    compactStyles(lines, Stylesheet())
+    self.assertEqual(lines,
+      [ "<div style='page-break-before:always'></div>" ] * 8)
+
+  # The book's own !important rules still win over what was inline
+  def test_stylesheet_compact_important(self):
+    lines = [ "<style>", "p.c { Text-Align : left ! important; }",
+      "</style>" ] + [ "<p style='margin-top:1em; text-align:center'>",
+      "<td style='vertical-align:top; margin-left:2em'>" ] * 8
+    s = self.sheet("[100] td { margin-left:0 !important; }")
+    compactStyles(lines, s)
+    self.assertEqual(lines[3:5], [
+      "<p style='margin-top:1em; text-align:center'>",
+      "<td style='vertical-align:top; margin-left:2em'>" ])
+    self.assertEqual(len(s), 1)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from optparse import OptionParser
+import os
+import random
+
+# synthbook: write a synthetic fpgen source, of any size, for benchmarks.
+#
+# The book is made of chapters, each of which uses most of what fpgen
+# supports: paragraphs with inline markup and footnotes, page numbers,
+# a table, poetry, an illustration, drama, a summary, a sidenote and
+# a multicol; and the book ends with an index.  Everything scales with
+# the number of chapters, so a book with ten times the chapters is ten
+# times the size.  The text is random, but the same for the same seed.
+
+WORDS = """
+  the of and to in that was his he it with is for as had you not be her
+  on at by which have or from this him but all she they were my are me
+  one their so an said them we who would been will no when there if more
+  out up into do any your what has man could other than our some very
+  time upon about may its only now like little then can should made did
+  us such great before must two these see know over much down after first
+  mr good men own never most old shall day where those came come himself
+""".split()
+
+class Shape(object):
+  def __init__(self):
+    self.chapters = 10
+    self.paragraphs = 12 # per chapter
+    self.footnotes = 4 # per chapter
+    self.tableRows = 10 # per chapter
+    self.poems = 2 # per chapter
+    self.illustrations = 1 # per chapter
+    self.dramaSpeeches = 6 # per chapter
+    self.indexEntries = 5 # per chapter
+    self.pageEvery = 3 # paragraphs per page number
+    self.seed = 1
+
+  # Everything is per chapter, so scaling is just more chapters
+  def scaled(self, scale):
+    shape = Shape()
+    shape.__dict__.update(self.__dict__)
+    shape.chapters = self.chapters * scale
+    return shape
+
+class Synth(object):
+  def __init__(self, shape):
+    self.shape = shape
+    self.random = random.Random(shape.seed)
+    self.page = 0
+    self.note = 0
+    self.lines = []
+    self.images = []
+
+  def words(self, n):
+    return " ".join(self.random.choice(WORDS) for i in range(n))
+
+  def sentence(self):
+    s = self.words(self.random.randint(6, 18))
+    return s[0].upper() + s[1:] + "."
+
+  # A paragraph, with some inline markup, wrapped like a real source
+  def paragraph(self, footnote):
+    text = []
+    for i in range(self.random.randint(3, 6)):
+      s = self.sentence()
+      r = self.random.random()
+      if r < 0.15:
+        s = "<i>" + s[:-1] + "</i>."
+      elif r < 0.2:
+        s = s[:-1] + " <sc>" + self.words(2) + "</sc>."
+      elif r < 0.25:
+        s = s[:-1] + " <b>" + self.words(1) + "</b>."
+      text.append(s)
+    if footnote:
+      self.note += 1
+      text[-1] = text[-1][:-1] + "<fn id='" + str(self.note) + "'>."
+    line = ""
+    for s in text:
+      for word in s.split(" "):
+        if len(line) + len(word) > 70:
+          self.lines.append(line)
+          line = word
+        elif line == "":
+          line = word
+        else:
+          line += " " + word
+    self.lines.append(line)
+    self.lines.append("")
+
+  def pageNumber(self):
+    self.page += 1
+    self.lines.append("<pn='" + str(self.page) + "'>")
+
+  def footnote(self, id):
+    self.lines.append("<footnote id='" + str(id) + "'>")
+    self.lines.append(self.sentence())
+    self.lines.append("</footnote>")
+    self.lines.append("")
+
+  def table(self):
+    self.lines.append("<table pattern='l20 r6 r8'>")
+    self.lines.append("Item|Count|Price")
+    self.lines.append("_")
+    for i in range(self.shape.tableRows):
+      self.lines.append("{}|{}|{}.{:02}".format(self.words(2),
+        self.random.randint(1, 500), self.random.randint(0, 99),
+        self.random.randint(0, 99)))
+    self.lines.append("</table>")
+    self.lines.append("")
+
+  def poem(self):
+    self.lines.append("<lg>")
+    for i in range(self.random.randint(4, 8)):
+      indent = "    " if i % 2 == 1 else ""
+      self.lines.append(indent + self.words(self.random.randint(4, 8)))
+    self.lines.append("</lg>")
+    self.lines.append("")
+
+  def illustration(self, chapter, n):
+    name = "images/c{}-{}.jpg".format(chapter, n)
+    self.images.append(name)
+    self.lines.append("<illustration src='{}' rend='w:50%' id='i{}-{}'>"
+      .format(name, chapter, n))
+    self.lines.append("<caption>")
+    self.lines.append(self.sentence())
+    self.lines.append("</caption>")
+    self.lines.append("</illustration>")
+    self.lines.append("")
+
+  def drama(self):
+    self.lines.append("<drama>")
+    self.lines.append("<stage>" + self.sentence() + "</stage>")
+    self.lines.append("")
+    for i in range(self.shape.dramaSpeeches):
+      speaker = [ "HAMLET.", "OPHELIA.", "POLONIUS." ][i % 3]
+      self.lines.append("<sp>" + speaker + "</sp> " + self.sentence())
+      self.lines.append("")
+    self.lines.append("</drama>")
+    self.lines.append("")
+
+  def chapter(self, c):
+    shape = self.shape
+    self.pageNumber()
+    self.lines.append("<chap-head id='c{}'>CHAPTER {}</chap-head>".format(c, c))
+    self.lines.append("<sub-head>" + self.words(4) + "</sub-head>")
+    self.lines.append("")
+    self.lines.append("<summary>")
+    self.lines.append(self.sentence())
+    self.lines.append("</summary>")
+    self.lines.append("")
+
+    # Spread the rest out among the paragraphs
+    firstNote = self.note + 1
+    for p in range(shape.paragraphs):
+      if p > 0 and p % shape.pageEvery == 0:
+        self.pageNumber()
+      self.paragraph(p < shape.footnotes)
+      if p < shape.poems:
+        self.poem()
+      if p < shape.illustrations:
+        self.illustration(c, p)
+      if p == 1:
+        self.table()
+      if p == 2:
+        self.lines.append("<sidenote>" + self.words(3) + "</sidenote>")
+        self.paragraph(False)
+      if p == 3:
+        self.drama()
+    for id in range(firstNote, self.note + 1):
+      self.footnote(id)
+    self.lines.append("<multicol>")
+    for i in range(6):
+      self.lines.append(self.words(2))
+    self.lines.append("</multicol>")
+    self.lines.append("")
+
+  def index(self):
+    self.lines.append("<heading level='1'>INDEX</heading>")
+    self.lines.append("")
+    self.lines.append("<index>")
+    entries = self.shape.indexEntries * self.shape.chapters
+    for i in range(entries):
+      pages = sorted(self.random.sample(range(1, self.page + 1),
+        min(3, self.page)))
+      self.lines.append("{}, {}".format(self.words(2).capitalize(),
+        ", ".join(str(p) for p in pages)))
+      if i % 4 == 0:
+        self.lines.append("  " + self.words(1) + ", " + str(pages[0]))
+    self.lines.append("</index>")
+    self.lines.append("")
+
+  def book(self):
+    self.lines = [
+      "<property name='cover image' content='images/cover.jpg'>",
+      "<option name='pstyle' content='indent'>",
+      "<option name='footnote-location' content='heading'>",
+      "<option name='warning-suppress' content='wrapping longpoetry widetable'>",
+      ".title A Synthetic Book of {} Chapters".format(self.shape.chapters),
+      ".author Synthbook",
+      ".language en",
+      ".created 1920",
+      "",
+      "<tocloc heading='Contents'>",
+      "",
+    ]
+    self.images = [ "images/cover.jpg" ]
+    for c in range(1, self.shape.chapters + 1):
+      self.chapter(c)
+    self.index()
+    return self.lines
+
+# Write the book, and an empty file for each image it uses
+def writeBook(shape, filename):
+  synth = Synth(shape)
+  lines = synth.book()
+  with open(filename, "w", encoding='utf-8') as f:
+    f.write("\n".join(lines) + "\n")
+  dir = os.path.dirname(filename)
+  for image in synth.images:
+    path = os.path.join(dir, image)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not os.path.exists(path):
+      open(path, "wb").close()
+  return len(lines)
+
+def main():
+  parser = OptionParser(usage="usage: %prog [options] book-src.txt")
+  shape = Shape()
+  for name, value in shape.__dict__.items():
+    parser.add_option("--" + name, dest=name, type="int", default=value,
+      help="default " + str(value))
+  parser.add_option("-s", "--scale", dest="scale", type="int", default=1,
+    help="multiply the number of chapters")
+  (options, args) = parser.parse_args()
+  if len(args) != 1:
+    parser.error("one output file")
+  for name in shape.__dict__:
+    setattr(shape, name, getattr(options, name))
+  n = writeBook(shape.scaled(options.scale), args[0])
+  print("{}: {} lines".format(args[0], n))
+
+if __name__ == '__main__':
+  main()
@@ -1104,3 +1104,57 @@ class TestHTMLPara(unittest.TestCase):
         "⩤span class='dropcap'⩥w⩤/span⩥ord1⩤/span⩥ w2 w3",
       "w4 w5",
     ])
+
+  # Each of the special characters, and escapes beside other markup
+  def test_html_preprocess(self):
+    wb = [
+      "a\\ b c \\% \\# \\<i\\> \\<thinsp> <thinsp><shy><l/>",
+      "wait. . . . or .. . \\. . \\' \\\" & \\\\ x",
+      config.FORMATTED_PREFIX + "a . . & \\%",
+    ]
+    self.html.preprocessOneBlock(wb)
+    self.assertSequenceEqual(wb, [
+      "a⋀b⋀c ⊐ ⊏ ≼i≽ ≼thinsp>  ­<l></l>",
+      "wait.⋀.⋀.⋀. or ..⋀. \\.⋀. ⧗ ⧢ ⧲ \\⋀x",
+      config.FORMATTED_PREFIX + "a . . & \\%",
+    ])
+
+  def test_html_cleanup(self):
+    self.html.wb = [
+      "①a② ⧲ ≼⋀▹x H_{2}O Rob^t Rob^{st} ^{} a^{b^c}",
+      "no markup",
+    ]
+    self.html.cleanup()
+    self.assertSequenceEqual(self.html.wb, [
+      "<span class='it'>a</span> &amp; &lt;&nbsp;x H<sub>2</sub>O " +
+        "Rob<sup>t</sup> Rob<sup>st</sup> <sup>&#8203;</sup> " +
+        "a<sup>b<sup>c</sup></sup>",
+      "no markup",
+    ])
+
+  # The font spans are each book's own
+  def test_html_cleanup_fonts(self):
+    other = HTML(None, None, 0, 'h')
+    self.html.uprop.addprop("font-one", "one.ttf")
+    other.uprop.addprop("font-two", "two.ttf")
+    self.html.wb = [ chr(config.FONT_BASE) + "a" + config.FONT_END ]
+    other.wb = [ chr(config.FONT_BASE) + "b" + config.FONT_END ]
+    before = dict(HTML.cleanTrans)
+    self.html.cleanup()
+    other.cleanup()
+    self.assertEqual(self.html.wb,
+      [ "<span style=\"font-family:'one';\">a</span>" ])
+    self.assertEqual(other.wb,
+      [ "<span style=\"font-family:'two';\">b</span>" ])
+    self.assertEqual(HTML.cleanTrans, before)
+
+  # The font tags are hidden from the passes between, and then made into
+  # their internal characters; other tags are left alone
+  def test_html_protect_restore(self):
+    block = [ "a <i>b</i> <fs:l>c</fs><fn id='1'> <ol>d</ol> <bx> <i/>" ]
+    self.html.protectMarkup(block)
+    self.assertEqual(block, [ "a ⩤i⩥b⩤/i⩥ ⩤fs:l⩥c⩤/fs⩥⩤fn id='1'⩥ " +
+      config.OL_START + "d" + config.OL_END + " <bx> <i/>" ])
+    self.html.restoreMarkup(block)
+    self.assertEqual(block, [ "a ①b② ⓯c⓳<fn id='1'> " +
+      config.OL_START + "d" + config.OL_END + " <bx> <i/>" ])
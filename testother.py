@@ -11,6 +11,19 @@ class TestBookVarious(unittest.TestCase):
   def tearDown(self):
     config.uopt = userOptions()
 
+  # The characters used internally are warned about, once per line
+  def test_book_reserved(self):
+    import io
+    import contextlib
+    self.book.wb = [ "plain & <i>text</i>", "circled ① and ⓯", "a ⩤b⩥" ]
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+      self.book.checkReserved()
+    warnings = [ l for l in out.getvalue().split("\n")
+      if l.startswith("warning") ]
+    self.assertEqual(len(warnings), 2)
+    self.assertIn("U+2460", warnings[0])
+    self.assertIn("U+2A64", warnings[1])
+
   # Test the method Book.parseVersion
   def test_book_version(self):
     major, minor, letter = Book.parseVersion("4.55d")
@@ -52,3 +65,41 @@ class TestBookVarious(unittest.TestCase):
     with self.assertRaises(SystemExit) as cm:
       self.book.versionCheck()
     self.assertEqual(cm.exception.code, 1)
+
+  # Test the method Book.extractDirectives
+  def test_book_extract_directives(self):
+    self.book.wb = [
+      ".title %t%",
+      "<macro t=\"A Title\"/>",
+      "<option name='pstyle' content='indent'>",
+      "text %t%",
+      "<template name='x' type='macro'>",
+      "<meta name='m' content='in template'>",
+      "</template>",
+      "<lit>",
+      "<meta name='m' content='literal'>",
+      "</lit>",
+      "<meta name='m' content='%t%'>",
+      ".unknown directive",
+    ]
+    self.book.extractDirectives()
+    self.assertSequenceEqual(self.book.wb, [
+      "text A Title",
+      "<lit>",
+      "<meta name='m' content='literal'>",
+      "</lit>",
+      ".unknown directive",
+    ])
+    self.assertSequenceEqual(self.book.directives, [
+      ".title A Title",
+      "<option name='pstyle' content='indent'>",
+      "<meta name='m' content='A Title'>",
+    ])
+    self.assertSequenceEqual(self.book.userTemplates, [
+      (" name='x' type='macro'", [ "<meta name='m' content='in template'>" ]),
+    ])
+
+  def test_book_extract_directives_unclosed_template(self):
+    self.book.wb = [ "<template name='x' type='macro'>", "text" ]
+    with self.assertRaises(SystemExit):
+      self.book.extractDirectives()
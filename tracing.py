@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+
+import parse
+import passes
+
+# --trace file.json: record every pass of every Book, and every task of
+# the build (including each ebook-convert and kindlegen run), in the
+# Chrome trace event format, for chrome://tracing or ui.perfetto.dev.
+#
+# Passes are begin/end pairs, with the number of lines in the book's
+# buffer at each, so both the time and the growth of the buffer can be
+# seen; and the hits and misses so far of the attribute and option caches
+# in parse.py.  Times are wall clock, so events recorded in worker processes
+# with --jobs line up with those recorded here.
+
+class TraceRecorder(passes.PassListener):
+  def __init__(self):
+    self.events = []
+    self.pid = os.getpid()
+
+  def event(self, ph, name, cat, args):
+    self.events.append({
+      "name" : name,
+      "cat" : cat,
+      "ph" : ph,
+      "ts" : time.time_ns() // 1000,
+      "pid" : self.pid,
+      "tid" : threading.get_ident(),
+      "args" : args,
+    })
+
+  # Passes
+  def passArgs(self, book):
+    args = { "lines" : len(book.wb) }
+    args.update(parse.cacheCounts())
+    return args
+
+  def begin(self, book, name):
+    self.event("B", name, passes.bookName(book), self.passArgs(book))
+
+  def end(self, book, name):
+    self.event("E", name, passes.bookName(book), self.passArgs(book))
+
+  # Scheduler tasks
+  def taskBegin(self, task):
+    self.event("B", task.name, "task", {})
+
+  def taskEnd(self, task, ok):
+    args = { "ok" : ok, "cached" : task.cached }
+    command = getattr(task, "commandLine", None)
+    if command:
+      args["command"] = command
+    self.event("E", task.name, "task", args)
+
+  # Events recorded in a worker
+  def merge(self, events):
+    self.events.extend(events)
+
+  def save(self, filename):
+    with open(filename, "w", encoding='utf-8') as f:
+      json.dump({ "traceEvents" : self.events, "displayTimeUnit" : "ms" }, f)
+
+class TestTracing(unittest.TestCase):
+  def setUp(self):
+    self.recorder = passes.addListener(TraceRecorder())
+
+  def tearDown(self):
+    passes.removeListener(self.recorder)
+    import config
+    config.setContext(config.BuildContext())
+
+  def test_tracing_passes(self):
+    from fpgen import Book
+    book = Book("x-src.txt", "x.html", 0, 'h')
+    book.wb = [ "a" ]
+    def grow():
+      book.wb.extend([ "b", "c" ])
+    book.step(grow)
+    begin, end = self.recorder.events
+    self.assertEqual((begin["ph"], begin["name"], begin["args"]["lines"]),
+      ("B", "grow", 1))
+    self.assertEqual((end["ph"], end["name"], end["args"]["lines"]),
+      ("E", "grow", 3))
+    self.assertEqual(begin["cat"], "Book x.html")
+    self.assertIn("option hits", end["args"])
+    self.assertLessEqual(begin["ts"], end["ts"])
+    self.assertEqual(begin["tid"], end["tid"])
+
+  # Parsing the same options again is counted as a hit
+  def test_tracing_cache_counts(self):
+    from fpgen import Book
+    book = Book("x-src.txt", "x.html", 0, 'h')
+    def options():
+      parse.parseOption("x", "tracing:1 test")
+      parse.parseOption("x", "tracing:1 test")
+    book.step(options)
+    begin, end = self.recorder.events
+    hits = end["args"]["option hits"] - begin["args"]["option hits"]
+    misses = end["args"]["option misses"] - begin["args"]["option misses"]
+    self.assertGreaterEqual(hits, 1)
+    self.assertEqual(hits + misses, 2)
+
+  def test_tracing_tasks(self):
+    from scheduler import Scheduler, CommandTask
+    s = Scheduler()
+    s.listeners.append(self.recorder)
+    s.add(CommandTask("a", "true"))
+    s.add(CommandTask("b", "false"))
+    s.run()
+    events = [ (e["ph"], e["name"], e["args"].get("ok"))
+      for e in self.recorder.events ]
+    self.assertEqual(events, [ ("B", "a", None), ("E", "a", True),
+      ("B", "b", None), ("E", "b", False) ])
+    self.assertEqual(self.recorder.events[1]["args"]["command"], "true")
+
+  def test_tracing_save(self):
+    self.recorder.event("B", "x", "y", {})
+    fd, name = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+      self.recorder.save(name)
+      with open(name) as f:
+        trace = json.load(f)
+    finally:
+      os.remove(name)
+    self.assertEqual(trace["traceEvents"][0]["name"], "x")
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import re
+import sys
+import contextlib
+import unittest
+
+import msgs
+import config
+import cache
+
+# Chapter-granular incremental regeneration.  A pass which runs through
+# units.run works on the book a chapter at a time, and the result for each
+# chapter is kept in the build cache (cache.py); when a book is generated
+# again after a change to one chapter, the other chapters are copied from
+# the cache, and only the changed one goes through the pass.
+#
+# A chapter, or unit, starts at a level 1 <heading>, or once headings are
+# html, at the <h1> of one.  The key of a unit is its lines, the fpgen
+# version and format, the .title, <meta>, <option> and <property> lines of
+# the book, which are everything else a pass looks at; and the state the
+# pass carries from one unit to the next, given as the names of attributes
+# of the Book: Text.rewrap's stack of <quote> indents, and the rend and
+# poetry state of HTML.doLines.  The cache holds the unit's new lines, the
+# state after it, and what the pass printed and the css it added, which
+# are replayed when it is used.
+#
+# Only passes which go down the book line by line, or block by block within
+# a chapter, can be run like this; those which gather from the whole book,
+# such as the footnotes, page numbers and table of contents, always see it
+# all.  Unless --cache and --unit-cache are given, or with --debug, the
+# pass runs on the whole book at once, as it always has.
+
+regexLevel = re.compile(r"<heading[^>]*level=['\"](\d)")
+
+# The first line of a chapter; a <heading> with no level is level 1
+def isChapter(line):
+  if line.startswith("<heading"):
+    m = regexLevel.match(line)
+    return m is None or m.group(1) == "1"
+  return line.startswith("<div") and "<h1" in line
+
+# (start, end) of each unit of lines; the first is whatever comes before
+# the first chapter
+def segment(lines, isStart = isChapter):
+  bounds = []
+  start = 0
+  for i, line in enumerate(lines):
+    if i > start and isStart(line):
+      bounds.append((start, i))
+      start = i
+  if start < len(lines):
+    bounds.append((start, len(lines)))
+  return bounds
+
+class UnitCache(object):
+  def __init__(self, buildCache = None):
+    self.cache = buildCache if buildCache is not None else cache.BuildCache()
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, book, name, lines, state):
+    return self.cache.key([ config.VERSION, book.gentype, name, repr(state),
+      str(len(book.directives)) ] + book.directives + [ "\n".join(lines) ])
+
+  def restore(self, key):
+    hit, value = self.cache.restore(key, [])
+    if hit:
+      self.hits += 1
+    else:
+      self.misses += 1
+    return hit, value
+
+  def store(self, key, value):
+    self.cache.store(key, [], value)
+
+# Run function, a pass over book.wb, a unit at a time when the book has a
+# unit cache.  names are the attributes of book which are the state of the
+# pass between units.
+def run(book, function, names):
+  unitCache = getattr(book, "unitCache", None)
+  if unitCache is None or int(book.debug) > 0:
+    function()
+    return
+
+  lines = book.wb
+  result = []
+  try:
+    for start, end in segment(lines):
+      unit = lines[start:end]
+      state = { name : getattr(book, name, None) for name in names }
+      key = unitCache.key(book, function.__name__, unit, state)
+      hit, value = unitCache.restore(key)
+      if hit:
+        unit, state, output, css = value
+        sys.stdout.write(output)
+        for s in css:
+          book.css.addcss(s)
+        for name, v in state.items():
+          setattr(book, name, v)
+      else:
+        book.wb = unit
+        unit, output, css = runUnit(book, function)
+        state = { name : getattr(book, name, None) for name in names }
+        unitCache.store(key, (unit, state, output, css))
+      result.extend(unit)
+  finally:
+    book.wb = lines
+  lines[:] = result
+
+# Run the pass over the one unit in book.wb, recording what it prints and
+# the css it adds; returns the new lines, the output and the css
+def runUnit(book, function):
+  out = io.StringIO()
+  bookCss = getattr(book, "css", None)
+  css = [] if bookCss is None else bookCss.record()
+  try:
+    with msgs.capture(out):
+      function()
+  finally:
+    if bookCss is not None:
+      bookCss.stopRecording()
+    # Shown even when the pass fails, as it would have been
+    sys.stdout.write(out.getvalue())
+  return book.wb, out.getvalue(), css
+
+class TestUnits(unittest.TestCase):
+  def setUp(self):
+    import os
+    import tempfile
+    self.cwd = os.getcwd()
+    self.dir = tempfile.TemporaryDirectory()
+    os.chdir(self.dir.name)
+
+  def tearDown(self):
+    import os
+    os.chdir(self.cwd)
+    self.dir.cleanup()
+    config.setContext(config.BuildContext())
+
+  def test_units_segment(self):
+    lines = [ "title", "<heading level='1'>One</heading>", "a",
+      "<heading level='2'>Sub</heading>", "b", "<heading>Two</heading>",
+      "<div><h1 id='x'>Three</h1></div>", "c" ]
+    self.assertEqual(segment(lines), [ (0, 1), (1, 5), (5, 6), (6, 8) ])
+    self.assertEqual(segment(lines[1:3]), [ (0, 2) ])
+    self.assertEqual(segment([]), [])
+
+  # A pass which numbers its lines across the units, and adds css
+  def book(self, lines):
+    from fpgen import HTML
+    book = HTML(None, None, 0, 'h')
+    book.wb = lines
+    book.unitCache = UnitCache()
+    book.count = 0
+    def number():
+      for i, line in enumerate(book.wb):
+        book.count += 1
+        book.css.addcss("[100] .n" + str(book.count % 2) + " { }")
+        book.wb[i] = str(book.count) + " " + line
+      print("numbered")
+    return book, number
+
+  def test_units_run(self):
+    lines = [ "<heading>One</heading>", "a", "<heading>Two</heading>", "b" ]
+    expected = [ "1 <heading>One</heading>", "2 a",
+      "3 <heading>Two</heading>", "4 b" ]
+    book, number = self.book(lines)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+      run(book, number, [ "count" ])
+    self.assertIs(book.wb, lines)
+    self.assertEqual(lines, expected)
+    self.assertEqual((book.unitCache.hits, book.unitCache.misses), (0, 2))
+    self.assertEqual(out.getvalue(), "numbered\nnumbered\n")
+
+    # Again, from the cache
+    again, number = self.book([ "<heading>One</heading>", "a",
+      "<heading>Two</heading>", "b" ])
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+      run(again, number, [ "count" ])
+    self.assertEqual(again.wb, expected)
+    self.assertEqual((again.unitCache.hits, again.unitCache.misses), (2, 0))
+    self.assertEqual(again.count, 4)
+    self.assertEqual(again.css.added, book.css.added)
+    self.assertEqual(out.getvalue(), "numbered\nnumbered\n")
+
+    # A change to the first unit; the second is the same, with the same
+    # state, so it is still from the cache
+    changed, number = self.book([ "<heading>One</heading>", "A",
+      "<heading>Two</heading>", "b" ])
+    with contextlib.redirect_stdout(io.StringIO()):
+      run(changed, number, [ "count" ])
+    self.assertEqual(changed.wb[1], "2 A")
+    self.assertEqual((changed.unitCache.hits, changed.unitCache.misses), (1, 1))
+
+  def test_units_no_cache(self):
+    book, number = self.book([ "<heading>One</heading>", "<heading>Two</heading>" ])
+    book.unitCache = None
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+      run(book, number, [ "count" ])
+    self.assertEqual(out.getvalue(), "numbered\n")
+    self.assertEqual(book.count, 2)
+
+  # What a unit prints is taken from its own thread only
+  def test_units_capture_thread(self):
+    import threading
+    started = threading.Event()
+    done = threading.Event()
+    def other():
+      started.wait()
+      print("other")
+      done.set()
+    out = io.StringIO()
+    outer = io.StringIO()
+    with contextlib.redirect_stdout(outer):
+      thread = threading.Thread(target=other)
+      thread.start()
+      with msgs.capture(out):
+        started.set()
+        done.wait()
+        print("unit")
+      thread.join()
+      print("after")
+    self.assertEqual(out.getvalue(), "unit\n")
+    self.assertEqual(outer.getvalue(), "other\nafter\n")
+    self.assertNotIsInstance(sys.stdout, msgs.ThreadStdout)
+
+  # A whole book, changed in one chapter, is the same as without the cache
+  def test_units_generate(self):
+    from formats import generateFormat
+    source = [
+      ".title A Book",
+      "<option name='pstyle' content='indent'>",
+      "<chap-head>One</chap-head>",
+      "", "Some text in <i>one</i>.", "",
+      "<quote>", "quoted", "</quote>", "",
+      "<chap-head>Two</chap-head>",
+      "", "<lg>", "a line", "</lg>", "", "Text in two.",
+    ]
+    def generate(lines, unitCache):
+      with open("book-src.txt", "w", encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+      outputs = {}
+      for fmt in "th":
+        with contextlib.redirect_stdout(io.StringIO()):
+          result = generateFormat(fmt, "book-src.txt", "book", 0, None,
+            unitCache = unitCache)
+        with open(result.outfile, "r", encoding='utf-8') as f:
+          outputs[fmt] = [ l for l in f.readlines() if "GMT" not in l ]
+      return outputs
+    generate(source, True)
+    source[4] = "Changed text in <i>one</i>."
+    self.assertEqual(generate(source, True), generate(source, False))
+    import os
+    self.assertTrue(os.path.isdir(cache.CACHE_DIR))